@@ -0,0 +1,54 @@
+"""
+Adaptive tessellation deflection: triangles and conversion time with one global deflection
+against ``ConvertArguments(adaptive_deflection=True)`` (see ``ifcexport2.deflection``).
+
+Triangles are counted per deflection class, the classification pre-pass is timed separately.
+
+    python benchmarks/bench_deflection.py [examples/AC-11-Smiley-West-04-07-2007.ifc] [-t 4]
+"""
+import argparse
+import time
+from pathlib import Path
+
+import ifcopenshell
+
+from ifcexport2.deflection import classify_products
+from ifcexport2.ifc_to_mesh import ConvertArguments, convert_stream
+
+EXAMPLE = Path(__file__).parent.parent / "examples" / "AC-11-Smiley-West-04-07-2007.ifc"
+
+
+def triangles(ifc_file, args, threads):
+    start = time.perf_counter()
+    counts = {o.id: len(o.mesh.faces) for o in convert_stream(ifc_file, args, threads=threads).objects}
+    return time.perf_counter() - start, counts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("ifc", nargs="?", type=Path, default=EXAMPLE)
+    parser.add_argument("-t", "--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    ifc_file = ifcopenshell.open(str(args.ifc))
+    products = ConvertArguments().select_products(ifc_file)
+    start = time.perf_counter()
+    classes = classify_products(ifc_file, products)
+    classify_time = time.perf_counter() - start
+
+    base_time, base = triangles(ifc_file, ConvertArguments(), args.threads)
+    adaptive_time, adaptive = triangles(ifc_file, ConvertArguments(adaptive_deflection=True), args.threads)
+
+    print(f"{args.ifc.name}: {len(products)} products, classified in {classify_time * 1e3:.1f} ms")
+    for deflection_class, selection in classes:
+        ids = [p.id() for p in selection]
+        before = sum(base.get(i, 0) for i in ids)
+        after = sum(adaptive.get(i, 0) for i in ids)
+        name = "default" if deflection_class is None else deflection_class.name
+        print(f"{name:>8}: {len(ids):6d} products, {before:9d} -> {after:9d} triangles")
+    print(f"   total: {sum(base.values()):9d} -> {sum(adaptive.values()):9d} triangles, "
+          f"{base_time:.2f} s -> {adaptive_time:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
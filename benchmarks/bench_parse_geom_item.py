@@ -0,0 +1,90 @@
+"""
+Per-product overhead of ``parse_geom_item``: the buffer based ingestion against the
+previous path that materialised ``geom.verts``/``geom.faces``/``geom.material_ids`` as
+Python sequences and built the colours through a generator.
+
+Only the parsing is timed (best of ``--repeat`` runs per product), not the tessellation.
+
+    python benchmarks/bench_parse_geom_item.py [examples/AC-11-Smiley-West-04-07-2007.ifc] [-r 5]
+"""
+import argparse
+import time
+from pathlib import Path
+
+import ifcopenshell
+import ifcopenshell.geom
+import numpy as np
+
+from ifcexport2.ifc_to_mesh import parse_geom_item, extract_color
+from ifcexport2.mesh import Mesh
+from ifcexport2.settings import ifcopenshell_default_settings_dict
+
+EXAMPLE = Path(__file__).parent.parent / "examples" / "AC-11-Smiley-West-04-07-2007.ifc"
+
+
+def parse_geom_item_sequences(item):
+    """The sequence based ingestion used before (reference implementation)."""
+    materials_colors = np.array(list(extract_color(item)), dtype=np.float32)
+    geom = item.geometry
+    faces = geom.faces
+    verts = geom.verts
+    verts = np.array(verts, dtype=np.float32).reshape((len(verts) // 3, 3))
+    faces = np.array(faces, dtype=int).reshape((len(faces) // 3, 3))
+    cols = materials_colors[np.array(geom.material_ids, dtype=int)]
+    ccols = cols[np.arange(faces.shape[0]).repeat(3)]
+    colors = np.zeros_like(verts)
+    colors[faces] = ccols.reshape((*faces.shape, 3))
+    return Mesh(verts, faces=faces, colors=colors, uid=item.id)
+
+
+def iter_shapes(path: Path, threads: int):
+    ifc_file = ifcopenshell.open(str(path))
+    settings = ifcopenshell.geom.settings()
+    for k, v in ifcopenshell_default_settings_dict.items():
+        settings.set(getattr(settings, k), v)
+    iterator = ifcopenshell.geom.iterator(settings, ifc_file, num_threads=threads)
+    if iterator.initialize():
+        while True:
+            yield iterator.get()
+            if not iterator.next():
+                break
+
+
+def timed(fn, shape, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(shape)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("ifc", nargs="?", type=Path, default=EXAMPLE)
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument("-t", "--threads", type=int, default=4)
+    args = parser.parse_args()
+
+    # Shapes are only valid until the iterator moves on, so both paths are timed
+    # on each shape as it comes out of the iterator.
+    methods = (("sequences", parse_geom_item_sequences), ("buffers", parse_geom_item))
+    totals = {name: 0.0 for name, _ in methods}
+    products = vertices = 0
+    for shape in iter_shapes(args.ifc, args.threads):
+        for name, fn in methods:
+            totals[name] += timed(fn, shape, args.repeat)
+        # Both paths must produce the same mesh
+        a, b = parse_geom_item_sequences(shape), parse_geom_item(shape)[2]
+        assert np.array_equal(a.position, b.position) and np.array_equal(a.faces, b.faces)
+        assert np.array_equal(a.colors, b.colors)
+        products += 1
+        vertices += a.position.shape[0]
+
+    print(f"{args.ifc.name}: {products} products, {vertices} vertices")
+    for name, total in totals.items():
+        print(f"{name:>10}: {total * 1e3:8.2f} ms total, {total / products * 1e6:8.1f} us/product")
+
+
+if __name__ == "__main__":
+    main()
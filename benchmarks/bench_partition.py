@@ -0,0 +1,71 @@
+"""
+Partitioning of large trees: ``partition_tree`` (part count or byte budget) against ``split_into_k_subtrees``
+on synthetic models of 10^5-10^6 leaves (buildings > storeys > containers > products, log-normal sizes).
+
+Time per leaf stays flat as the tree grows, the balance is reported as the largest part over the mean part.
+
+    python benchmarks/bench_partition.py [-n 100000 300000 1000000] [-k 64]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from ifcexport2.partition import Node, partition_tree, split_into_k_subtrees, flatten_leaves
+
+
+def synthetic_tree(leaves: int, seed: int = 0) -> Node:
+    rng = np.random.default_rng(seed)
+    sizes = rng.lognormal(9, 1.5, leaves).astype(np.int64)
+    # Products per container, containers per storey, storeys per building
+    containers = np.split(np.arange(leaves), np.cumsum(rng.integers(5, 200, leaves // 5)))
+    containers = [c for c in containers if len(c)]
+    storeys = [containers[i:i + 12] for i in range(0, len(containers), 12)]
+    buildings = [storeys[i:i + 20] for i in range(0, len(storeys), 20)]
+    return Node(False, children=[
+        Node(False, children=[
+            Node(False, children=[
+                Node(False, children=[Node(True, int(sizes[i])) for i in container])
+                for container in storey])
+            for storey in building])
+        for building in buildings])
+
+
+def imbalance(groups):
+    sizes = np.array([sum(leaf.size for leaf in flatten_leaves(g)) for g in groups])
+    return sizes.max() / sizes.mean(), len(sizes)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--leaves", type=int, nargs="+", default=[100_000, 300_000, 1_000_000])
+    parser.add_argument("-k", "--parts", type=int, default=64)
+    args = parser.parse_args()
+
+    for n in args.leaves:
+        tree = synthetic_tree(n)
+        total = sum(leaf.size for leaf in flatten_leaves(tree))
+
+        start = time.perf_counter()
+        groups, report = partition_tree(tree, parts=args.parts)
+        count_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        budget_groups, budget = partition_tree(tree, max_part_bytes=total // args.parts)
+        budget_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        old, old_parts = imbalance(split_into_k_subtrees(tree, args.parts))
+        old_time = time.perf_counter() - start
+
+        print(f"{n:>9} leaves, {total / 1024 ** 3:.1f} GB")
+        print(f"    count : {report.parts:4d} parts, max/mean {report.imbalance:.3f}, "
+              f"{count_time:.2f} s ({count_time / n * 1e6:.2f} us/leaf)")
+        print(f"    budget: {budget.parts:4d} parts, max/mean {budget.imbalance:.3f}, "
+              f"max {budget.max / (total // args.parts):.3f} of budget, "
+              f"{budget_time:.2f} s ({budget_time / n * 1e6:.2f} us/leaf)")
+        print(f"    split_into_k_subtrees: {old_parts:4d} parts, max/mean {old:.3f}, {old_time:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
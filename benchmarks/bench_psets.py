@@ -0,0 +1,71 @@
+"""
+Property extraction for the viewer tree: ``PropsExtractor`` (relationships inverted once,
+each property set flattened once and shared) against the per-object ``extract_props`` path
+that calls ``get_psets`` for every object.
+
+Props are extracted for every object of the spatial and aggregation hierarchy, as
+``_build_tree`` does. Best of ``--repeat`` runs, the index build is timed separately.
+
+    python benchmarks/bench_psets.py [examples/AC-11-Smiley-West-04-07-2007.ifc] [-r 5]
+"""
+import argparse
+import time
+from pathlib import Path
+
+import ifcopenshell
+
+from ifcexport2.ifc_hierarchy import build_hierarchy
+from ifcexport2.ifc_psets import extract_props, PropsExtractor
+from ifcexport2.model_index import ModelIndex
+
+EXAMPLE = Path(__file__).parent.parent / "examples" / "AC-11-Smiley-West-04-07-2007.ifc"
+
+
+def per_object(ifc_file, ids, index):
+    return [extract_props(i, ifc_file) for i in ids]
+
+
+def bulk(ifc_file, ids, index):
+    extractor = PropsExtractor(ifc_file, index)
+    return [extractor.props(i) for i in ids]
+
+
+def bulk_views(ifc_file, ids, index):
+    extractor = PropsExtractor(ifc_file, index, views=True)
+    return [extractor.props(i) for i in ids]
+
+
+def timed(fn, repeat, *args):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("ifc", nargs="?", type=Path, default=EXAMPLE)
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    ifc_file = ifcopenshell.open(str(args.ifc))
+    index_time, index = timed(ModelIndex.build, args.repeat, ifc_file)
+    hierarchy = build_hierarchy(ifc_file, index=index)
+    ids = sorted(set(hierarchy.hierarchy) | {c for children in hierarchy.hierarchy.values() for c in children})
+
+    print(f"{args.ifc.name}: {len(ids)} objects, ModelIndex.build {index_time * 1e3:.2f} ms")
+    reference = None
+    for name, fn in (("per-object", per_object), ("bulk", bulk), ("bulk-views", bulk_views)):
+        total, result = timed(fn, args.repeat, ifc_file, ids, index)
+        # Same props, in the same key order
+        result = [dict(props) for props in result]
+        if reference is None:
+            reference = result
+        assert result == reference and all(list(a) == list(b) for a, b in zip(result, reference))
+        print(f"{name:>10}: {total * 1e3:8.2f} ms total, {total / len(ids) * 1e6:8.1f} us/object")
+
+
+if __name__ == "__main__":
+    main()
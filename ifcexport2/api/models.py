@@ -69,3 +69,6 @@ class Upload:
         default_factory=lambda: now(greenwich_tz).isoformat(), compare=False
     )
     detail: Optional[str] = None
+    # Bytes written so far and the sha256 of the complete file, see appv2.uploads
+    offset: int = 0
+    sha256: Optional[str] = None
@@ -6,11 +6,15 @@ import uuid
 import json
 
 import redis
-from starlette.concurrency import run_in_threadpool
 
 from ifcexport2.api.settings import BLOBS_PATH, UPLOADS_PATH, DEPLOYMENT_NAME
 from ifcexport2.settings import ifcopenshell_default_settings_dict
+from ifcexport2.viewer_buffers import BIN_SUFFIX
+from ifcexport2.blob_variants import best_variant
 from ifcexport2.api.redis_helpers import Hset,redis_client
+from ifcexport2.appv2.result_cache import ResultCache, conversion_key
+from ifcexport2.appv2.uploads import append_chunks, upload_offset, UploadConflict, MultipartFile, MultipartError, \
+    TUS_VERSION, OFFSET_CONTENT_TYPE
 # Initialize Redis (adjust host/port/db as needed)
 r = redis_client
 
@@ -20,13 +24,16 @@ from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import FileResponse
 
 import os
-import shutil
+import hashlib
+from email.utils import formatdate, parsedate_to_datetime
 from pathlib import Path
+from typing import Optional
+from urllib.parse import urlparse
 from ifcexport2.api.models import TaskStatus, ConversionTaskResult, ConversionTaskStatus, ConversionTaskInputs, Upload
 
 
 
-from fastapi import UploadFile, Request, BackgroundTasks, File, HTTPException
+from fastapi import UploadFile, Request, Response, Header, File, HTTPException
 
 import uuid
 
@@ -34,6 +41,7 @@ import time
 from dataclasses import asdict
 
 upload_statuses = Hset(DEPLOYMENT_NAME + "-uploads")
+result_cache = ResultCache(r)
 
 app = FastAPI(
     title="IFC Exchange API",
@@ -47,8 +55,22 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Read by resumable upload clients, see appv2.uploads
+    expose_headers=["Location", "Upload-Offset", "Upload-Length", "Tus-Resumable"],
 )
-app.add_middleware(GZipMiddleware, minimum_size=50)
+
+
+class BlobsBypassGZipMiddleware(GZipMiddleware):
+    """Blobs are served precompressed (see ``blobs_proxy``), they are never compressed on the fly."""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith("/blobs/"):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+app.add_middleware(BlobsBypassGZipMiddleware, minimum_size=50)
 
 # Global storages
 IFCS = dict()
@@ -58,88 +80,8 @@ OIFCS = dict()
 TASKS = {}
 
 
-async def background_upload_task(upload_id: str, file_path: str, spooled_path: str):
-    upload_data = upload_statuses[upload_id]
-    try:
-        # 2.1) Check if we need to resume
-        total_size = upload_statuses[upload_id].total_size
-        existing_offset = 0
-        if os.path.exists(file_path):
-            existing_offset = os.path.getsize(file_path)
-            # If final_path is bigger than total_size (or equals it),
-            # we might treat it as done or remove it and restart.
-            if existing_offset >= total_size > 0:
-                # We'll remove it for the example's sake:
-                os.remove(file_path)
-                existing_offset = 0
-
-        # 2.2) Open final file in append mode
-        with open(file_path, "ab") as out_f:
-            # 2.3) Move to "existing_offset" in the spooled file
-            with open(spooled_path, "rb") as in_f:
-                # skip existing_offset in the spooled file
-                in_f.seek(existing_offset)
-
-                bytes_written = existing_offset
-                chunk_size = 1024 * 1024  # 1MB
-
-                while True:
-                    chunk = in_f.read(chunk_size)
-                    if not chunk:
-                        break
-                    out_f.write(chunk)
-                    bytes_written += len(chunk)
-
-                    # update progress
-                    if total_size > 0:
-                        percent = round((bytes_written / total_size) * 100, 2)
-                    else:
-                        # if unknown total_size, treat as done or estimate
-                        percent = 100
-
-                    upload_data.progress = percent
-                    upload_statuses[upload_id] = upload_data
-
-        # done
-        upload_data.status = "success"
-        upload_statuses[upload_id] = upload_data
-    except Exception as exc:
-        upload_data.status = "error"
-        upload_data.detail = str(exc)
-        upload_statuses[upload_id] = upload_data
-    Path(spooled_path).unlink()
-
-
-def cpobj(spooled_path, file):
-    with open(spooled_path, "wb") as spool_file:
-        # You can do chunked copying if the file is large
-        shutil.copyfileobj(file.file, spool_file)
-
-
-@app.post("/upload", response_model=TaskStatus, response_model_exclude_none=True)
-async def upload_ifc_endpoint(
-        scene_id: int,
-        user_id: int,
-        request: Request,
-        background_tasks: BackgroundTasks,
-        file: UploadFile = File(...),
-):
-    if not file:
-        raise HTTPException(status_code=400, detail="No file uploaded")
-
-    # 3.1) Figure out total size if we can
-    total_size = request.headers.get("content-length")
-    try:
-        total_size = int(total_size) if total_size else 0
-    except ValueError:
-        total_size = 0
-
-    # 3.2) Generate an ID for this upload
+def _new_upload(scene_id: int, user_id: int, filename: str, total_size: int) -> Upload:
     upload_id = str(uuid.uuid4())
-
-    # 3.3) Decide final location
-    final_path = UPLOADS_PATH / f"{upload_id}{''.join(Path(file.filename).suffixes)}"
-
     upl = Upload(
         upload_id,
         status="pending",
@@ -147,31 +89,100 @@ async def upload_ifc_endpoint(
         scene_id=scene_id,
         user_id=user_id,
         total_size=total_size,
-        filename=file.filename,
-        file_path=final_path.__str__(),
+        filename=filename,
+        file_path=(UPLOADS_PATH / f"{upload_id}{''.join(Path(filename).suffixes)}").__str__(),
     )
     upload_statuses[upload_id] = upl
+    return upl
+
+
+# The body is parsed by the endpoint (MultipartFile), only documented here
+UPLOAD_REQUEST_BODY = {"requestBody": {"required": True, "content": {"multipart/form-data": {"schema": {
+    "type": "object", "required": ["file"], "properties": {"file": {"type": "string", "format": "binary"}}}}}}}
 
-    # 3.4) Spool the incoming upload to a temporary file
-    #      So we don't rely on 'file.file' in the background task
-    spooled_path = UPLOADS_PATH / f"spool_{upload_id}.tmp"
 
+@app.post("/upload", response_model=TaskStatus, response_model_exclude_none=True, openapi_extra=UPLOAD_REQUEST_BODY)
+async def upload_ifc_endpoint(
+        scene_id: int,
+        user_id: int,
+        request: Request,
+):
+    """
+    Upload a file in the ``file`` field of one multipart request. The body is parsed as it arrives
+    and the file goes to its final path in one pass, it is never spooled to a temporary file. An
+    interrupted request is not resumable, large files should use the ``/uploads`` protocol (see
+    ``appv2.uploads``).
+    """
     try:
-        await run_in_threadpool(cpobj, spooled_path, file)
-        # Copy the entire stream from 'UploadFile' into the spool file
+        form = MultipartFile(request)
+        filename = await form.start()
+    except MultipartError as ex:
+        raise HTTPException(status_code=400, detail=str(ex))
 
+    # Content-Length bounds the file size, for the progress until the body ends
+    upl = _new_upload(scene_id, user_id, filename, int(request.headers.get("content-length") or 0))
+    try:
+        await append_chunks(upl, form.chunks(), upload_statuses, final=True)
     except Exception as ex:
-        raise HTTPException(status_code=500, detail=f"Failed to spool file: {str(ex)}")
+        upl.status = "error"
+        upl.detail = str(ex)
+        upload_statuses[upl.id] = upl
+        raise HTTPException(status_code=500, detail=f"Failed to write file: {str(ex)}")
+    return TaskStatus(**{"id": upl.id, "status": upl.status})
 
-    # Initialize the status
 
-    # If we already have some progress, reflect that in the progress calculation
+def _tus_headers(upl: Upload) -> dict:
+    return {"Tus-Resumable": TUS_VERSION, "Upload-Offset": str(upload_offset(upl)),
+            "Upload-Length": str(upl.total_size), "Cache-Control": "no-store"}
 
-    # Schedule the background task to continue reading from the file
-    background_tasks.add_task(
-        background_upload_task, upload_id, final_path, spooled_path
-    )
-    return TaskStatus(**{"id": upload_id, "status": "success"})
+
+def _resumable_upload(upload_id: str) -> Upload:
+    upl = upload_statuses.get(upload_id)
+    if upl is None:
+        raise HTTPException(status_code=404, detail="Upload ID not found")
+    return upl
+
+
+@app.post("/uploads", status_code=201, response_model=TaskStatus, response_model_exclude_none=True)
+async def create_resumable_upload_endpoint(
+        scene_id: int,
+        user_id: int,
+        filename: str,
+        request: Request,
+        response: Response,
+        upload_length: int = Header(..., gt=0),
+):
+    """Create a resumable upload of ``Upload-Length`` bytes, the chunks are sent with PATCH to its ``Location``."""
+    upl = _new_upload(scene_id, user_id, filename, upload_length)
+    response.headers.update(_tus_headers(upl))
+    response.headers["Location"] = str(request.url_for("patch_resumable_upload_endpoint", upload_id=upl.id))
+    return TaskStatus(**{"id": upl.id, "status": upl.status})
+
+
+@app.head("/uploads/{upload_id}")
+async def head_resumable_upload_endpoint(upload_id: str):
+    """The offset to resume the upload from."""
+    return Response(status_code=200, headers=_tus_headers(_resumable_upload(upload_id)))
+
+
+@app.patch("/uploads/{upload_id}", status_code=204)
+async def patch_resumable_upload_endpoint(
+        upload_id: str,
+        request: Request,
+        upload_offset: int = Header(..., ge=0),
+        content_type: str = Header(...),
+):
+    """Append the request body at ``Upload-Offset``, the new offset is returned in ``Upload-Offset``."""
+    if content_type.split(";")[0].strip() != OFFSET_CONTENT_TYPE:
+        raise HTTPException(status_code=415, detail=f"Content-Type must be {OFFSET_CONTENT_TYPE}")
+    upl = _resumable_upload(upload_id)
+    if upl.status == "success":
+        raise HTTPException(status_code=409, detail="Upload is complete")
+    try:
+        await append_chunks(upl, request.stream(), upload_statuses, offset=upload_offset)
+    except UploadConflict as ex:
+        raise HTTPException(status_code=409, detail=str(ex), headers=_tus_headers(upl))
+    return Response(status_code=204, headers=_tus_headers(upl))
 
 
 @app.get(
@@ -215,6 +226,8 @@ async def convert_ifc_endpoint(upload_id: str, data: ConversionTaskInputs):
 
     if upl is None:
         raise HTTPException(status_code=404, detail="Upload ID not found")
+    if upl.status != "success":
+        raise HTTPException(status_code=409, detail="Upload is not complete")
     task_id = str(uuid.uuid4())
 
     data_dict=asdict(data)
@@ -229,6 +242,10 @@ async def convert_ifc_endpoint(upload_id: str, data: ConversionTaskInputs):
     prms['threads'] = threads
     prms['is_file_path']=True
 
+    # Uploads from before content hashes are not cached
+    sha256=getattr(upl,'sha256',None)
+    if sha256 is not None:
+        prms['cache_key']=conversion_key(sha256,prms)
 
     # Initialize the task status in Redis
 
@@ -247,6 +264,12 @@ async def convert_ifc_endpoint(upload_id: str, data: ConversionTaskInputs):
         "detail": ""
     }
            )
+    if 'cache_key' in prms:
+        existing=result_cache.claim(prms['cache_key'],task_id,usable=_task_usable)
+        if existing is not None:
+            # The same file with the same settings is converted or being converted by this task
+            r.delete(task_id)
+            return await get_result(existing)
 
     # Instead of publishing to a channel, we push the task_id to a list
     # The consumer(s) will BRPOP from this list
@@ -258,11 +281,68 @@ async def convert_ifc_endpoint(upload_id: str, data: ConversionTaskInputs):
     return ConversionTaskStatus(**{"id": task_id, "status": "pending"})
 
 
-@app.get("/blobs/{blob_id}")
-async def blobs_proxy(blob_id: str):
-    path = BLOBS_PATH / blob_id
-    if path.exists() and path.is_file():
-        return FileResponse(path)
+def _task_usable(task_id: str) -> bool:
+    """A cached task is pending or done with its blob in place, see appv2.result_cache."""
+    status = r.hget(task_id, "status")
+    if status is None or status.decode("utf-8") == "error":
+        return False
+    if status.decode("utf-8") == "pending":
+        return True
+    result = json.loads(r.hget(task_id, "result") or b"null")
+    return result is not None and (BLOBS_PATH / Path(urlparse(result["url"]).path).name).is_file()
+
+
+# Viewer JSON blobs and their geometry buffers (compat 'viewer-bin'), which the blobs
+# refer to by relative uri, e.g. /blobs/model-<task id>.json -> /blobs/model-<task id>.bin,
+# and the tiles next to them, e.g. /blobs/model-<task id>.tiles/model.tileset.json
+BLOB_MEDIA_TYPES = {".json": "application/json", BIN_SUFFIX: "application/octet-stream", ".glb": "model/gltf-binary"}
+# Clients revalidate with the ETag (304 if unchanged). Blobs of the worker are named by task and
+# not rewritten, but the volume may hold blobs named by upload (rewritten by every conversion of
+# it) or variants written later, so 'immutable' is for deployments that know their blobs are not.
+BLOB_CACHE_CONTROL = os.getenv("BLOB_CACHE_CONTROL", "no-cache")
+
+
+def _blob_validators(path: Path, encoding: Optional[str]) -> dict:
+    """Strong ETag (of the file served, so of the variant) and Last-Modified of a blob."""
+    stat = path.stat()
+    tag = hashlib.blake2b(f"{path.name}-{encoding}-{stat.st_size}-{stat.st_mtime_ns}".encode(), digest_size=16)
+    return {"ETag": f'"{tag.hexdigest()}"', "Last-Modified": formatdate(stat.st_mtime, usegmt=True)}
+
+
+def _not_modified(request: Request, validators: dict, mtime: float) -> bool:
+    """If-None-Match (weak comparison, as for GET and HEAD), or If-Modified-Since without it."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or validators["ETag"] in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+@app.api_route("/blobs/{blob_id:path}", methods=["GET", "HEAD"])
+async def blobs_proxy(blob_id: str, request: Request):
+    """
+    A blob, its buffers or tiles. The precompressed variant the client accepts best is served (see
+    blob_variants), 304 if the client has it (If-None-Match, If-Modified-Since), byte ranges of it
+    with Range (206, If-Range).
+    """
+    root = BLOBS_PATH.resolve()
+    path = (root / blob_id).resolve()
+    if root in path.parents and path.is_file():
+        variant, encoding = best_variant(path, request.headers.get("accept-encoding"))
+        headers = {"Vary": "Accept-Encoding", "Cache-Control": BLOB_CACHE_CONTROL,
+                   **_blob_validators(variant, encoding)}
+        if _not_modified(request, headers, variant.stat().st_mtime):
+            return Response(status_code=304, headers=headers)
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+        # Range and If-Range are handled by FileResponse, the ranges are of the variant served
+        return FileResponse(variant, media_type=BLOB_MEDIA_TYPES.get(path.suffix), headers=headers)
     else:
         raise HTTPException(status_code=404, detail=f"Blob {blob_id} is not found")
 
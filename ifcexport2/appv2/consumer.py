@@ -11,10 +11,12 @@ import gc
 
 from ifcexport2.api.settings import DEPLOYMENT_NAME,consumer_settings
 from ifcexport2.api.redis_helpers import redis_client
-from ifcexport2.appv2.task import ifc_export
+from ifcexport2.appv2.task import ifc_export, tessellation_cache_from_env
 from ifcexport2.appv2.consumer_stats import process_stats
+from ifcexport2.appv2.result_cache import ResultCache
 # Initialize Redis
 r = redis_client
+result_cache = ResultCache(r)
 
 # Create a pubsub instance and subscribe to "tasks"
 
@@ -141,7 +143,7 @@ if __name__ =='__main__':
         try:
                 update_consumer_info('work', current_task=task_id)
 
-                result =   json.dumps(ifc_export(task_data))
+                result =   json.dumps(ifc_export(task_data,cache=tessellation_cache_from_env(),task_id=task_id))
 
                 # Update the Redis hash with success
                 r.hset(task_id, mapping={
@@ -151,6 +153,9 @@ if __name__ =='__main__':
                     "detail": ""
 
                 })
+                if task_data.get('cache_key'):
+                    # Identical conversions get this result from now on, see result_cache
+                    result_cache.complete(task_data['cache_key'], task_id)
                 gc.collect()
                 update_consumer_info('idle')
                 print(f"Task {task_id} completed successfully.")
@@ -202,6 +207,8 @@ if __name__ =='__main__':
                     "attempts":attempts+1
                 })
 
+                if task_data.get('cache_key'):
+                    result_cache.release(task_data['cache_key'], task_id)
                 print(f"Task {task_id} failed with error: {err}")
                 update_consumer_info('idle')
                 gc.collect()
@@ -6,7 +6,7 @@ if __name__ =='__main__':
     import json
 
     from ifcexport2.api.redis_helpers import redis_client
-    from ifcexport2.appv2.task import ifc_export
+    from ifcexport2.appv2.task import ifc_export, tessellation_cache_from_env
 
     # Initialize Redis
     r = redis_client
@@ -38,7 +38,7 @@ if __name__ =='__main__':
         try:
             metric_manager.update_app_context({'status':'work', 'task_id':task_id})
 
-            result =   json.dumps(ifc_export(task_data,metric_manager=metric_manager))
+            result =   json.dumps(ifc_export(task_data,metric_manager=metric_manager,cache=tessellation_cache_from_env()))
 
             # Update the Redis hash with success
             r.hset(task_id, mapping={
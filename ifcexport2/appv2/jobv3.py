@@ -70,7 +70,7 @@ if __name__ =='__main__':
     import json
     
 
-    from ifcexport2.appv2.task import ifc_export, ResultData, TaskData
+    from ifcexport2.appv2.task import ifc_export, ResultData, TaskData, tessellation_cache_from_env
     
     redis_client=redis_conn = Redis(host=REDIS_HOST,
                        port=REDIS_PORT,
@@ -132,7 +132,7 @@ if __name__ =='__main__':
     try:
         #metric_manager.update_app_context({'status':'work', 'task_id':task_id})
         from ifcexport2.settings import settings
-        result=  ifc_export(task_item,volume_path=VOLUME_PATH,blobs_prefix='blobs',threads=NUM_THREADS,settings=settings,metric_manager=None)
+        result=  ifc_export(task_item,volume_path=VOLUME_PATH,blobs_prefix='blobs',threads=NUM_THREADS,settings=settings,metric_manager=None,cache=tessellation_cache_from_env(),task_id=task_id.decode())
         
         task_item['result']=result
         task_item['status']='success'
@@ -0,0 +1,107 @@
+"""
+Conversion results by content: the same upload converted with the same task data is not converted again.
+
+The key of a conversion is the sha256 of the uploaded file (``Upload.sha256``), the task data that
+changes the result (settings, excluded types, target units, extras, ... everything but the
+per-request fields) and the ifcexport2 and ifcopenshell versions. Redis maps the key to the task
+computing or holding the result:
+
+- a new key is claimed with ``SET NX`` for ``IN_FLIGHT_TTL`` seconds, the task is enqueued;
+- identical requests meanwhile get the id of that task, so they attach to it instead of
+  converting the same file again;
+- when the task succeeds the key lives ``RESULT_CACHE_TTL`` seconds, requests get its result at
+  once. A failed task or a result whose blob is gone releases the key.
+
+>>> key = conversion_key(upload.sha256, task_data)
+>>> existing = ResultCache().claim(key, task_id, usable=lambda task_id: ...)
+"""
+from __future__ import annotations
+
+import hashlib
+import importlib.metadata
+import json
+import os
+from typing import Callable, Optional
+
+import ifcopenshell
+import redis
+
+from ifcexport2.api.settings import DEPLOYMENT_NAME, redis_client
+
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", str(7 * 24 * 3600)))
+# A task nobody completes (its consumer died) releases its key after this
+IN_FLIGHT_TTL = int(os.getenv("RESULT_CACHE_IN_FLIGHT_TTL", str(3600)))
+KEY_PREFIX = f"{DEPLOYMENT_NAME}-results:"
+# Task data that does not change the result
+PER_REQUEST_FIELDS = ("fp", "upload_id", "name", "fname", "threads", "is_file_path", "cache_key")
+
+
+def package_version() -> Optional[str]:
+    try:
+        return importlib.metadata.version("ifcexport2")
+    except importlib.metadata.PackageNotFoundError:
+        # A source tree
+        return None
+
+
+def conversion_key(sha256: str, data: dict) -> str:
+    """Key of the conversion of a file with content hash ``sha256`` with the task ``data``."""
+    payload = json.dumps({"content": sha256,
+                          "data": {k: v for k, v in data.items() if k not in PER_REQUEST_FIELDS},
+                          "ifcexport2": package_version(),
+                          "ifcopenshell": ifcopenshell.version},
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResultCache:
+    """Conversion key -> task id in Redis, see the module."""
+
+    def __init__(self, client: redis.Redis = redis_client, prefix: str = KEY_PREFIX,
+                 ttl: int = RESULT_CACHE_TTL, in_flight_ttl: int = IN_FLIGHT_TTL):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.in_flight_ttl = in_flight_ttl
+
+    def claim(self, key: str, task_id: str, usable: Callable[[str], bool] = lambda task_id: True) -> Optional[str]:
+        """
+        Make ``task_id`` the task of ``key``, None if it is. Otherwise returns the task already
+        holding the key, if ``usable(task_id)`` (pending, or done with its result in place), or
+        takes the key over from an unusable one.
+        """
+        name = self.prefix + key
+        while True:
+            if self.client.set(name, task_id, nx=True, ex=self.in_flight_ttl):
+                return None
+            existing = self.client.get(name)
+            if existing is None:
+                # Expired in between
+                continue
+            existing = existing.decode()
+            if usable(existing):
+                return existing
+            self.release(key, existing)
+
+    def _if_owner(self, key: str, task_id: str, action: Callable[[redis.client.Pipeline, str], None]) -> bool:
+        name = self.prefix + key
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(name)
+                if pipe.get(name) != task_id.encode():
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                action(pipe, name)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    def complete(self, key: str, task_id: str) -> bool:
+        """Keep the result of ``task_id`` for ``ttl`` seconds, if it still holds ``key``."""
+        return self._if_owner(key, task_id, lambda pipe, name: pipe.expire(name, self.ttl))
+
+    def release(self, key: str, task_id: str) -> bool:
+        """Release ``key`` if ``task_id`` holds it (failed tasks, missing blobs)."""
+        return self._if_owner(key, task_id, lambda pipe, name: pipe.delete(name))
@@ -1,3 +1,4 @@
+import contextlib
 import dataclasses
 import gc
 import os
@@ -9,7 +10,17 @@ import ujson
 import multiprocessing as mp
 from ifcexport2.cxm.metric_manager import MetricManager
 from ifcexport2.ifc_to_mesh import safe_call_fast_convert, create_viewer_object, settings_dict, ConvertArguments, \
-        convert
+        convert, convert_stream, write_viewer_object, effective_settings
+from ifcexport2.incremental import ConversionManifest, PreviousConversion, convert_incremental, MANIFEST_SUFFIX
+from ifcexport2.tess_cache import TessellationCache
+from ifcexport2.robust import RobustPolicy
+from ifcexport2.compat import IfcExportCompat
+from ifcexport2.gltf import write_glb
+from ifcexport2.batching import batch_viewer_json
+from ifcexport2.lod import lod_stream, LodPolicy
+from ifcexport2.tiling import write_tiles
+from ifcexport2.viewer_buffers import GeometryBuffer, EmbeddedBuffer, BIN_SUFFIX
+from ifcexport2.blob_variants import write_variants, available_encodings
 from pathlib import Path
 
 VOLUME_PATH=Path(os.getenv("VOLUME_PATH", "./vol")).absolute()
@@ -24,22 +35,84 @@ BLOBS_PATH=Path(os.getenv("BLOBS_PATH", VOLUME_PATH/"blobs")).absolute()
 if not BLOBS_PATH.exists():
     BLOBS_PATH.mkdir(parents=True,exist_ok=False)
 
+TESSELLATION_CACHE_PATH=Path(os.getenv("TESSELLATION_CACHE_PATH", VOLUME_PATH/"tess-cache")).absolute()
+# Size limit of the tessellation cache in bytes, 0 disables the cache.
+TESSELLATION_CACHE_SIZE=int(os.getenv("TESSELLATION_CACHE_SIZE", str(10*1024**3)))
+# Retry the products the geometry iterator fails on in isolated processes, see ifcexport2.robust
+ROBUST_CONVERSION=bool(int(os.getenv("ROBUST_CONVERSION", "0")))
+RETRY_TIMEOUT=float(os.getenv("RETRY_TIMEOUT", "60"))
+# Precompressed variants written next to the blobs (comma separated, empty for none), see ifcexport2.blob_variants
+BLOB_ENCODINGS=[e for e in os.getenv("BLOB_ENCODINGS", ",".join(available_encodings())).split(",") if e in available_encodings()]
+
+
+def tessellation_cache_from_env()->Optional[TessellationCache]:
+    if TESSELLATION_CACHE_SIZE<=0:
+        return None
+    return TessellationCache(TESSELLATION_CACHE_PATH,max_bytes=TESSELLATION_CACHE_SIZE)
+
 @dataclasses.dataclass
 class IfcExportExtras:
     excluded_types: list[str]= dataclasses.field(default_factory=lambda :list(('IfcSpace',)))
     target_units:Optional[str]=None
+    instancing: bool = False
+    # Blob name of a previous conversion of the same model, enables incremental conversion
+    previous_blob:Optional[str]=None
+    # Product filters, see ConvertArguments
+    included_types:Optional[list[str]]=None
+    global_ids:Optional[list[str]]=None
+    containers:Optional[list[str]]=None
+    contexts:Optional[list[str]]=None
+    # IfcExportCompat value, 'viewer-bin' stores the geometry in a <blob>.bin buffer
+    compat:str=IfcExportCompat.viewer.value
+    # With 'viewer-bin', store the geometry as base64 data in the blob instead
+    embed_buffers:bool=False
+    # With 'glb', compress the primitives with Draco
+    draco:bool=False
+    # Quantize the geometry attributes (viewer layouts), see ifcexport2.quantize
+    quantize:bool=False
+    # Geometry groups and palette materials instead of vertex colours, see mesh_to_three
+    material_groups:bool=False
+    # Merge small meshes into batches with an objectId attribute, see ifcexport2.batching
+    batch:bool=False
+    # Simplified levels of detail of heavy meshes (viewer layouts), see ifcexport2.lod
+    lod:bool=False
+    # Coarser tessellation of small products and MEP categories, see ifcexport2.deflection
+    adaptive_deflection:bool=False
+    # Also write spatial tiles of at most tile_size bytes and a tileset manifest, see ifcexport2.tiling
+    tile_size:Optional[int]=None
     
 
 
 class IfcExportExtrasData(TypedDict):
     excluded_types: Optional[list[str]]
     target_units:Optional[str]
+    instancing: Optional[bool]
+    previous_blob: Optional[str]
+    included_types: Optional[list[str]]
+    global_ids: Optional[list[str]]
+    containers: Optional[list[str]]
+    contexts: Optional[list[str]]
+    compat: Optional[str]
+    embed_buffers: Optional[bool]
+    draco: Optional[bool]
+    quantize: Optional[bool]
+    material_groups: Optional[bool]
+    batch: Optional[bool]
+    lod: Optional[bool]
+    adaptive_deflection: Optional[bool]
+    tile_size: Optional[int]
 
 
 class ResultData(TypedDict):
     url: str
     name: str
     extras: dict
+    # Products that failed all attempts, see models.ProductFail
+    fails: list[dict]
+    # Urls of the geometry buffers the blob refers to (compat 'viewer-bin')
+    buffers: list[str]
+    # Url of the tileset manifest (extras 'tile_size'), the tiles are next to it
+    tileset: Optional[str]
 
 
 class TaskData(TypedDict):
@@ -55,7 +128,7 @@ class TaskData(TypedDict):
   
 
 
-def ifc_export(data:TaskData,*,volume_path='./vol',blobs_prefix:str='blobs',metric_manager: Optional[MetricManager]=None, threads=None, settings:dict[str,Any]=None)->ResultData:
+def ifc_export(data:TaskData,*,volume_path='./vol',blobs_prefix:str='blobs',metric_manager: Optional[MetricManager]=None, threads=None, settings:dict[str,Any]=None, cache:Optional[TessellationCache]=None, task_id:Optional[str]=None)->ResultData:
         dt = data
         #if data.get('is_file_path',False):
         #    with open(data['fp'],'rb' ) as f:
@@ -70,6 +143,12 @@ def ifc_export(data:TaskData,*,volume_path='./vol',blobs_prefix:str='blobs',metr
         extras:IfcExportExtrasData=IfcExportExtrasData(**dt.get('extras',{}))
         excluded_types=extras.get('excluded_types',[])
         target_units=extras.get('target_units',None)
+        instancing=bool(extras.get('instancing',False))
+        previous_blob=extras.get('previous_blob',None)
+        compat=IfcExportCompat(extras.get('compat',None) or IfcExportCompat.viewer)
+        if compat==IfcExportCompat.glb:
+            # The manifest refers to the geometry entries of a viewer JSON
+            previous_blob=None
         if volume_path is not None:
             fp=(Path(volume_path)/ dt["fp"]   ).absolute().__str__()
         else:
@@ -79,47 +158,122 @@ def ifc_export(data:TaskData,*,volume_path='./vol',blobs_prefix:str='blobs',metr
         ifc_file=ifcopenshell.open( fp)
 
         print(f'success')
-        result=convert( ifc_file,
-                ConvertArguments(
+        args=ConvertArguments(
                     excluded_types=excluded_types,
                     target_units=target_units,
-                    name=name
-                ),
-                        settings=settings,
-                        threads=threads,
-                        verbose=True
-                        )
-        blob_path=Path(volume_path)/blobs_prefix/f'{name}-{upload_id}.json'
+                    name=name,
+                    instancing=instancing,
+                    included_types=extras.get('included_types',None),
+                    global_ids=extras.get('global_ids',None),
+                    containers=extras.get('containers',None),
+                    contexts=extras.get('contexts',None),
+                    adaptive_deflection=bool(extras.get('adaptive_deflection',False)),
+                )
+        robust=RobustPolicy(timeout=RETRY_TIMEOUT) if ROBUST_CONVERSION else None
+        previous=None
+        if previous_blob is not None:
+            blobs_root=(Path(volume_path)/blobs_prefix).resolve()
+            previous_path=(blobs_root/previous_blob).resolve()
+            # A blob name from the request, it must not lead out of the blobs directory
+            if blobs_root not in previous_path.parents:
+                raise ValueError(f'previous_blob {previous_blob!r} is not a blob')
+            if Path(f'{previous_path}{MANIFEST_SUFFIX}').exists():
+                previous=PreviousConversion.load(previous_path)
+            else:
+                print(f'No manifest for {previous_path}, converting from scratch.')
+        if previous is not None:
+            stream=convert_incremental(ifc_file,args,previous,settings=settings,threads=threads,verbose=True,cache=cache,robust=robust)
+            reused,manifest=stream.reused,stream.manifest
+        else:
+            stream=convert_stream( ifc_file,
+                    args,
+                            settings=settings,
+                            threads=threads,
+                            verbose=True,
+                            cache=cache,
+                            robust=robust
+                            )
+            reused,manifest=(),ConversionManifest.for_file(ifc_file,effective_settings(args,settings),args=args)
+        # One blob per conversion: conversions of the same upload with other settings must not
+        # rewrite the blob of another (served from the result cache, cached by clients)
+        blob_path=Path(volume_path)/blobs_prefix/f'{name}-{task_id or upload_id}.{"glb" if compat==IfcExportCompat.glb else "json"}'
         
         blob_url_path=blob_path.absolute().relative_to(
             Path(volume_path).absolute()
         )
-        f'{BUCKET_PREFIX}/{blob_url_path.__str__()}'
-        print('convert success')
-        root = create_viewer_object(name, result.objects, ifc_file,include_spatial_hierarchy=False)
-        ud=root['object'].get('userData',{})
-        props=ud.get('properties',{})
-        props['units']=result.info.units.symbol
-       
-        ud['properties']=props
-        root['object']['userData']=ud
-        
         
         key= f'{BUCKET_PREFIX}/{blob_url_path.__str__()}'
-        with open(blob_path,mode="w",encoding='utf-8') as f:
-            ujson.dump(root,f, ensure_ascii=False)
+        buffer=None
+        buffer_urls=[]
+        tileset_url=None
+        bin_file=None
+        if compat==IfcExportCompat.viewer_buffers:
+            if extras.get('embed_buffers',False):
+                buffer=EmbeddedBuffer()
+            else:
+                # Served by /blobs next to the blob, the uri is relative to the blob url
+                bin_path=blob_path.with_suffix(BIN_SUFFIX)
+                bin_file=open(bin_path,mode="wb")
+                buffer=GeometryBuffer(bin_file,bin_path.name)
+                buffer_urls.append(f'{BUCKET_PREFIX}/{bin_path.absolute().relative_to(Path(volume_path).absolute())}')
+        # Geometries are written as they are tessellated, so the whole model is never
+        # held in memory as IRGeometryObjects or three.js dicts at once.
+        if compat==IfcExportCompat.glb:
+            with open(blob_path,mode="wb") as f:
+                write_glb(f,
+                          name,
+                          stream.objects,
+                          ifc_file,
+                          include_spatial_hierarchy=False,
+                          props={'name':name,'units':stream.info.units.symbol},
+                          index=stream.index,
+                          draco=bool(extras.get('draco',False)))
+        else:
+            objects=stream.objects
+            if extras.get('lod',False):
+                objects=lod_stream(objects,LodPolicy())
+            with open(blob_path,mode="w",encoding='utf-8') as f, (bin_file or contextlib.nullcontext()):
+                write_viewer_object(f,
+                                    name,
+                                    objects,
+                                    ifc_file,
+                                    include_spatial_hierarchy=False,
+                                    props={'name':name,'units':stream.info.units.symbol},
+                                    reused=reused,
+                                    manifest=manifest,
+                                    index=stream.index,
+                                    buffer=buffer,
+                                    reused_buffers=getattr(stream,'reused_buffers',()),
+                                    quantize=bool(extras.get('quantize',False)),
+                                    material_groups=bool(extras.get('material_groups',False)))
+            if extras.get('batch',False):
+                # Batches do not keep the geometry entries of the products, the next revision is converted from scratch
+                batch_viewer_json(blob_path)
+            else:
+                # Lets the next revision of this model be converted incrementally against this blob
+                manifest.dump(f'{blob_path}{MANIFEST_SUFFIX}')
+            if extras.get('tile_size',None):
+                # <blob>.tiles/<name>.tileset.json, the tile uris are relative to it
+                tile_paths=write_tiles(blob_path,blob_path.with_suffix('.tiles'),name,max_tile_bytes=int(extras['tile_size']),
+                                       quantize=bool(extras.get('quantize',False)))
+                tileset_url=f'{BUCKET_PREFIX}/{tile_paths[-1].absolute().relative_to(Path(volume_path).absolute())}'
+        # Served by /blobs as they are instead of compressing every response
+        for path in (blob_path, blob_path.with_suffix(BIN_SUFFIX)):
+            if BLOB_ENCODINGS and path.is_file():
+                write_variants(path, BLOB_ENCODINGS)
+        fails=[asdict(fl) for fl in stream.fails if not fl.recovered]
+        print(f'convert success, {len(fails)} failed products')
 
       
         del dt
         del data
-        del root
         del ifc_file
-        del result
+        del stream
         gc.collect()
         
 
 
-        return {'url':key,'name': name, 'extras':extras}
+        return {'url':key,'name': name, 'extras':extras, 'fails':fails, 'buffers':buffer_urls, 'tileset':tileset_url}
 
 
 
@@ -0,0 +1,231 @@
+"""
+Streaming, resumable uploads.
+
+Request chunks are written straight to the final path of the upload with async file I/O and
+hashed (sha256) on the fly, nothing is spooled or copied afterwards. Resumable uploads follow
+the core of the tus protocol (https://tus.io/protocols/resumable-upload):
+
+- ``POST /uploads`` with an ``Upload-Length`` header creates an upload, its url is in ``Location``;
+- ``HEAD /uploads/{id}`` returns ``Upload-Offset``, the number of bytes on disk;
+- ``PATCH /uploads/{id}`` with ``Upload-Offset`` appends the body (``application/offset+octet-stream``)
+  at that offset, 409 if it is not the current one. The upload is complete at ``Upload-Length``.
+
+An interrupted PATCH keeps what it wrote, the client asks HEAD for the offset and sends the rest.
+Progress goes to the upload status at most every ``PROGRESS_INTERVAL`` seconds.
+
+Single request ``multipart/form-data`` uploads are parsed as the body arrives (``MultipartFile``),
+the file field is written the same way instead of being spooled to a temporary file first.
+
+>>> offset = await append_chunks(upload, request.stream(), upload_statuses)
+>>> form = MultipartFile(request)
+>>> filename = await form.start()
+>>> offset = await append_chunks(upload, form.chunks(), upload_statuses, final=True)
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import time
+from typing import AsyncIterator, Optional
+
+import aiofiles
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+
+from ifcexport2.api.models import Upload
+
+TUS_VERSION = "1.0.0"
+OFFSET_CONTENT_TYPE = "application/offset+octet-stream"
+CHUNK_SIZE = 1 << 20
+PROGRESS_INTERVAL = 0.5
+
+# Upload id -> (offset, sha256 of the bytes before it) of the uploads written by this process,
+# the state is rebuilt from the file if the upload went on elsewhere
+_hashers: dict[str, tuple[int, "hashlib._Hash"]] = {}
+# Uploads being written by this process
+_active: set[str] = set()
+
+
+class UploadConflict(Exception):
+    """The upload is written by another request or the offset is not the current one."""
+
+
+class MultipartError(ValueError):
+    """The body is not ``multipart/form-data`` or has no file field."""
+
+
+def upload_offset(upload: Upload) -> int:
+    """Bytes of the upload on disk."""
+    try:
+        return os.path.getsize(upload.file_path)
+    except FileNotFoundError:
+        return 0
+
+
+async def _hasher(upload: Upload, offset: int):
+    state = _hashers.pop(upload.id, None)
+    if state is not None and state[0] == offset:
+        return state[1]
+    hasher = hashlib.sha256()
+    if offset:
+        async with aiofiles.open(upload.file_path, "rb") as f:
+            while chunk := await f.read(min(CHUNK_SIZE, offset)):
+                hasher.update(chunk)
+                offset -= len(chunk)
+    return hasher
+
+
+class _Progress:
+    """Throttled writes of the upload status."""
+    __slots__ = ("upload", "statuses", "last")
+
+    def __init__(self, upload: Upload, statuses):
+        self.upload = upload
+        self.statuses = statuses
+        self.last = time.monotonic()
+
+    def update(self, offset: int, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self.last < PROGRESS_INTERVAL:
+            return
+        self.last = now
+        self.upload.offset = offset
+        self.upload.progress = round(offset / self.upload.total_size * 100, 2) if self.upload.total_size > 0 else 0.0
+        self.statuses[self.upload.id] = self.upload
+
+
+async def append_chunks(upload: Upload, chunks: AsyncIterator[bytes], statuses, offset: Optional[int] = None,
+                        final: bool = False) -> int:
+    """
+    Append ``chunks`` to the file of ``upload`` and record the progress in ``statuses``
+    (``upload_statuses``). ``offset`` is the offset the client sent, ``UploadConflict`` if it
+    is not the current one. The upload is complete at ``upload.total_size`` bytes, or at the end of
+    the chunks if ``final`` (``total_size`` is set then). Returns the new offset.
+    """
+    if upload.id in _active:
+        raise UploadConflict("The upload is being written by another request")
+    _active.add(upload.id)
+    try:
+        current = upload_offset(upload)
+        if offset is not None and offset != current:
+            raise UploadConflict(f"Upload-Offset {offset} does not match the current offset {current}")
+        hasher = await _hasher(upload, current)
+        progress = _Progress(upload, statuses)
+        offset = current
+        try:
+            async with aiofiles.open(upload.file_path, "ab") as f:
+                async for chunk in chunks:
+                    if upload.total_size > 0 and not final and offset + len(chunk) > upload.total_size:
+                        raise UploadConflict(f"The body exceeds Upload-Length {upload.total_size}")
+                    await f.write(chunk)
+                    hasher.update(chunk)
+                    offset += len(chunk)
+                    progress.update(offset)
+            if final:
+                upload.total_size = offset
+        finally:
+            # Also for interrupted requests, the written bytes stay and the next PATCH goes on from them
+            _hashers[upload.id] = (offset, hasher)
+            if offset == upload.total_size:
+                upload.status = "success"
+                upload.sha256 = hasher.hexdigest()
+                del _hashers[upload.id]
+            progress.update(offset, force=True)
+        return offset
+    finally:
+        _active.discard(upload.id)
+
+
+class MultipartFile:
+    """
+    The ``field`` file of a ``multipart/form-data`` request, parsed from ``request.stream()`` as it
+    arrives. ``start`` reads the body up to the headers of the file and returns its filename,
+    ``chunks`` yields its content. The other fields are skipped.
+    """
+
+    def __init__(self, request, field: str = "file"):
+        content_type, params = parse_options_header(request.headers.get("content-type", ""))
+        if content_type != b"multipart/form-data" or b"boundary" not in params:
+            raise MultipartError("Content-Type must be multipart/form-data")
+        self.field = field.encode()
+        self.filename: Optional[str] = None
+        self._stream = request.stream().__aiter__()
+        self._ended = False
+        self._chunks: list[bytes] = []
+        self._header_field = b""
+        self._header_value = b""
+        self._disposition: Optional[bytes] = None
+        self._in_file = False
+        self._file_done = False
+        self._parser = MultipartParser(params[b"boundary"], {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        })
+
+    def _on_part_begin(self):
+        self._disposition = None
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        if self._header_field.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_field = self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._disposition or b"")
+        if self.filename is None and options.get(b"name") == self.field and b"filename" in options:
+            self.filename = options[b"filename"].decode("utf-8", "replace")
+            self._in_file = True
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._in_file:
+            self._chunks.append(data[start:end])
+
+    def _on_part_end(self):
+        if self._in_file:
+            self._in_file = False
+            self._file_done = True
+
+    async def _feed(self) -> bool:
+        """Parse the next chunk of the body, False at its end."""
+        try:
+            chunk = await self._stream.__anext__()
+        except StopAsyncIteration:
+            self._parser.finalize()
+            self._ended = True
+            return False
+        if chunk:
+            self._parser.write(chunk)
+        return True
+
+    async def start(self) -> str:
+        """Read the body up to the file field, returns its filename."""
+        while self.filename is None:
+            if not await self._feed():
+                raise MultipartError(f"No {self.field.decode()!r} file field in the body")
+        return self.filename
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        """Content of the file field, ``start`` must have returned."""
+        while True:
+            chunks, self._chunks = self._chunks, []
+            for chunk in chunks:
+                yield chunk
+            if self._file_done:
+                return
+            if self._ended:
+                raise MultipartError("The body ended within the file field")
+            await self._feed()
@@ -0,0 +1,199 @@
+"""
+Draw-call batching of the viewer JSON.
+
+Small meshes sharing a material under the same group (storey, space or any other container of
+the hierarchy) are merged into batch meshes. Every vertex of a batch gets an ``objectId``
+attribute, the index of its source object in the batch's ``userData.objects`` side table, which
+holds the ``userData.properties`` of the source objects (``userData.uuids`` their uuids), so
+picking and property lookup still work::
+
+    {"type": "Mesh", "name": "Level 1 batch 0", "material": "...",
+     "userData": {"properties": {"name": "Level 1 batch 0", "batch": true},
+                  "objects": [{"id": 123, "name": "Fastener", ...}, ...], "uuids": [...]}}
+
+Objects with material groups are split by group, each part goes to the batch of its material.
+Batch positions are float32 relative to the centre of the batch, which goes to its matrix.
+
+>>> root = batch_viewer_object(create_viewer_object('model', objects, ifc_file))
+>>> batch_viewer_json('model.viewer.json', 'model-batched.viewer.json')
+"""
+from __future__ import annotations
+
+import contextlib
+import os
+import uuid
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+import ujson
+
+from ifcexport2.mesh_to_three import _mesh_object
+from ifcexport2.viewer_buffers import Buffer, GeometryBuffer, BIN_SUFFIX, attribute, attribute_array, \
+    encode_geometry, load_buffers, float_attribute
+
+# Objects with more vertices are left as they are
+MAX_OBJECT_VERTICES = 4096
+MAX_BATCH_VERTICES = 1 << 20
+IDENTITY = [1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1]
+
+
+class _Piece:
+    """Faces of one object going to one batch, in the coordinates of the object's parent."""
+    __slots__ = ("obj", "position", "faces", "colors")
+
+    def __init__(self, obj, position, faces, colors):
+        self.obj = obj
+        self.position = position
+        self.faces = faces
+        self.colors = colors
+
+
+def _pieces(obj: dict, geom: dict, buffers: list):
+    """(material uuid, piece) for each material of a mesh object."""
+    attrs = geom["data"]["attributes"]
+    position = float_attribute(attrs["position"], buffers)
+    matrix = np.array(obj.get("matrix", IDENTITY), dtype=np.float64).reshape((4, 4), order="F")
+    position = position @ matrix[:3, :3].T + matrix[:3, 3]
+    colors = float_attribute(attrs["color"], buffers) if "color" in attrs else None
+    if "index" in geom["data"]:
+        faces = attribute_array(geom["data"]["index"], buffers).astype(np.int64)
+    else:
+        faces = np.arange(len(position), dtype=np.int64)
+    materials = obj["material"]
+    if not isinstance(materials, list):
+        yield materials, _Piece(obj, position, faces, colors)
+        return
+    for group in geom["data"].get("groups", ()):
+        group_faces = faces[group["start"]:group["start"] + group["count"]]
+        # Only the vertices used by the group
+        used, group_faces = np.unique(group_faces, return_inverse=True)
+        yield materials[group["materialIndex"]], _Piece(obj, position[used], group_faces.reshape(-1),
+                                                       None if colors is None else colors[used])
+
+
+def _batch_mesh(pieces: list[_Piece], material: str, name: str, buffer: Optional[Buffer]) -> tuple[dict, dict]:
+    position = np.concatenate([p.position for p in pieces])
+    center = (position.min(axis=0) + position.max(axis=0)) / 2
+    offsets = np.cumsum([0] + [len(p.position) for p in pieces])
+    faces = np.concatenate([p.faces + offset for p, offset in zip(pieces, offsets)])
+    object_ids = np.repeat(np.arange(len(pieces), dtype=np.float32), np.diff(offsets))
+
+    geometry_uuid = str(uuid.uuid4())
+    data = {
+        "attributes": {
+            "position": attribute((position - center).astype(np.float32), 3, "Float32Array", buffer),
+            "objectId": attribute(object_ids, 1, "Float32Array", buffer),
+        },
+        "index": attribute(faces, 1, "Uint16Array" if len(position) <= 0xFFFF else "Uint32Array", buffer),
+    }
+    if pieces[0].colors is not None:
+        data["attributes"]["color"] = attribute(np.concatenate([p.colors for p in pieces]).astype(np.float32),
+                                                pieces[0].colors.shape[-1], "Float32Array", buffer)
+    geom = {"uuid": geometry_uuid, "type": "BufferGeometry", "data": data}
+
+    matrix = np.eye(4)
+    matrix[:3, 3] = center
+    obj = _mesh_object(geometry_uuid, {"uuid": material}, {"name": name, "batch": True}, name, matrix)
+    obj["userData"]["objects"] = [p.obj.get("userData", {}).get("properties", {}) for p in pieces]
+    obj["userData"]["uuids"] = [p.obj["uuid"] for p in pieces]
+    return obj, geom
+
+
+def batch_viewer_object(root: dict, buffers: list = (), buffer: Optional[Buffer] = None,
+                        max_object_vertices: int = MAX_OBJECT_VERTICES,
+                        max_batch_vertices: int = MAX_BATCH_VERTICES) -> dict:
+    """
+    Batched copy of a three.js root (``create_viewer_object`` output or a loaded viewer JSON).
+
+    Mesh objects with at most ``max_object_vertices`` vertices are merged per parent group and
+    material into batches of up to ``max_batch_vertices`` vertices. ``buffers`` are the loaded
+    buffers of ``root`` (``viewer_buffers.load_buffers``), the geometries of the result are stored
+    in ``buffer`` (as ``array`` lists if None).
+    """
+    geometries = {g["uuid"]: g for g in root["geometries"]}
+    new_geometries = []
+    used_geometries = set()
+
+    def vertices_count(geom):
+        attr = geom["data"]["attributes"]["position"]
+        return len(attribute_array(attr, buffers)) // attr["itemSize"]
+
+    def batch_group(group: dict) -> dict:
+        children = []
+        # (material, has colours) -> pieces
+        batches: dict[tuple, list[_Piece]] = {}
+        sizes: dict[tuple, int] = {}
+        name = group.get("name", "Group")
+        count = 0
+
+        def flush(key):
+            nonlocal count
+            obj, geom = _batch_mesh(batches.pop(key), key[0], f"{name} batch {count}", buffer)
+            count += 1
+            sizes.pop(key)
+            new_geometries.append(geom)
+            children.append(obj)
+
+        for child in group.get("children", ()):
+            if child.get("type") == "LOD":
+                # Levels of detail are kept as they are, see lod
+                children.append(child)
+                used_geometries.update(level.get("geometry") for level in child["children"])
+                continue
+            if "children" in child:
+                children.append(batch_group(child))
+                continue
+            geom = geometries.get(child.get("geometry"))
+            if geom is None or child.get("type") != "Mesh" or vertices_count(geom) > max_object_vertices:
+                children.append(child)
+                used_geometries.add(child.get("geometry"))
+                continue
+            for material, piece in _pieces(child, geom, buffers):
+                key = (material, piece.colors is not None)
+                if sizes.get(key, 0) + len(piece.position) > max_batch_vertices and key in batches:
+                    flush(key)
+                batches.setdefault(key, []).append(piece)
+                sizes[key] = sizes.get(key, 0) + len(piece.position)
+        for key in list(batches):
+            flush(key)
+        return {**group, "children": children}
+
+    result = {k: v for k, v in root.items() if k != "buffers"}
+    result["object"] = batch_group(root["object"])
+    result["geometries"] = [encode_geometry(g, buffers, buffer) for g in root["geometries"]
+                            if g["uuid"] in used_geometries] + new_geometries
+    if buffer is not None and buffer.entry() is not None:
+        result["buffers"] = [buffer.entry()]
+    return result
+
+
+def batch_viewer_json(input_path: Union[str, Path], output_path: Union[str, Path] = None, **options) -> list[Path]:
+    """
+    Batch a viewer JSON file (in place if ``output_path`` is None), see ``batch_viewer_object``.
+    A viewer JSON with external buffers gets a new ``*.bin`` next to the output. Returns the written files.
+    """
+    input_path = Path(input_path)
+    output_path = input_path if output_path is None else Path(output_path)
+    with input_path.open("r") as f:
+        root = ujson.load(f)
+    buffers = load_buffers(root, input_path.parent)
+    outputs = [output_path]
+    if any(not b["uri"].startswith("data:") for b in root.get("buffers", ())):
+        outputs.append(output_path.with_suffix(BIN_SUFFIX))
+    # Written to temporary files first, the input buffers may be the output ones
+    temporaries = [p.with_name(p.name + ".tmp") for p in outputs]
+    try:
+        with contextlib.ExitStack() as stack:
+            files = [stack.enter_context(tmp.open("wb")) for tmp in temporaries]
+            buffer = GeometryBuffer(files[1], outputs[1].name) if len(files) > 1 else None
+            batched = batch_viewer_object(root, buffers, buffer, **options)
+            del root, buffers
+            files[0].write(ujson.dumps(batched, ensure_ascii=False).encode("utf-8"))
+        for tmp, path in zip(temporaries, outputs):
+            os.replace(tmp, path)
+    except BaseException:
+        for tmp in temporaries:
+            tmp.unlink(missing_ok=True)
+        raise
+    return outputs
@@ -0,0 +1,148 @@
+"""
+Precompressed variants of the output files and ``Accept-Encoding`` negotiation.
+
+A viewer JSON of some hundred MB compressed on every request costs the server more than the
+conversion did. The worker writes the variants once, next to the blob: ``model.json.gz``,
+``model.json.br`` and ``model.json.zst``. All are compressed in one streaming pass over the
+file. gzip is always available, brotli and zstd only with the ``brotli`` and ``zstandard``
+packages installed. The server picks the best variant the client accepts (``negotiate``) and
+serves it as it is, with ``Content-Encoding``.
+
+>>> write_variants('blobs/model.json')
+[PosixPath('blobs/model.json.br'), PosixPath('blobs/model.json.zst'), PosixPath('blobs/model.json.gz')]
+>>> negotiate('gzip, deflate, br;q=0.9', ['br', 'gzip'])
+'gzip'
+"""
+from __future__ import annotations
+
+import os
+import zlib
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+# Content-Encoding -> file suffix, in the order of preference
+SUFFIXES = {"br": ".br", "zstd": ".zst", "gzip": ".gz"}
+LEVELS = {"br": 5, "zstd": 9, "gzip": 6}
+CHUNK_SIZE = 1 << 20
+
+
+def available_encodings() -> list[str]:
+    """Encodings with a compressor in this environment, in the order of preference."""
+    encodings = []
+    for encoding, module in (("br", "brotli"), ("zstd", "zstandard"), ("gzip", "zlib")):
+        try:
+            __import__(module)
+        except ImportError:
+            continue
+        encodings.append(encoding)
+    return encodings
+
+
+class _Compressor:
+    """Streaming compressor with the ``compress``/``flush`` interface of ``zlib``."""
+    __slots__ = ("compress", "flush")
+
+    def __init__(self, encoding: str, level: Optional[int] = None):
+        level = LEVELS[encoding] if level is None else level
+        if encoding == "gzip":
+            obj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.compress, self.flush = obj.compress, obj.flush
+        elif encoding == "br":
+            import brotli
+            obj = brotli.Compressor(quality=level)
+            self.compress, self.flush = obj.process, obj.finish
+        elif encoding == "zstd":
+            import zstandard
+            obj = zstandard.ZstdCompressor(level=level).compressobj()
+            self.compress, self.flush = obj.compress, obj.flush
+        else:
+            raise ValueError(f"Unknown encoding {encoding!r}")
+
+
+def variant_path(path: Union[str, Path], encoding: str) -> Path:
+    path = Path(path)
+    return path.with_name(path.name + SUFFIXES[encoding])
+
+
+def write_variants(path: Union[str, Path], encodings: Optional[Iterable[str]] = None,
+                   chunk_size: int = CHUNK_SIZE) -> list[Path]:
+    """
+    Write the compressed variants of ``path`` next to it in one pass over the file,
+    ``encodings`` are the available ones by default. Returns the written files.
+    """
+    path = Path(path)
+    encodings = available_encodings() if encodings is None else list(encodings)
+    outputs = [variant_path(path, encoding) for encoding in encodings]
+    # Written to temporary files first, a variant is never served half written
+    temporaries = [p.with_name(p.name + ".tmp") for p in outputs]
+    compressors = [_Compressor(encoding) for encoding in encodings]
+    files = []
+    try:
+        files.extend(tmp.open("wb") for tmp in temporaries)
+        with path.open("rb") as f:
+            while chunk := f.read(chunk_size):
+                for compressor, out in zip(compressors, files):
+                    out.write(compressor.compress(chunk))
+        for compressor, out in zip(compressors, files):
+            out.write(compressor.flush())
+            out.close()
+        for tmp, output in zip(temporaries, outputs):
+            os.replace(tmp, output)
+    except BaseException:
+        for out in files:
+            out.close()
+        for tmp in temporaries:
+            tmp.unlink(missing_ok=True)
+        raise
+    return outputs
+
+
+def _accepted(accept_encoding: str) -> dict[str, float]:
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding:
+            accepted[coding.strip().lower()] = q
+    return accepted
+
+
+def negotiate(accept_encoding: Optional[str], encodings: Iterable[str]) -> Optional[str]:
+    """
+    The encoding of ``encodings`` (in the order of preference) the client accepts with the highest
+    ``q`` in its ``Accept-Encoding``, None for the identity.
+    """
+    if not accept_encoding:
+        return None
+    accepted = _accepted(accept_encoding)
+    best, best_q = None, 0.0
+    for encoding in encodings:
+        q = accepted.get(encoding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def best_variant(path: Union[str, Path], accept_encoding: Optional[str]) -> tuple[Path, Optional[str]]:
+    """
+    The variant of ``path`` to serve for ``accept_encoding`` and its encoding, ``(path, None)`` if none.
+    Variants older than ``path`` (written before it was rewritten) are not served.
+    """
+    path = Path(path)
+    mtime = path.stat().st_mtime
+    encodings = []
+    for encoding in SUFFIXES:
+        try:
+            if variant_path(path, encoding).stat().st_mtime >= mtime:
+                encodings.append(encoding)
+        except FileNotFoundError:
+            pass
+    encoding = negotiate(accept_encoding, encodings)
+    return (path, None) if encoding is None else (variant_path(path, encoding), encoding)
@@ -1,9 +1,16 @@
 import multiprocessing
+from typing import Optional
 from pathlib import Path
 import ujson
 import click
 from ifcexport2.compat import IfcExportCompat
-from ifcexport2.partition import partition_viewer_json
+from ifcexport2.batching import batch_viewer_json, MAX_OBJECT_VERTICES, MAX_BATCH_VERTICES
+from ifcexport2.lod import LodPolicy
+from ifcexport2.split_stream import split_viewer_json_stream
+from ifcexport2.partition import TOLERANCE
+from ifcexport2.tiling import write_tiles, MAX_TILE_BYTES, MAX_DEPTH
+from ifcexport2.grouping import write_groups
+from ifcexport2.blob_variants import write_variants, SUFFIXES
 import rich
 @click.group('ifcexport2')
 def ifcexport2_cli():
@@ -100,6 +107,209 @@ def ifcexport2_cli():
     default=False,
     help="Outputs the result in a single JSON string. Suitable for scripts.",
 )
+@click.option(
+    "--instancing",
+    is_flag=True,
+    default=False,
+    help=(
+            "Tessellate in local coordinates and share one geometry between all products "
+            "with the same representation. Each object gets its own matrix."
+    ),
+)
+@click.option(
+    "--cache-dir",
+    type=click.Path(
+        file_okay=False,
+        dir_okay=True,
+        writable=True,
+        path_type=Path,
+    ),
+    default=None,
+    help=(
+            "Directory of the persistent tessellation cache. Products found in the cache "
+            "are not tessellated again. Disabled by default."
+    ),
+)
+@click.option(
+    "--cache-size",
+    type=int,
+    default=10 * 1024,
+    show_default=True,
+    help="Size limit of the tessellation cache in megabytes. Least recently used entries are evicted.",
+)
+@click.option(
+    "--previous",
+    type=click.Path(
+        exists=True,
+        file_okay=True,
+        dir_okay=False,
+        readable=True,
+        path_type=Path,
+    ),
+    default=None,
+    help=(
+            "*.viewer.json of a previous conversion of the same model (exported with --manifest). "
+            "Only added or changed products are tessellated, the rest is taken from it."
+    ),
+)
+@click.option(
+    "--manifest",
+    "write_manifest",
+    is_flag=True,
+    default=False,
+    help="Write the *.viewer.json.manifest.json product to geometry mapping, required to use the output as --previous.",
+)
+@click.option(
+    "-i",
+    "--include-type",
+    "include_types",
+    multiple=True,
+    help=(
+            "Convert only products of these IFC types (subtypes included). "
+            "Example: -i IfcWall -i IfcSlab"
+    ),
+)
+@click.option(
+    "--global-id",
+    "global_ids",
+    multiple=True,
+    help="Convert only the products with these GlobalIds.",
+)
+@click.option(
+    "--exclude-global-id",
+    "exclude_global_ids",
+    multiple=True,
+    help="Do not convert the products with these GlobalIds.",
+)
+@click.option(
+    "--container",
+    "containers",
+    multiple=True,
+    help="GlobalId of a spatial container (storey, building, ...). Convert only the products it contains.",
+)
+@click.option(
+    "--context",
+    "contexts",
+    multiple=True,
+    help="Convert only products with a representation in these contexts (representation or context identifier, or context type). Example: --context Body",
+)
+@click.option(
+    "--robust",
+    is_flag=True,
+    default=False,
+    help=(
+            "Retry the products the geometry iterator fails on one by one in isolated processes, "
+            "with timeouts and degraded settings. "
+            "Failed products are saved to the *.fails file."
+    ),
+)
+@click.option(
+    "--retry-timeout",
+    type=float,
+    default=60.0,
+    show_default=True,
+    help="Seconds allowed for one product in one isolated retry (with --robust).",
+)
+@click.option(
+    "--embed-buffers",
+    is_flag=True,
+    default=False,
+    help="With -f viewer-bin, store the geometry attributes inline as base64 data instead of a *.viewer.bin file.",
+)
+@click.option(
+    "--draco",
+    is_flag=True,
+    default=False,
+    help="With -f glb, compress the mesh primitives with Draco (KHR_draco_mesh_compression).",
+)
+@click.option(
+    "--quantize",
+    is_flag=True,
+    default=False,
+    help=(
+            "Store positions as normalized int16 relative to the centre of each mesh (the decode matrix goes "
+            "to the object matrix), colours as normalized uint8 and indices as uint16 where possible."
+    ),
+)
+@click.option(
+    "--material-groups",
+    is_flag=True,
+    default=False,
+    help=(
+            "Colour multi-material products with geometry groups and a deduplicated palette of materials "
+            "instead of a per-vertex colour attribute."
+    ),
+)
+@click.option(
+    "--batch",
+    is_flag=True,
+    default=False,
+    help=(
+            "Merge small meshes sharing a material within the same storey or container into batches "
+            "with an objectId vertex attribute (see the batch command)."
+    ),
+)
+@click.option(
+    "--lod",
+    is_flag=True,
+    default=False,
+    help=(
+            "Add simplified levels of detail (quadric decimation) to heavy meshes, written as three.js LOD objects. "
+            "Viewer formats only."
+    ),
+)
+@click.option(
+    "--lod-min-triangles",
+    type=int,
+    default=1024,
+    show_default=True,
+    help="Meshes with fewer triangles get no levels of detail.",
+)
+@click.option(
+    "--lod-max-triangles",
+    type=int,
+    default=None,
+    help="Triangle budget of a level of detail.",
+)
+@click.option(
+    "--lod-workers",
+    type=int,
+    default=None,
+    help="Simplification processes, cpu count - 1 by default, 0 to simplify in the main process.",
+)
+@click.option(
+    "--adaptive-deflection",
+    is_flag=True,
+    default=False,
+    help=(
+            "Tessellate small products, fasteners, MEP flow elements and furniture with coarser linear/angular "
+            "deflection, one iterator per deflection class. Large elements keep the base settings."
+    ),
+)
+@click.option(
+    "--parts",
+    type=int,
+    default=None,
+    help=(
+            "Write the viewer JSON as this many <prefix>-<i>.viewer.json parts straight from the conversion "
+            "results, as the split command would split it. Viewer formats only."
+    ),
+)
+@click.option(
+    "--max-part-size",
+    type=float,
+    default=None,
+    help="Write parts (see --parts) of at most this many MB of geometry, the tile budget with --tiles.",
+)
+@click.option(
+    "--tiles",
+    is_flag=True,
+    default=False,
+    help=(
+            "Write the parts as spatial tiles with a <prefix>.tileset.json manifest (see the tile command), "
+            f"{MAX_TILE_BYTES / 1024 ** 2:g} MB per tile unless --max-part-size is given."
+    ),
+)
 def export_ifc_to_viewer(input_file: Path,
                          output_prefix: Path,
                          output_format: IfcExportCompat,
@@ -108,7 +318,32 @@ def export_ifc_to_viewer(input_file: Path,
                          threads: int,
                          print_items: bool,
                          no_save_fails: bool,
-                         json_output: bool):
+                         json_output: bool,
+                         instancing: bool,
+                         cache_dir: Path,
+                         cache_size: int,
+                         previous: Path,
+                         write_manifest: bool,
+                         include_types: tuple,
+                         global_ids: tuple,
+                         exclude_global_ids: tuple,
+                         containers: tuple,
+                         contexts: tuple,
+                         robust: bool,
+                         retry_timeout: float,
+                         embed_buffers: bool,
+                         draco: bool,
+                         quantize: bool,
+                         material_groups: bool,
+                         batch: bool,
+                         lod: bool,
+                         lod_min_triangles: int,
+                         lod_max_triangles: int,
+                         lod_workers: int,
+                         adaptive_deflection: bool,
+                         parts: Optional[int],
+                         max_part_size: Optional[float],
+                         tiles: bool):
     """Process an IFC file to extract geometric meshes and associated data and output in  ifcexport2.cxm-viewer friendly format.
 
     This script reads an IFC file, extracts geometry data, applies scaling,
@@ -116,13 +351,53 @@ def export_ifc_to_viewer(input_file: Path,
     """
 
     from ifcexport2 import ifc_to_mesh
-    ifc_to_mesh.cli_export(input_file, output_prefix, output_format, scale, exclude, threads, print_items,
-                           no_save_fails, json_output)
+    from ifcexport2.viewer_parts import PartitionPolicy
+    partition = None
+    if tiles:
+        partition = PartitionPolicy(max_part_bytes=int((max_part_size or MAX_TILE_BYTES / 1024 ** 2) * 1024 ** 2),
+                                    tiles=True)
+    elif parts is not None or max_part_size is not None:
+        partition = PartitionPolicy(parts=parts,
+                                    max_part_bytes=None if max_part_size is None else int(max_part_size * 1024 ** 2))
+    ifc_to_mesh.cli_export(input_file, output_prefix, output_format,
+                           exclude=exclude,
+                           threads=threads,
+                           print_items=print_items,
+                           json_output=json_output,
+                           scale=scale,
+                           no_save_fails=no_save_fails,
+                           instancing=instancing,
+                           cache_dir=cache_dir,
+                           cache_size=cache_size * 1024 * 1024,
+                           previous=previous,
+                           write_manifest=write_manifest,
+                           include_types=include_types,
+                           global_ids=global_ids,
+                           exclude_global_ids=exclude_global_ids,
+                           containers=containers,
+                           contexts=contexts,
+                           robust=robust,
+                           retry_timeout=retry_timeout,
+                           embed_buffers=embed_buffers,
+                           draco=draco,
+                           quantize=quantize,
+                           material_groups=material_groups,
+                           batch=batch,
+                           lod=LodPolicy(min_triangles=lod_min_triangles,
+                                         max_triangles=lod_max_triangles,
+                                         workers=lod_workers) if lod else None,
+                           adaptive_deflection=adaptive_deflection,
+                           partition=partition)
 
 
 @ifcexport2_cli.command(
     name="split",
-    help="Split a single *.viewer.json file into parts."
+    help=(
+            "Split a single *.viewer.json file into PARTS_COUNT parts, or into parts of at most --max-part-size MB. "
+            "Whole storeys and containers stay in one part where the balance allows it. Geometry buffers "
+            "(-f viewer-bin) are split along. With --by, one part per storey, IFC class or property value "
+            "instead, with a <name>.index.json of the parts."
+    )
 
 )
 @click.argument(
@@ -140,6 +415,8 @@ def export_ifc_to_viewer(input_file: Path,
     "parts_count",
     type=int,
     metavar="PARTS_COUNT",
+    required=False,
+    default=None,
 )
 @click.option(
     "-o",
@@ -158,61 +435,150 @@ def export_ifc_to_viewer(input_file: Path,
             "Path to the directory where the split files will be written. By default current working directory"))
 @click.option('-n','--no-print',  is_flag=True,
     default=False,help="Disable printing.")
-def split_viewer_json(input_file: Path, parts_count: int, output_dir: Path,no_print:bool=False):
+@click.option('--quantize',  is_flag=True,
+    default=False,help="Quantize the geometries of the parts (see export --quantize) and rebase each part to its own origin.")
+@click.option('-w','--workers', type=int, default=None,
+    help="Processes writing the parts, 0 writes them in this process. By default the CPU count.")
+@click.option('--max-part-size', type=float, default=None,
+    help="Geometry budget of a part in MB, instead of PARTS_COUNT.")
+@click.option('--tolerance', type=float, default=TOLERANCE, show_default=True,
+    help="With PARTS_COUNT, how far the largest part may exceed the mean before storeys and containers are split up.")
+@click.option('--by', type=str, default=None,
+    help="Group the objects into parts by a userData.properties key (e.g. type), 'storey', 'building', 'site' "
+         "or container:<IfcClass>, instead of PARTS_COUNT. Groups over --max-part-size are split up.")
+def split_viewer_json(input_file: Path, parts_count: Optional[int], output_dir: Path,no_print:bool=False, quantize:bool=False,
+                      workers:int=None, max_part_size:Optional[float]=None, tolerance:float=TOLERANCE,
+                      by:Optional[str]=None):
+    if parts_count is None and max_part_size is None and by is None:
+        raise click.UsageError("PARTS_COUNT, --max-part-size or --by is required.")
+    if parts_count is not None and by is not None:
+        raise click.UsageError("PARTS_COUNT and --by are exclusive.")
     verbose=not no_print
     progress_bar_size = 64
-    step_size=(progress_bar_size//parts_count)
-    import time
 
     console=rich.get_console()
 
     if verbose:
         console.print(f"Reading {input_file.absolute()}", style="rgb(127,127,127)")
 
-
-        #rich.print(f"  "+
-        #           "[grey]" + "░" * progress_bar_size + f"[/grey] [blue][bold]0/{parts_count}[/bold][/blue]",
-        #           end='\r',
-        #           flush=True)
-    with input_file.open('r') as f:
-        data=ujson.load(f)
-
-
-
-
-
     _ifl=input_file.name
 
     for sf in input_file.suffixes:
         _ifl=_ifl.replace(sf,'')
 
-    if verbose:
-        console.print(f"Perform splitting on {parts_count} parts ..", style="rgb(127,127,127)")
-        rich.print(f"  "+ "[grey]" + ("░" * progress_bar_size) +f"[/grey]" +f" [blue][bold]0/{parts_count}[/bold][/blue]",
-               end='\r',
-               flush=True)
-    outs=[]
-    for i, (jsn, perf) in enumerate(partition_viewer_json(data, parts_count, _ifl)):
-
-        path = f'{_ifl}-{i}.viewer.json'
-        outs.append(str((output_dir / path).absolute()))
-        with (output_dir/path).open( 'w') as f:
-            ujson.dump(jsn, f)
+    max_part_bytes=int(max_part_size*1024**2) if max_part_size is not None else None
+    if by is not None:
+        # The file is loaded whole, as for the tile command
+        if verbose:
+            console.print(f"Perform splitting by {by} ..", style="rgb(127,127,127)")
+        outs=write_groups(input_file, output_dir, by, _ifl, max_part_bytes=max_part_bytes, quantize=quantize)
         if verbose:
+            console.print(f"Output files saved:",  [str(Path(o).absolute()) for o in outs], style="rgb(127,127,127)")
+        return
+    if verbose:
+        console.print(f"Perform splitting on {parts_count} parts .." if max_part_bytes is None else
+                      f"Perform splitting on parts of at most {max_part_size} MB ..", style="rgb(127,127,127)")
 
-            rich.print(
-                       f"  "+"[blue]" + "█" * (i * step_size) + f"[/blue]"+"[grey]" + ("░" * (progress_bar_size - (i * step_size))) + f"[/grey]" +f" [blue][bold]{i}/{parts_count}[/bold][/blue]",
-                       end='\r',
+    def progress(done, total):
+        if verbose:
+            filled=progress_bar_size*done//total
+            rich.print(f"  "+"[blue]" + "█" * filled + f"[/blue]"+"[grey]" + ("░" * (progress_bar_size - filled)) + f"[/grey]" +f" [blue][bold]{done}/{total}[/bold][/blue]",
+                       end='\r' if done<total else '\n',
                        flush=True)
+
+    # The file is read incrementally and the parts are written in parallel, see split_stream
+    outs,report=split_viewer_json_stream(input_file, parts_count, output_dir, _ifl, quantize=quantize, workers=workers,
+                                         progress=progress, max_part_bytes=max_part_bytes, tolerance=tolerance)
     if verbose:
+        console.print(f"Output files saved:",  [str(Path(o).absolute()) for o in outs], style="rgb(127,127,127)")
+        console.print(f"Balance: {report.parts} parts of {report.min/1024**2:.2f}-{report.max/1024**2:.2f} MB "
+                      f"(mean {report.mean/1024**2:.2f} MB, max/mean {report.imbalance:.3f})", style="rgb(127,127,127)")
 
-        rich.print(f"  "+
-                       "[blue]" + "█" *progress_bar_size + "[/blue]"+f" [blue][bold]{parts_count}/{parts_count}[/bold][/blue]",
-                       end='\n',
-                       flush=True)
-        console.print(f"Output files saved:",  outs, style="rgb(127,127,127)")
+
+@ifcexport2_cli.command(
+    name="batch",
+    help=(
+            "Merge small meshes of a *.viewer.json file sharing a material within the same storey or container "
+            "into batches. Each vertex gets an objectId attribute, the index of its object in the userData.objects "
+            "(properties) and userData.uuids tables of the batch."
+    )
+)
+@click.argument(
+    "input_file",
+    type=click.Path(exists=True, dir_okay=False, readable=True, path_type=Path),
+    metavar="INPUT_FILE",
+)
+@click.option(
+    "-o",
+    "--output",
+    "output_file",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    default=None,
+    help="Output *.viewer.json path. By default the input file is overwritten.",
+)
+@click.option("--max-object-vertices", type=int, default=MAX_OBJECT_VERTICES, show_default=True,
+              help="Meshes with more vertices are kept as they are.")
+@click.option("--max-batch-vertices", type=int, default=MAX_BATCH_VERTICES, show_default=True,
+              help="Maximum number of vertices of a batch.")
+def batch_viewer_json_command(input_file: Path, output_file: Path, max_object_vertices: int, max_batch_vertices: int):
+    outs = batch_viewer_json(input_file, output_file,
+                             max_object_vertices=max_object_vertices,
+                             max_batch_vertices=max_batch_vertices)
+    rich.get_console().print(f"Output files saved:", [str(o.absolute()) for o in outs], style="rgb(127,127,127)")
 
 
+@ifcexport2_cli.command(
+    name="tile",
+    help=(
+            "Split a *.viewer.json file into spatial tiles of a loose octree with a byte budget per tile, "
+            "and write a <name>.tileset.json manifest (3D Tiles like) of their bounds, sizes and children "
+            "for progressive loading. Geometry buffers (-f viewer-bin) are split along."
+    )
+)
+@click.argument(
+    "input_file",
+    type=click.Path(exists=True, dir_okay=False, readable=True, path_type=Path),
+    metavar="INPUT_FILE",
+)
+@click.option(
+    "-o",
+    "--output-dir",
+    type=click.Path(file_okay=False, dir_okay=True, writable=True, path_type=Path),
+    default=Path("."),
+    show_default=True,
+    help="Directory the tiles and the tileset are written to, created if missing.",
+)
+@click.option("--tile-size", type=float, default=MAX_TILE_BYTES / 1024 ** 2, show_default=True,
+              help="Geometry budget of a tile in MB, larger tiles are split into octants.")
+@click.option("--max-depth", type=int, default=MAX_DEPTH, show_default=True,
+              help="Maximum depth of the octree.")
+@click.option('--quantize', is_flag=True, default=False,
+              help="Quantize the geometries of the tiles (see export --quantize) and rebase each tile to its own origin.")
+def tile_viewer_json_command(input_file: Path, output_dir: Path, tile_size: float, max_depth: int, quantize: bool):
+    outs = write_tiles(input_file, output_dir,
+                       max_tile_bytes=int(tile_size * 1024 ** 2),
+                       max_depth=max_depth,
+                       quantize=quantize)
+    rich.get_console().print(f"Output files saved:", [str(o.absolute()) for o in outs], style="rgb(127,127,127)")
+
+
+@ifcexport2_cli.command(
+    name="compress",
+    help=(
+            "Write precompressed variants (.gz, and .br/.zst with the brotli/zstandard packages) next to the given "
+            "files, e.g. the blobs of the conversion service written before it compressed them, or files served "
+            "by a static server with precompression (nginx gzip_static)."
+    )
+)
+@click.argument("input_files", nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False, readable=True, path_type=Path))
+@click.option("-e", "--encoding", "encodings", multiple=True, type=click.Choice(list(SUFFIXES)),
+              help="Encodings to write, all available ones by default.")
+def compress_command(input_files: tuple, encodings: tuple):
+    outs = []
+    for input_file in input_files:
+        outs.extend(write_variants(input_file, encodings or None))
+    rich.get_console().print(f"Output files saved:", [str(o.absolute()) for o in outs], style="rgb(127,127,127)")
 
 
 if __name__ == "__main__":
@@ -3,11 +3,8 @@ from enum import Enum
 
 class IfcExportCompat(str, Enum):
     viewer="viewer"
+    # viewer JSON with the geometry attributes in a little-endian *.bin buffer (see viewer_buffers)
+    viewer_buffers = "viewer-bin"
+    # binary glTF, see gltf.write_glb
+    glb = "glb"
     collision_detection_mesh = "cd-mesh"
-
-
-
-
-
-
-
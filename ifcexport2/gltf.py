@@ -0,0 +1,307 @@
+"""
+Binary glTF (GLB) export of converted objects (``IfcExportCompat.glb``).
+
+One glTF mesh is written per unique representation (``Mesh.uid``). Representations used by
+several products (``ConvertArguments(instancing=True)``) are drawn by one node with
+``EXT_mesh_gpu_instancing``, the products keep their own nodes in the IFC hierarchy for
+their properties. Primitives can be Draco-compressed (``KHR_draco_mesh_compression``).
+IFC properties are stored in the ``extras`` of the nodes, the model is rotated to glTF's
+Y-up and scaled from the file length unit to metres by the root node.
+
+>>> stream = convert_stream(ifc_file, ConvertArguments(instancing=True))
+>>> with open('model.glb', 'wb') as f:
+...     write_glb(f, 'model', stream.objects, ifc_file, index=stream.index, draco=True)
+"""
+from __future__ import annotations
+
+import shutil
+import struct
+import tempfile
+from typing import BinaryIO, Iterable, Optional
+
+import ifcopenshell
+import ifcopenshell.util.unit
+import numpy as np
+import ujson
+
+import ifcexport2.ifc_hierarchy
+import ifcexport2.ifc_psets
+from ifcexport2.ifc_to_mesh import _build_tree
+from ifcexport2.mesh import Mesh
+from ifcexport2.mesh_to_three import create_group, default_material, color_attr_material
+from ifcexport2.model_index import ModelIndex
+from ifcexport2.models import IRGeometryObject
+from ifcexport2.viewer_buffers import GeometryBuffer
+
+GLB_MAGIC = 0x46546C67
+GLB_JSON_CHUNK = 0x4E4F534A
+GLB_BIN_CHUNK = 0x004E4942
+
+# componentType
+UNSIGNED_BYTE = 5121
+UNSIGNED_SHORT = 5123
+UNSIGNED_INT = 5125
+FLOAT = 5126
+COMPONENT_TYPES = {UNSIGNED_BYTE: "Uint8Array", UNSIGNED_SHORT: "Uint16Array", UNSIGNED_INT: "Uint32Array",
+                   FLOAT: "Float32Array"}
+ARRAY_BUFFER = 34962
+ELEMENT_ARRAY_BUFFER = 34963
+
+# IFC is Z-up, glTF is Y-up: -90 degrees around X
+Z_UP_TO_Y_UP = [-0.7071067811865476, 0.0, 0.0, 0.7071067811865476]
+IDENTITY = np.eye(4)
+
+
+def _gltf_material(mat: dict, base_color) -> dict:
+    return {
+        "name": mat["uuid"],
+        "pbrMetallicRoughness": {
+            "baseColorFactor": [*base_color, 1.0],
+            "metallicFactor": mat["metalness"],
+            "roughnessFactor": mat["roughness"],
+        },
+        "doubleSided": True,
+    }
+
+
+def decompose_matrices(matrices: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Translation (n, 3), rotation quaternion xyzw (n, 4) and scale (n, 3) of (n, 4, 4) affine matrices,
+    and a mask of the matrices that are representable as TRS (no shear).
+    """
+    translation = matrices[:, :3, 3]
+    linear = matrices[:, :3, :3]
+    scale = np.linalg.norm(linear, axis=1)
+    # A mirror becomes a negative scale along X
+    scale[np.linalg.det(linear) < 0, 0] *= -1
+    valid = np.all(np.abs(scale) > 1e-12, axis=1)
+    rotation = linear / np.where(valid[:, None], scale, 1.0)[:, None, :]
+    valid &= np.all(np.abs(rotation.transpose(0, 2, 1) @ rotation - np.eye(3)) < 1e-5, axis=(1, 2))
+
+    m = rotation
+    trace = np.stack((1 + m[:, 0, 0] - m[:, 1, 1] - m[:, 2, 2],
+                      1 - m[:, 0, 0] + m[:, 1, 1] - m[:, 2, 2],
+                      1 - m[:, 0, 0] - m[:, 1, 1] + m[:, 2, 2],
+                      1 + m[:, 0, 0] + m[:, 1, 1] + m[:, 2, 2]), axis=1)
+    quaternion = np.sqrt(np.maximum(trace, 0.0)) / 2
+    quaternion[:, 0] = np.copysign(quaternion[:, 0], m[:, 2, 1] - m[:, 1, 2])
+    quaternion[:, 1] = np.copysign(quaternion[:, 1], m[:, 0, 2] - m[:, 2, 0])
+    quaternion[:, 2] = np.copysign(quaternion[:, 2], m[:, 1, 0] - m[:, 0, 1])
+    quaternion /= np.linalg.norm(quaternion, axis=1, keepdims=True)
+    return translation, quaternion, scale, valid
+
+
+class GlbBuilder:
+    """
+    The glTF document of a GLB file. Binary data is appended to ``bin_fp`` as it is added,
+    so meshes can be dropped right after ``add_mesh``.
+    """
+
+    def __init__(self, bin_fp: BinaryIO, draco: bool = False, draco_options: dict = None):
+        self.buffer = GeometryBuffer(bin_fp, "")
+        self.draco = draco
+        self.draco_options = draco_options if draco_options is not None else {}
+        self.gltf = {
+            "asset": {"version": "2.0", "generator": "ifcexport2"},
+            "scene": 0,
+            "scenes": [{"nodes": []}],
+            "nodes": [],
+            "meshes": [],
+            "materials": [_gltf_material(default_material, (np.array((150, 150, 150)) / 255).tolist()),
+                          _gltf_material(color_attr_material, (1.0, 1.0, 1.0))],
+            "accessors": [],
+            "bufferViews": [],
+            "buffers": [],
+        }
+        self.extensions = set()
+
+    def buffer_view(self, array: np.ndarray, component_type: int, target: Optional[int] = None) -> int:
+        ref = self.buffer.add(array, COMPONENT_TYPES[component_type])
+        view = {"buffer": 0, "byteOffset": ref["byteOffset"], "byteLength": ref["byteLength"]}
+        if target is not None:
+            view["target"] = target
+        self.gltf["bufferViews"].append(view)
+        return len(self.gltf["bufferViews"]) - 1
+
+    def accessor(self, array: Optional[np.ndarray], component_type: int, type_name: str, count: int,
+                 target: Optional[int] = None, normalized: bool = False, bounds: Optional[np.ndarray] = None) -> int:
+        """Accessor of ``array`` in a new buffer view, or without data (``array=None``) for Draco attributes."""
+        accessor = {"componentType": component_type, "count": count, "type": type_name}
+        if array is not None:
+            accessor["bufferView"] = self.buffer_view(array, component_type, target)
+        if normalized:
+            accessor["normalized"] = True
+        if bounds is not None:
+            accessor["min"] = bounds.min(axis=0).tolist()
+            accessor["max"] = bounds.max(axis=0).tolist()
+        self.gltf["accessors"].append(accessor)
+        return len(self.gltf["accessors"]) - 1
+
+    def add_mesh(self, mesh: Mesh, name: str = None) -> int:
+        position = np.asarray(mesh.position, dtype=np.float32).reshape((-1, 3))
+        faces = np.asarray(mesh.faces, dtype=np.uint32).reshape(-1)
+        colors = None
+        if mesh.colors is not None:
+            # RGBA, vertex attribute elements must be 4-byte aligned and 3 unsigned bytes are not
+            colors = np.full((len(position), 4), 255, dtype=np.uint8)
+            colors[:, :3] = np.rint(np.clip(np.asarray(mesh.colors, dtype=np.float32)[:, :3], 0, 1) * 255)
+        index_type = UNSIGNED_SHORT if len(position) <= 0xFFFF else UNSIGNED_INT
+        primitive = {"attributes": {}, "material": 0 if colors is None else 1}
+
+        if self.draco:
+            import DracoPy
+            encoded = DracoPy.encode(position, faces.reshape((-1, 3)), colors=colors, **self.draco_options)
+            # Draco may split and reorder vertices, the accessors describe the decoded data
+            decoded = DracoPy.decode(encoded)
+            vertices_count = len(decoded.points)
+            primitive["attributes"]["POSITION"] = self.accessor(None, FLOAT, "VEC3", vertices_count, bounds=position)
+            draco_attributes = {"POSITION": 0}
+            if colors is not None:
+                primitive["attributes"]["COLOR_0"] = self.accessor(None, UNSIGNED_BYTE, "VEC4", vertices_count,
+                                                                   normalized=True)
+                draco_attributes["COLOR_0"] = 1
+            primitive["indices"] = self.accessor(None, UNSIGNED_SHORT if vertices_count <= 0xFFFF else UNSIGNED_INT,
+                                                 "SCALAR", int(np.asarray(decoded.faces).size))
+            primitive["extensions"] = {"KHR_draco_mesh_compression": {
+                "bufferView": self.buffer_view(np.frombuffer(encoded, dtype=np.uint8), UNSIGNED_BYTE),
+                "attributes": draco_attributes,
+            }}
+            self.extensions.add("KHR_draco_mesh_compression")
+        else:
+            primitive["attributes"]["POSITION"] = self.accessor(position, FLOAT, "VEC3", len(position), ARRAY_BUFFER,
+                                                                bounds=position)
+            if colors is not None:
+                primitive["attributes"]["COLOR_0"] = self.accessor(colors, UNSIGNED_BYTE, "VEC4", len(colors),
+                                                                   ARRAY_BUFFER, normalized=True)
+            primitive["indices"] = self.accessor(faces, index_type, "SCALAR", len(faces), ELEMENT_ARRAY_BUFFER)
+
+        gltf_mesh = {"primitives": [primitive]}
+        if name is not None:
+            gltf_mesh["name"] = name
+        self.gltf["meshes"].append(gltf_mesh)
+        return len(self.gltf["meshes"]) - 1
+
+    def add_node(self, node: dict) -> int:
+        self.gltf["nodes"].append(node)
+        return len(self.gltf["nodes"]) - 1
+
+    def add_instances(self, mesh_index: int, matrices: np.ndarray, extras: dict = None) -> int:
+        """A node drawing the mesh once per matrix with EXT_mesh_gpu_instancing, matrices must be TRS."""
+        translation, rotation, scale, _ = decompose_matrices(matrices)
+        attributes = {
+            "TRANSLATION": self.accessor(translation.astype(np.float32), FLOAT, "VEC3", len(matrices)),
+            "ROTATION": self.accessor(rotation.astype(np.float32), FLOAT, "VEC4", len(matrices)),
+            "SCALE": self.accessor(scale.astype(np.float32), FLOAT, "VEC3", len(matrices)),
+        }
+        self.extensions.add("EXT_mesh_gpu_instancing")
+        node = {"mesh": mesh_index, "extensions": {"EXT_mesh_gpu_instancing": {"attributes": attributes}}}
+        if extras is not None:
+            node["extras"] = extras
+        return self.add_node(node)
+
+    def write(self, fp: BinaryIO, bin_fp: BinaryIO):
+        """Write the GLB to ``fp``, ``bin_fp`` is the file the binary data was appended to."""
+        bin_length = self.buffer.byte_length + (-self.buffer.byte_length % 4)
+        self.gltf["buffers"] = [{"byteLength": bin_length}]
+        if self.extensions:
+            self.gltf["extensionsUsed"] = sorted(self.extensions)
+        # Without them a loader would draw compressed primitives as nothing and instanced meshes once
+        required = sorted(self.extensions & {"KHR_draco_mesh_compression", "EXT_mesh_gpu_instancing"})
+        if required:
+            self.gltf["extensionsRequired"] = required
+        # Props can be ChainMap views over shared property sets (see ifc_psets.PropsExtractor)
+        json_chunk = ujson.dumps(self.gltf, ensure_ascii=False, default=dict).encode("utf-8")
+        json_chunk += b" " * (-len(json_chunk) % 4)
+
+        fp.write(struct.pack("<III", GLB_MAGIC, 2, 12 + 8 + len(json_chunk) + 8 + bin_length))
+        fp.write(struct.pack("<II", len(json_chunk), GLB_JSON_CHUNK))
+        fp.write(json_chunk)
+        fp.write(struct.pack("<II", bin_length, GLB_BIN_CHUNK))
+        bin_fp.seek(0)
+        shutil.copyfileobj(bin_fp, fp)
+        fp.write(b"\0" * (bin_length - self.buffer.byte_length))
+
+
+def write_glb(fp: BinaryIO, name: str, objects: Iterable[IRGeometryObject], ifc_file: ifcopenshell.file,
+              include_spatial_hierarchy: bool = True, props: dict = None, index: Optional[ModelIndex] = None,
+              draco: bool = False, draco_options: dict = None) -> int:
+    """
+    GLB counterpart of ``write_viewer_object``, writes the objects in the IFC hierarchy to ``fp``.
+
+    Meshes are written to a temporary file as soon as their object arrives from ``objects``,
+    only matrices are kept until the hierarchy is assembled. ``draco_options`` are passed to
+    ``DracoPy.encode`` (quantization_bits, compression_level, ...). Returns the number of written objects.
+    """
+    if props is None:
+        props = {'name': name}
+    if index is None:
+        index = ModelIndex.build(ifc_file)
+    hierarchy = ifcexport2.ifc_hierarchy.build_hierarchy(ifc_file, include_spatial_hierarchy=include_spatial_hierarchy,
+                                                         index=index)
+    with tempfile.TemporaryFile() as bin_fp:
+        builder = GlbBuilder(bin_fp, draco, draco_options)
+        # Mesh.uid -> glTF mesh index
+        meshes = {}
+        # product id -> (glTF mesh index, matrix)
+        placements = {}
+        for o in objects:
+            mesh_index = meshes.get(o.mesh.uid)
+            if mesh_index is None:
+                mesh_index = meshes[o.mesh.uid] = builder.add_mesh(o.mesh)
+            placements[o.id] = (mesh_index, np.asarray(o.transform, dtype=float).reshape((4, 4)))
+            del o
+
+        # Repeated meshes are drawn by instancing nodes, products with a sheared matrix keep their own mesh node
+        by_mesh = {}
+        for product_id, (mesh_index, _) in placements.items():
+            by_mesh.setdefault(mesh_index, []).append(product_id)
+        instanced = {}
+        instancing_nodes = []
+        for mesh_index, product_ids in by_mesh.items():
+            if len(product_ids) < 2:
+                continue
+            matrices = np.stack([placements[i][1] for i in product_ids])
+            valid = decompose_matrices(matrices)[3]
+            if valid.sum() < 2:
+                continue
+            ids = [i for i, v in zip(product_ids, valid) if v]
+            instancing_nodes.append(builder.add_instances(mesh_index, matrices[valid], {'ids': ids}))
+            instanced.update((i, len(instancing_nodes) - 1) for i in ids)
+
+        def make_leaf(obj_id, leaf_props):
+            placement = placements.get(obj_id)
+            if placement is None:
+                return None
+            node = {'name': str(leaf_props['name']), 'extras': leaf_props}
+            if obj_id not in instanced:
+                node['mesh'] = placement[0]
+                if not np.allclose(placement[1], IDENTITY):
+                    node['matrix'] = placement[1].flatten(order='F').tolist()
+            return {'node': node, 'userData': {'properties': leaf_props}}
+
+        tree = create_group(name, props)
+        _build_tree(tree,
+                    ifcexport2.ifc_hierarchy.clean_hierarchy(hierarchy, list(placements.keys())),
+                    ifc_file,
+                    make_leaf,
+                    ifcexport2.ifc_psets.PropsExtractor(ifc_file, index, views=True))
+
+        def add_tree(obj) -> int:
+            if 'node' in obj:
+                return builder.add_node(obj['node'])
+            node = {'name': str(obj['name']), 'extras': obj['userData']['properties']}
+            children = [add_tree(child) for child in obj['children']]
+            if children:
+                node['children'] = children
+            return builder.add_node(node)
+
+        root = add_tree(tree)
+        builder.gltf['nodes'][root]['rotation'] = Z_UP_TO_Y_UP
+        # Vertices are in the file length unit, glTF's is the metre
+        unit_scale = ifcopenshell.util.unit.calculate_unit_scale(ifc_file)
+        if unit_scale != 1.0:
+            builder.gltf['nodes'][root]['scale'] = [unit_scale] * 3
+        builder.gltf['nodes'][root].setdefault('children', []).extend(instancing_nodes)
+        builder.gltf['scenes'][0]['nodes'].append(root)
+        builder.write(fp, bin_fp)
+    return len(placements)
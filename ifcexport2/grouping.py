@@ -0,0 +1,148 @@
+"""
+Attribute based split of the viewer JSON.
+
+``partition.partition_viewer_json`` balances parts by size, so a part cuts across storeys and
+disciplines. Here the objects are grouped by what viewers ask for, one part per group (split
+further along the tree order if it exceeds a byte budget):
+
+- a property of the objects (``userData.properties``), e.g. ``type`` for the IFC class;
+- ``container:<IfcClass>``, the nearest spatial container of that class, e.g. ``storey``
+  (``container:IfcBuildingStorey``) or ``container:IfcBuilding``.
+
+An index of the parts is written next to them, so clients fetch only the parts they need::
+
+    {"by": "storey", "parts": [{"key": "1.OG", "part": 0, "uri": "model-3.viewer.json",
+                                "bounds": [[x, y, z], [x, y, z]], "objects": 97, "byteLength": 1048576}, ...]}
+
+Objects outside any group get the ``null`` key. Objects are placed by their world matrix directly
+under the part group, as the tiles of ``tiling``.
+
+>>> groups = group_leaves(root, 'storey')
+>>> write_groups('model.viewer.json', 'parts/', 'type', max_part_bytes=16 << 20)
+"""
+from __future__ import annotations
+
+import contextlib
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+import ujson
+
+from ifcexport2.partition import Node, partition_tree, flatten_leaves
+from ifcexport2.tiling import object_bounds, leaves_storage, leaves_viewer_json
+from ifcexport2.viewer_buffers import GeometryBuffer, BIN_SUFFIX, load_buffers
+
+CONTAINER_PREFIX = "container:"
+# Shorthands of the group keys
+ALIASES = {"storey": CONTAINER_PREFIX + "IfcBuildingStorey",
+           "building": CONTAINER_PREFIX + "IfcBuilding",
+           "site": CONTAINER_PREFIX + "IfcSite",
+           "class": "type"}
+INDEX_SUFFIX = ".index.json"
+
+
+def _props(obj: dict) -> dict:
+    return obj.get("userData", {}).get("properties", {})
+
+
+def group_leaves(root: dict, by: str) -> dict:
+    """
+    ``key -> indices`` of the ``tiling.viewer_leaves`` of ``root`` grouped ``by`` a property or a
+    container class (see the module), keys in the order of their first object.
+    Containers with the same name are told apart by their uuid: such keys are ``(name, uuid)``.
+    """
+    by = ALIASES.get(by, by)
+    container = by[len(CONTAINER_PREFIX):] if by.startswith(CONTAINER_PREFIX) else None
+    # uuid or property value -> indices, uuid -> name
+    groups = {}
+    names = {}
+
+    def inner(obj, group):
+        props = _props(obj)
+        if container is not None and props.get("type") == container:
+            group = obj["uuid"]
+            names[group] = props.get("name")
+        if obj.get("type") == "LOD" or "geometry" in obj:
+            key = group if container is not None else props.get(by)
+            # Unhashable property values are grouped by their JSON text
+            groups.setdefault(key if key is None or isinstance(key, (str, int, float, bool)) else ujson.dumps(key),
+                              []).append(len(leaves))
+            leaves.append(obj)
+        else:
+            for child in obj.get("children", ()):
+                inner(child, group)
+
+    leaves = []
+    inner(root["object"], None)
+    if container is None:
+        return groups
+    counts = {}
+    for name in names.values():
+        counts[name] = counts.get(name, 0) + 1
+    return {key if key is None else names[key] if counts[names[key]] == 1 else (names[key], key): indices
+            for key, indices in groups.items()}
+
+
+def split_groups(groups: dict, nbytes: np.ndarray, max_part_bytes: Optional[int] = None) -> list[tuple]:
+    """
+    ``(key, part, indices)`` per part: a group larger than ``max_part_bytes`` is cut into consecutive
+    runs of its objects with ``partition.partition_tree``.
+    """
+    parts = []
+    for key, indices in groups.items():
+        if max_part_bytes is None or nbytes[indices].sum() <= max_part_bytes:
+            parts.append((key, 0, indices))
+            continue
+        tree = Node(False, children=[Node(True, int(nbytes[k]), uid=k) for k in indices])
+        runs, _ = partition_tree(tree, max_part_bytes=max_part_bytes)
+        parts.extend((key, j, [leaf.uid for leaf in flatten_leaves(run)]) for j, run in enumerate(runs))
+    return parts
+
+
+def write_groups(input_path: Union[str, Path], output_dir: Union[str, Path], by: str, name: Optional[str] = None,
+                 max_part_bytes: Optional[int] = None, quantize: bool = False) -> list[Path]:
+    """
+    Split a viewer JSON file into ``output_dir`` by ``by`` (``group_leaves``, ``split_groups``):
+    ``<name>-<i>.viewer.json`` parts, their ``*.bin`` if the input has external buffers and the
+    ``<name>.index.json`` index, the last of the returned paths. ``quantize`` is as in
+    ``partition.partition_viewer_json``, ``name`` defaults to the input name without suffixes.
+    """
+    input_path = Path(input_path)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if name is None:
+        name = input_path.name.split(".")[0]
+    with input_path.open("r") as f:
+        root = ujson.load(f)
+    buffers = load_buffers(root, input_path.parent)
+    external = any(not b["uri"].startswith("data:") for b in root.get("buffers", ()))
+    leaves, bounds, nbytes = object_bounds(root, buffers)
+    parts = split_groups(group_leaves(root, by), nbytes, max_part_bytes)
+    storage = leaves_storage(root)
+    outputs = []
+    index = []
+
+    for i, (key, j, indices) in enumerate(parts):
+        with contextlib.ExitStack() as stack:
+            buffer = None
+            if external:
+                bin_path = output_dir / f"{name}-{i}.viewer{BIN_SUFFIX}"
+                outputs.append(bin_path)
+                buffer = GeometryBuffer(stack.enter_context(bin_path.open("wb")), bin_path.name)
+            label = list(key) if isinstance(key, tuple) else key
+            jsn = leaves_viewer_json(root, storage, [leaves[k] for k in indices], f"{name}-{i}",
+                                     {"part": name, "key": label}, buffers, buffer, quantize)
+            uri = f"{name}-{i}.viewer.json"
+            with (output_dir / uri).open("w") as f:
+                ujson.dump(jsn, f, ensure_ascii=False)
+            outputs.append(output_dir / uri)
+        index.append({"key": label, "part": j, "uri": uri,
+                      "bounds": [bounds[indices, 0].min(axis=0).tolist(), bounds[indices, 1].max(axis=0).tolist()],
+                      "objects": len(indices), "byteLength": int(nbytes[indices].sum())})
+
+    index_path = output_dir / f"{name}{INDEX_SUFFIX}"
+    with index_path.open("w") as f:
+        ujson.dump({"by": by, "parts": index}, f, ensure_ascii=False)
+    outputs.append(index_path)
+    return outputs
@@ -3,6 +3,9 @@ from typing import NamedTuple, List, Dict, Optional, Tuple
 
 
 import ifcopenshell
+import numpy as np
+
+from ifcexport2.model_index import ModelIndex
 
 
 class Hierarchy(NamedTuple):
@@ -11,13 +14,14 @@ class Hierarchy(NamedTuple):
 
 
 
-def build_hierarchy( ifc_model:ifcopenshell.file, include_spatial_hierarchy:bool=True
+def build_hierarchy( ifc_model:ifcopenshell.file, include_spatial_hierarchy:bool=True, index:Optional[ModelIndex]=None
 )->Hierarchy:
     """
     Build a hierarchy of ifc entities and determine root elements.
 
     Args:
         ifc_model (ifcopenshell.file): The IFC file object.
+        index (ModelIndex, optional): Index of ``ifc_model``, the relationships are read from it if passed.
 
 
     Returns:
@@ -26,6 +30,9 @@ def build_hierarchy( ifc_model:ifcopenshell.file, include_spatial_hierarchy:bool
                root element ids (those not child of any element).
 
     """
+    if index is not None:
+        edges = index.hierarchy_edges(include_spatial_hierarchy)
+        return Hierarchy(index.children(include_spatial_hierarchy), np.setdiff1d(edges[:, 0], edges[:, 1]).tolist())
     assembly_hierarchy = {}
     # Keep track of all elements that appear as a child in any assembly.
     all_ids = set()
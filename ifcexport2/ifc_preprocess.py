@@ -3,9 +3,12 @@ from abc import ABC
 from collections.abc import Callable
 
 import ifcopenshell
+import numpy as np
 from typing import Generator, runtime_checkable, Optional, NamedTuple
 from typing import Generator
 from ifcopenshell.entity_instance import entity_instance
+
+from ifcexport2.model_index import ModelIndex
 IfcEntityInstance = entity_instance
 IfcProductStream = Generator[IfcEntityInstance, None, None]
 
@@ -19,6 +22,114 @@ def iter_products_with_repr(ifc, excluded_types=None) -> IfcProductStream:
         if getattr(p, "Representation", None):
             yield p
 
+
+class SelectionError(ValueError):
+    """Product filters referring to GlobalIds or IFC classes that are not in the file or its schema."""
+
+
+def _by_guids(ifc, global_ids, what: str) -> list[IfcEntityInstance]:
+    entities = []
+    unknown = []
+    for global_id in global_ids:
+        try:
+            entities.append(ifc.by_guid(global_id))
+        except RuntimeError:
+            unknown.append(global_id)
+    if unknown:
+        raise SelectionError(f"Unknown {what}: {', '.join(map(str, unknown))}")
+    return entities
+
+
+def _by_types(ifc, types) -> list[list[IfcEntityInstance]]:
+    entities = []
+    unknown = []
+    for typ in types:
+        try:
+            entities.append(ifc.by_type(typ))
+        except RuntimeError:
+            unknown.append(typ)
+    if unknown:
+        raise SelectionError(f"Unknown IFC classes in {ifc.schema}: {', '.join(map(str, unknown))}")
+    return entities
+
+
+def _container_elements(ifc, container_ids) -> set[int]:
+    """Ids of all elements contained in or decomposing the given spatial containers (GlobalIds), recursively."""
+    import ifcopenshell.util.element
+    ids = set()
+    for container in _by_guids(ifc, container_ids, "containers"):
+        ids.add(container.id())
+        ids.update(e.id() for e in ifcopenshell.util.element.get_decomposition(container))
+    return ids
+
+
+def _context_matches(rep, contexts) -> bool:
+    # Exporters disagree on where 'Body' goes (ArchiCAD writes it to RepresentationIdentifier
+    # of representations in a 'Plan' context), so all three are matched.
+    ctx = rep.ContextOfItems
+    return rep.RepresentationIdentifier in contexts or ctx.ContextIdentifier in contexts or ctx.ContextType in contexts
+
+
+def _has_context(product, contexts) -> bool:
+    return any(_context_matches(rep, contexts) for rep in product.Representation.Representations)
+
+
+def context_ids(products, contexts) -> list[int]:
+    """
+    Ids of the representation contexts of the ``products`` representations matching ``contexts``
+    (see ``select_products``), for the ``context-ids`` iterator setting.
+    """
+    contexts = set(contexts)
+    return sorted({rep.ContextOfItems.id() for p in products for rep in p.Representation.Representations
+                   if _context_matches(rep, contexts)})
+
+
+def select_products(ifc,
+                    excluded_types=None,
+                    included_types=None,
+                    global_ids=None,
+                    excluded_global_ids=None,
+                    containers=None,
+                    contexts=None,
+                    index:Optional[ModelIndex]=None) -> list[IfcEntityInstance]:
+    """
+    Products with a Representation that pass all the given filters, this is the selection that
+    is passed to the geometry iterator with ``include=``, so filtered out products are never tessellated.
+
+    ``included_types`` match subtypes (IfcWall includes IfcWallStandardCase), ``excluded_types`` match
+    exact types. ``containers`` are GlobalIds of spatial elements (storeys, buildings, ...), their whole
+    decomposition is selected. ``contexts`` are representation identifiers or representation context
+    identifiers or types ('Body', 'Model').
+    With an ``index``, the products with a Representation are taken from it instead of checking every IfcProduct.
+    ``SelectionError`` if ``global_ids``, ``containers`` or ``included_types`` are not in the file or its schema.
+    """
+    if global_ids:
+        products = []
+        for p in _by_guids(ifc, global_ids, "GlobalIds"):
+            if p.is_a("IfcProduct") and getattr(p, "Representation", None):
+                products.append(p)
+    elif included_types:
+        seen = set()
+        products = []
+        for of_type in _by_types(ifc, included_types):
+            for p in of_type:
+                if p.id() not in seen and getattr(p, "Representation", None):
+                    seen.add(p.id())
+                    products.append(p)
+    elif index is not None:
+        products = [ifc.by_id(i) for i in index.products(excluded_types).tolist()]
+    else:
+        products = list(iter_products_with_repr(ifc, excluded_types))
+    excluded_types = set(excluded_types or ())
+    excluded_global_ids = set(excluded_global_ids or ())
+    contained = _container_elements(ifc, containers) if containers else None
+    contexts = set(contexts or ())
+    return [p for p in products
+            if p.is_a() not in excluded_types
+            and p.GlobalId not in excluded_global_ids
+            and (contained is None or p.id() in contained)
+            and (not contexts or _has_context(p, contexts))]
+
 from ifcopenshell.util.unit import calculate_unit_scale, get_project_unit, convert_file_length_units, get_unit_symbol,convert_unit, \
     get_unit_name, get_full_unit_name
 
@@ -28,21 +139,31 @@ class IfcProductInfo(NamedTuple):
     categories:set[str]
     product_count:int
 class ProductInfoExtractor:
-    def __init__(self, excluded_types:list[str]=None) -> None:
+    def __init__(self, excluded_types:list[str]=None, products:list[IfcEntityInstance]=None) -> None:
         self.categories = set()
         self.product_count: int = 0
         self.excluded_types = excluded_types if excluded_types is not None else []
+        self.products = products
         
         
     def categories_callback(self, product:IfcEntityInstance) -> None:
-        self.categories.add(product.get_info().get('type',None))
+        self.categories.add(product.is_a())
     def products_count_callback(self, product:IfcEntityInstance) -> None:
         self.product_count += 1
     
-    def build(self, ifc_file:ifcopenshell.file)->IfcProductInfo:
+    def build(self, ifc_file:ifcopenshell.file, index:Optional[ModelIndex]=None)->IfcProductInfo:
         self.categories = set()
         self.product_count = 0
-        iterator=iter_products_with_repr(ifc_file,set(self.excluded_types))
+        if index is not None:
+            if self.products is not None:
+                ids = np.array([p.id() for p in self.products], dtype=np.int64)
+            else:
+                ids = index.products(self.excluded_types)
+            return IfcProductInfo(set(index.categories(ids)), len(ids))
+        if self.products is not None:
+            iterator=iter(self.products)
+        else:
+            iterator=iter_products_with_repr(ifc_file,set(self.excluded_types))
         for product in iterator:
             self.categories_callback(product)
             self.products_count_callback(product)
@@ -104,10 +225,11 @@ class IfcInfo:
     
     
 
-def preprocess_ifc(ifc_file:ifcopenshell.file, excluded_types:list[str]=None)->IfcInfo:
+def preprocess_ifc(ifc_file:ifcopenshell.file, excluded_types:list[str]=None, products:list[IfcEntityInstance]=None, index:Optional[ModelIndex]=None)->IfcInfo:
+    """``products`` is the selection to be converted (see ``select_products``), it replaces ``excluded_types`` if passed."""
     if excluded_types is None:
         excluded_types = []
-    extractor=ProductInfoExtractor(excluded_types)
-    info=extractor.build(ifc_file)
+    extractor=ProductInfoExtractor(excluded_types, products)
+    info=extractor.build(ifc_file, index)
     unit_type: str = "LENGTHUNIT"
     return IfcInfo(IfcUnitInfo(ifc_file, unit_type=unit_type),list(info.categories),info.product_count)
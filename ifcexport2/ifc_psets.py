@@ -1,12 +1,15 @@
 from __future__ import annotations
 
+import collections
 import ifcopenshell
 import ifcopenshell.entity_instance
 from ifcopenshell.entity_instance import entity_instance
 import ifcopenshell.util.element
-from typing import Any, Dict, AnyStr
+from typing import Any, Dict, AnyStr, Optional
 import re
 
+from ifcexport2.model_index import ModelIndex
+
 Psets=Dict[str,Dict[str,Any]]
 FlatProps=Dict[str,Any]
 def extract_psets(ifc_element)->Psets:
@@ -14,6 +17,21 @@ def extract_psets(ifc_element)->Psets:
     psets =ifcopenshell.util.element.get_psets(ifc_element)
     return psets
 
+def extract_indexed_psets(ifc_element, ifc_model:ifcopenshell.file, index:ModelIndex)->Psets:
+    """Same as ``extract_psets``, with the property and type relationships looked up in ``index``."""
+    if ifc_element.is_a('IfcTypeObject') or not hasattr(ifc_element, 'IsDefinedBy'):
+        return extract_psets(ifc_element)
+    psets = {}
+    # Type psets first, the occurrence psets override them
+    type_id = index.object_types.get(ifc_element.id())
+    if type_id is not None:
+        for definition in ifc_model.by_id(type_id).HasPropertySets or ():
+            psets.setdefault(definition.Name, {}).update(ifcopenshell.util.element.get_property_definition(definition))
+    for definition_id in index.property_definitions.get(ifc_element.id(), ()):
+        definition = ifc_model.by_id(definition_id)
+        psets.setdefault(definition.Name, {}).update(ifcopenshell.util.element.get_property_definition(definition))
+    return psets
+
 def psets_flatten(psets:Psets)->FlatProps:
     flat_props=dict()
     for name, pset in psets.items():
@@ -37,20 +55,89 @@ def camel_to_space(s: str) -> str:
     # that is not at the beginning. The re.sub() then inserts a space at those positions.
     return re.sub(r'(?<!^)(?=[A-Z])', ' ', s)
 
-def extract_props(element_id:int,ifc_model:ifcopenshell.file, additional_props:dict=None)->FlatProps:
+def extract_props(element_id:int,ifc_model:ifcopenshell.file, additional_props:dict=None, index:Optional[ModelIndex]=None)->FlatProps:
     ifc_object=ifc_model.by_id(element_id)
-    props=psets_flatten(extract_psets(ifc_object))
+    if index is not None:
+        props=psets_flatten(extract_indexed_psets(ifc_object,ifc_model,index))
+    else:
+        props=psets_flatten(extract_psets(ifc_object))
+    _update_object_props(props, ifc_object, element_id, additional_props)
+    return props
+
 
-    info=ifc_object.get_info()
-    props['name'] = info.get('Name')
+def _update_object_props(props, ifc_object, element_id:int, additional_props:dict=None):
+    # Attributes are read directly, get_info() would build the dict of all attributes
+    props['name'] = getattr(ifc_object,'Name',None)
 
-    props['type'] = info.get('type')
-    props['id'] = info.get('id')
-    props['description']=info.get('Description')
+    props['type'] = ifc_object.is_a()
+    props['id'] = element_id
+    props['description']=getattr(ifc_object,'Description',None)
     if additional_props:
         props.update(additional_props)
 
     if props['name']=='Undefined':
         props['name']=camel_to_space('Undefined'+props['type'].replace("Ifc",''))
 
-    return props
\ No newline at end of file
+
+class PropsExtractor:
+    """
+    Bulk counterpart of ``extract_props``.
+
+    The property and type relationships are inverted once (see ``ModelIndex``) and every property
+    set is read and flattened once, then shared by all objects it is assigned to: the property sets
+    of a type are flattened once for all its occurrences.
+
+    With ``views=True`` the props of an object are a ChainMap of a small dict of its own (name, type,
+    id, ...) over the shared property set dicts. Serialize them with ``default=dict``. Otherwise each
+    object gets a new dict.
+
+    >>> extractor = PropsExtractor(ifc_file, index)
+    >>> extractor.props(wall.id(), {'parent_id': storey.id()}) == extract_props(wall.id(), ifc_file, {'parent_id': storey.id()})
+    True
+    """
+    def __init__(self, ifc_model:ifcopenshell.file, index:Optional[ModelIndex]=None, views:bool=False):
+        self.ifc_model = ifc_model
+        self.index = index if index is not None else ModelIndex.build(ifc_model)
+        self.views = views
+        # property definition id -> flattened properties
+        self._definitions: dict[int, FlatProps] = {}
+        # type object id -> flattened property sets of the type
+        self._types: dict[int, list[FlatProps]] = {}
+
+    def _definition(self, definition) -> FlatProps:
+        flat = self._definitions.get(definition.id())
+        if flat is None:
+            flat = psets_flatten({definition.Name: ifcopenshell.util.element.get_property_definition(definition)})
+            self._definitions[definition.id()] = flat
+        return flat
+
+    def _type_psets(self, type_id:int) -> list[FlatProps]:
+        flats = self._types.get(type_id)
+        if flats is None:
+            flats = [self._definition(d) for d in self.ifc_model.by_id(type_id).HasPropertySets or ()]
+            self._types[type_id] = flats
+        return flats
+
+    def psets(self, ifc_element) -> list[FlatProps]:
+        """Shared flattened property sets of the element, in the order ``get_psets`` merges them (later ones win)."""
+        if ifc_element.is_a('IfcTypeObject') or not hasattr(ifc_element, 'IsDefinedBy'):
+            return [psets_flatten(extract_psets(ifc_element))]
+        flats = []
+        type_id = self.index.object_types.get(ifc_element.id())
+        if type_id is not None:
+            flats.extend(self._type_psets(type_id))
+        for definition_id in self.index.property_definitions.get(ifc_element.id(), ()):
+            flats.append(self._definition(self.ifc_model.by_id(definition_id)))
+        return flats
+
+    def props(self, element_id:int, additional_props:dict=None) -> FlatProps:
+        ifc_object = self.ifc_model.by_id(element_id)
+        flats = self.psets(ifc_object)
+        if self.views:
+            props = collections.ChainMap({}, *reversed(flats))
+        else:
+            props = {}
+            for flat in flats:
+                props.update(flat)
+        _update_object_props(props, ifc_object, element_id, additional_props)
+        return props
\ No newline at end of file
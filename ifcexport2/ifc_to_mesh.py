@@ -1,17 +1,27 @@
 from __future__ import annotations
 
 import argparse
+import contextlib
 import dataclasses
 import gc
+import itertools
 import json
 import os
 
 import rich
 
-from ifcexport2.ifc_preprocess import preprocess_ifc, IfcInfo
+from ifcexport2.ifc_preprocess import preprocess_ifc, IfcInfo, iter_products_with_repr, select_products, context_ids
+from ifcexport2.model_index import ModelIndex
+from ifcopenshell.entity_instance import entity_instance
 from ifcexport2.mesh_to_three import create_three_js_root, mesh_to_three, add_mesh, create_group, get_property, \
-    add_material, material, default_material, add_geometry, color_attr_material
+    add_material, material, default_material, add_geometry, color_attr_material, _mesh_object, geometry_material, \
+    lod_to_three
+from ifcexport2.quantize import apply_decode_matrix
 from ifcexport2.mesh import Mesh
+from ifcexport2.viewer_writer import ViewerJsonWriter
+from ifcexport2.viewer_buffers import Buffer, GeometryBuffer, EmbeddedBuffer, encode_geometry, BIN_SUFFIX
+from ifcexport2.tess_cache import TessellationCache, RepresentationHasher, cache_uid
+from ifcexport2.incremental import ConversionManifest, PreviousConversion, convert_incremental, MANIFEST_SUFFIX
 import multiprocessing
 import sys
 import traceback
@@ -22,9 +32,11 @@ import ifcopenshell.geom
 import ifcopenshell.util.element
 from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List, Tuple, Union, Literal, NamedTuple, Any, Optional, Iterator
+from typing import List, Tuple, Union, Literal, NamedTuple, Any, Optional, Iterator, Iterable
 from typing import Protocol
-from ifcexport2.models import IRGeometryObject, ImportFailList, IfcFail
+from ifcexport2.models import IRGeometryObject, ImportFailList, IfcFail, ProductFail, FailAttempt
+from ifcexport2.robust import RobustPolicy, process_isolated_geometry_items
+from ifcexport2.deflection import classify_products
 NO_OCC=bool(os.getenv("NO_OCC",0))
 from ifcexport2.settings import ifcopenshell_default_settings_dict  as settings_dict
 
@@ -61,8 +73,7 @@ class ConvertResult:
     success: bool
     objects: list[IRGeometryObject]
     info: IfcInfo
-    
-    # fails:ImportFailList
+    fails: ImportFailList = dataclasses.field(default_factory=list)
 
 
 @dataclasses.dataclass(slots=True, frozen=True)
@@ -70,6 +81,25 @@ class ConvertArguments:
     excluded_types: list[str] = dataclasses.field(default_factory=lambda :["IfcSpace","IfcOpeningElement"])
     name: str = "Model",
     target_units:Optional[str]=None
+    instancing: bool = False
+    # Filters pushed down to the geometry iterator, see ifc_preprocess.select_products
+    included_types: Optional[list[str]] = None
+    global_ids: Optional[list[str]] = None
+    excluded_global_ids: Optional[list[str]] = None
+    containers: Optional[list[str]] = None
+    contexts: Optional[list[str]] = None
+    # Tessellate small products and some categories with coarser deflection, see ifcexport2.deflection
+    adaptive_deflection: bool = False
+
+    def select_products(self, ifc_file: ifcopenshell.file, index: Optional[ModelIndex] = None) -> list[entity_instance]:
+        return select_products(ifc_file,
+                               index=index,
+                               excluded_types=self.excluded_types,
+                               included_types=self.included_types,
+                               global_ids=self.global_ids,
+                               excluded_global_ids=self.excluded_global_ids,
+                               containers=self.containers,
+                               contexts=self.contexts)
     
     
 
@@ -81,6 +111,37 @@ from tqdm import tqdm
 from ifcopenshell.util.unit import convert_file_length_units, convert_unit
 from ifcopenshell.util.unit import convert as ifcopsh_convert
 OUTPUT_UNITS = "MILLIMETER"
+
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class ConvertStream:
+    objects: Iterator[IRGeometryObject]
+    info: IfcInfo
+    ifc_file: ifcopenshell.file
+    # Products that failed, filled while ``objects`` is consumed
+    fails: ImportFailList = dataclasses.field(default_factory=list)
+    index: Optional[ModelIndex] = None
+
+
+def geom_settings(settings: dict) -> ifcopenshell.geom.settings:
+    used_settings = ifcopenshell.geom.settings()
+    for k, v in settings.items():
+        # Constant names (USE_WORLD_COORDS) or setting names ('context-ids')
+        used_settings.set(getattr(used_settings, k, k), v)
+    return used_settings
+
+
+def effective_settings(args: ConvertArguments, settings: dict = None) -> dict:
+    """Iterator settings actually used for ``args``: ``settings`` (defaults if None) with the overrides required by the arguments."""
+    if settings is None:
+        settings = {**settings_dict}
+    if args.instancing:
+        # Tessellate in local coordinates so that products sharing a representation
+        # get the same geometry id, placement goes to IRGeometryObject.transform.
+        settings = {**settings, 'USE_WORLD_COORDS': False}
+    return settings
+
+
 def convert(
         ifc_file:ifcopenshell.file,
     args: ConvertArguments,
@@ -88,46 +149,113 @@ def convert(
     threads=None,
     verbose=False,
 backend=None,
-    
+    cache: Optional[TessellationCache] = None,
 ) -> ConvertResult:
-    
-    if settings is None:
-        if verbose:
-            rich.print(f"Using default settings.")
-        settings={**settings_dict}
-        if verbose:
-            rich.print(settings)
-    info = preprocess_ifc(ifc_file, args.excluded_types)
-    print(info)
+    stream = convert_stream(ifc_file, args, settings=settings, threads=threads, verbose=verbose, backend=backend, cache=cache)
+    items=list(stream.objects)
+
+    return ConvertResult(len(items)>0,items,stream.info,stream.fails)
+
+
+def convert_stream(
+        ifc_file: ifcopenshell.file,
+        args: ConvertArguments,
+        settings: dict = None,
+        threads=None,
+        verbose=False,
+        backend=None,
+        cache: Optional[TessellationCache] = None,
+        products: Optional[list[entity_instance]] = None,
+        robust: Optional[RobustPolicy] = None,
+        index: Optional[ModelIndex] = None,
+) -> ConvertStream:
+    """
+    Same as ``convert``, but the geometry objects are produced lazily.
+
+    Nothing is tessellated until ``objects`` is iterated, and each IRGeometryObject can be
+    released as soon as it is consumed (see ``write_viewer_object``).
+    With a ``cache``, products found in it are not sent to the geometry iterator.
+    ``products`` restricts the conversion to the given products, by default the products
+    selected by the filters of ``args`` are converted. Filtered out products are never
+    passed to the geometry iterator.
+    With a ``robust`` policy, the products the iterator fails on are retried in isolation
+    (see ``ifcexport2.robust``).
+    The ``index`` of the file is built if not passed, it is returned with the stream for
+    ``write_viewer_object``.
+    """
+    if settings is None and verbose:
+        rich.print(f"Using default settings.")
+        rich.print(settings_dict)
+    settings = effective_settings(args, settings)
     if args.target_units is not None:
         ifc_file = convert_file_length_units(ifc_file, args.target_units)
-        info = preprocess_ifc(ifc_file, args.excluded_types)
-        print('info new',info)
-    used_settings = ifcopenshell.geom.settings()
+        index = None
+    if index is None:
+        index = ModelIndex.build(ifc_file)
+    if products is None:
+        products = args.select_products(ifc_file, index)
+    if args.contexts:
+        # Only the selected contexts are tessellated, not every representation of the products
+        settings = {**settings, 'context-ids': context_ids(products, args.contexts)}
+    info = preprocess_ifc(ifc_file, args.excluded_types, products=products, index=index)
+    print(info)
+    used_settings = geom_settings(settings)
     if threads is None:
         threads = multiprocessing.cpu_count() - 1
     threads=int(threads)
     threads = max(threads, 1)
-    for k, v in settings.items():
-        used_settings.set(getattr(used_settings, k), v)
     #used_settings.set("convert-back-units", True)
     if verbose:
         rich.print(f"Using {threads} threads for processing.")
         rich.print(f"settings:\n{used_settings}")
-    if backend is not None:
-        iterator = ifcopenshell.geom.iterator(
-            used_settings,
+    fails = []
+
+    def tessellate_with(selection, selection_settings):
+        selection_geom_settings = used_settings if selection_settings is settings else geom_settings(selection_settings)
+
+        def make_iterator(**kwargs):
+            if backend is not None:
+                kwargs['geometry_library'] = backend
+            return ifcopenshell.geom.iterator(selection_geom_settings, ifc_file, num_threads=threads, **kwargs)
+
+        def tessellate(selection):
+            if robust is not None:
+                return process_isolated_geometry_items(ifc_file, selection, make_iterator, selection_settings,
+                                                       excluded_types=args.excluded_types,
+                                                       instancing=args.instancing,
+                                                       policy=robust,
+                                                       fails=fails)
+            return process_ifc_geometry_items(
+                geom_iterator=make_iterator(include=selection),
+                excluded_types=args.excluded_types,
+                instancing=args.instancing,
+                fails=fails,
+            )
+
+        if cache is None:
+            return tessellate(selection)
+        return process_cached_geometry_items(
             ifc_file,
-            num_threads=threads,
-            geometry_library=backend,
+            cache,
+            RepresentationHasher(ifc_file, selection_settings, backend),
+            tessellate,
+            excluded_types=args.excluded_types,
+            instancing=args.instancing,
+            products=selection,
         )
+
+    if len(products) == 0:
+        itr = iter(())
+    elif args.adaptive_deflection:
+        # One iterator per deflection class, see ifcexport2.deflection
+        classes = classify_products(ifc_file, products)
+        if verbose:
+            rich.print("Deflection classes: " + ", ".join(
+                f"{'default' if c is None else c.name} {len(selection)}" for c, selection in classes))
+        itr = itertools.chain.from_iterable(
+            tessellate_with(selection, settings if c is None else c.settings(settings)) for c, selection in classes)
     else:
-        iterator = ifcopenshell.geom.iterator(used_settings, ifc_file, num_threads=threads)
-    itr = process_ifc_geometry_items(
-        geom_iterator=iterator,
-        excluded_types=args.excluded_types,
-    
-    )
+        itr = tessellate_with(products, settings)
     if verbose:
         total = info.product_count
         # --- pre-count only metadata (very fast, no geometry)
@@ -139,11 +267,8 @@ backend=None,
             colour="#1d6acf",
             total=total,
         )
-    items=list(itr)
-    
-  
-        
-    return ConvertResult(len(items)>0,items,info)
+
+    return ConvertStream(itr, info, ifc_file, fails, index)
 
 
 def safe_call_fast_convert(
@@ -153,38 +278,30 @@ def safe_call_fast_convert(
     threads=None,
     settings: dict = None,
     verbose: bool = False,
-):
+    policy: Optional[RobustPolicy] = None,
+) -> ConvertResult:
+    """
+    Convert with per-product fallback and write the viewer JSON to ``mesh_file_path``.
+    Products that fail the main pass are retried in isolation with ``policy``, those that
+    fail every retry are returned in ``ConvertResult.fails``.
+    """
     if excluded_types is None:
         excluded_types = ["IfcSpace", "IfcOpeningElement"]
-
-    with ProcessPoolExecutor(max_workers=1) as executor:
-        future = executor.submit(
-            convert,
-            ConvertArguments(
-                ifc_string,
-                backend=None,
-                excluded_types=excluded_types,
-                settings=settings,
-                mesh_file_path=mesh_file_path,
-            ),
-            verbose=verbose,
-            threads=threads,
-        )
-        try:
-
-            return future.result()
-        except Exception as e:
-            print(f"Fast method failed with exception: {e}")
-            return convert(
-                ConvertArguments(
-                    ifc_string,
-                    excluded_types=excluded_types,
-                    settings=settings,
-                    mesh_file_path=mesh_file_path,
-                ),
-                threads=1,
-                verbose=verbose,
-            )
+    if policy is None:
+        policy = RobustPolicy()
+    ifc_file = ifc_loads(ifc_string)
+    stream = convert_stream(
+        ifc_file,
+        ConvertArguments(excluded_types=excluded_types),
+        settings=settings,
+        threads=threads,
+        verbose=verbose,
+        robust=policy,
+    )
+    objects = list(stream.objects)
+    with open(mesh_file_path, 'w') as f:
+        write_viewer_object(f, Path(mesh_file_path).stem, objects, stream.ifc_file, index=stream.index)
+    return ConvertResult(len(objects) > 0, objects, stream.info, stream.fails)
 
 
 import ifcopenshell.util
@@ -234,52 +351,74 @@ def extract_color(itm):
             yield _color.r(), _color.g(), _color.b()
 
 
+def extract_colors(geom) -> np.ndarray:
+    """
+    Diffuse RGB colours of all materials of the triangulation as a (materials, 3) float32 array.
+    ``colors_buffer`` stores RGBA doubles per material.
+    """
+    return np.frombuffer(geom.colors_buffer, dtype=np.float64).reshape((-1, 4))[:, :3].astype(np.float32)
+
+
 def parse_geom_item(
-        item: TriangulationElement, scale: float = 1.0
+        item: TriangulationElement, scale: float = 1.0, mesh: Optional[Mesh] = None
 ) -> Tuple[bool, IRGeometryObject, Union[Mesh, Tuple[str, str]]]:
+    """
+    Parse a shape produced by the geometry iterator.
+
+    If ``mesh`` is passed (a mesh already parsed from a shape with the same geometry id),
+    it is reused as is and only the object data and transformation are read from ``item``.
+    """
     typ = item.type
-    trx =  (np.reshape(item.transformation.matrix, (4, 4), order="F"),)
+    trx = np.reshape(item.transformation.matrix, (4, 4), order="F")
+    if scale != 1.0:
+        trx[:3, 3] *= scale
     product_id = item.id
     name = item.name
     parent_id = item.parent_id
     context = item.context
+    geometry_id = item.geometry.id
+
+    if mesh is not None:
+        return True, IRGeometryObject(
+            id=product_id,
+            type=typ,
+            name=name,
+            context=context,
+            parent_id=parent_id,
+            mesh=mesh,
+            transform=trx,
+            geometry_id=geometry_id,
+        ), mesh
 
-    materials_colors = np.array(list(extract_color(item)), dtype=np.float32)
     try:
         geom = item.geometry
-        faces = geom.faces
-        verts = geom.verts
-        #normals = geom.normals
-        single_color = True
-
-        verts = np.array(verts, dtype=np.float32).reshape((len(verts) // 3, 3))
-        # normals = np.array(normals, dtype=np.float32).reshape((len(normals) // 3, 3))
-        faces = np.array(faces, dtype=int).reshape((len(faces) // 3, 3))
-        # if set(geom.material_ids).__len__()==1:
-        #    single_color = True
-        #    color=materials_colors[0]
-        #    colors=np.zeros_like(verts)
-        #    colors[...,:]=color
-        #    #verts =  np.repeat(np.array(verts, dtype=np.float32).reshape((len(verts) // 3, 3)), 3, axis=0)
-        #    #normals = np.array(normals, dtype=np.float32).reshape((len(normals) // 3, 3))
-        #    #faces = np.array(faces, dtype=int).reshape((len(faces)//3,3))
-        #
-
-        single_color = False
-
-        cols = materials_colors[np.array(geom.material_ids, dtype=int)]
-        ccols = cols[np.arange(faces.shape[0]).repeat(3)]
-        
-        colors = np.zeros_like(verts)
-        colors[faces] = ccols.reshape((*faces.shape, 3))
+        # The *_buffer accessors return the C++ arrays as bytes, np.frombuffer views them
+        # without building Python tuples of floats/ints.
+        verts = np.frombuffer(geom.verts_buffer, dtype=np.float64).reshape((-1, 3)).astype(np.float32)
+        faces = np.frombuffer(geom.faces_buffer, dtype=np.int32).reshape((-1, 3))
+        material_ids = np.frombuffer(geom.material_ids_buffer, dtype=np.int32)
+        materials_colors = extract_colors(geom)
+
+        if materials_colors.shape[0] == 0:
+            colors = None
+        else:
+            # One gather per product: material colour of each face, written to its vertices.
+            colors = np.zeros_like(verts)
+            colors[faces] = materials_colors[material_ids][:, np.newaxis, :]
+
+        if scale != 1.0:
+            verts = verts * scale
 
         msh = Mesh(
-                verts * scale,
+                verts,
                 faces=faces,
                 # color=tuple(np.array(materials_colors[0]*255,dtype=int)),
                 # normals=normals,
                 colors=colors,
-                uid=product_id,
+                uid=geometry_id,
+                # Kept for material groups, see mesh_to_three
+                material_ids=None if colors is None else material_ids,
+                materials=None if colors is None else materials_colors,
             )
 
 
@@ -291,6 +430,7 @@ def parse_geom_item(
             parent_id=parent_id, mesh=msh,
 
             transform=trx,
+            geometry_id=geometry_id,
         )
         return True, ifc_object, msh
     except RuntimeError as err:
@@ -302,6 +442,7 @@ def parse_geom_item(
             parent_id=parent_id,
             mesh=None,
             transform=trx,
+            geometry_id=geometry_id,
         )
         print(err)
         tb = traceback.format_exc()
@@ -311,34 +452,95 @@ def parse_geom_item(
 def process_ifc_geometry_items(
     geom_iterator,
     excluded_types: list[str],
-
+    instancing: bool = False,
+    fails: Optional[ImportFailList] = None,
     **kwargs,
 ):
+    """
+    Yield IRGeometryObject for each shape of the geometry iterator.
 
+    With ``instancing=True`` the iterator is expected to run in local coordinates: shapes
+    with the same geometry id are parsed once and share a single Mesh.
+    Shapes that fail in ``parse_geom_item`` are appended to ``fails`` as ProductFail.
+    """
+    meshes: dict[str, Mesh] = {}
     if geom_iterator.initialize():
         i = 0
         j = 0
-        while geom_iterator.next():
+        while True:
             # if print_items:
             # print(f"Reading IFC: {i}", flush=True, end="\r")
             i += 1
+            # initialize() already positions the iterator on the first shape
             shape = geom_iterator.get()
             if shape.type not in excluded_types:
                 success, obj, mesh_or_tb = parse_geom_item(
-                    shape
+                    shape,
+                    mesh=meshes.get(shape.geometry.id) if instancing else None
                 )
-              
+                if success and instancing:
+                    meshes[obj.geometry_id] = obj.mesh
+
                 if success:
                     yield obj
                 else:
                     rich.print(f'[red][bold]import fail: {obj}[/bold][/red]')
-                
+                    if fails is not None:
+                        fails.append(ProductFail(obj.id, shape.guid, obj.type, obj.name,
+                                                 [FailAttempt('main', 'error', mesh_or_tb[1])]))
+            if not geom_iterator.next():
+                break
+
         return None
     else:
         rich.print('[red][bold]geometry iterator are not initialized![/bold][/red]')
         return None
 
 
+def process_cached_geometry_items(
+    ifc_file: ifcopenshell.file,
+    cache: TessellationCache,
+    hasher: RepresentationHasher,
+    tessellate,
+    excluded_types: list[str],
+    instancing: bool = False,
+    products: Optional[list[entity_instance]] = None,
+):
+    """
+    Yield IRGeometryObject for each product, taking the geometry from ``cache`` when possible.
+    Only the misses are tessellated with ``tessellate(products)`` and then stored in the cache.
+    """
+    keys = {}
+    hits = []
+    misses = []
+    meshes: dict[str, Mesh] = {}
+    if products is None:
+        products = iter_products_with_repr(ifc_file, excluded_types)
+    for product in products:
+        key = hasher.product_key(product)
+        entry = cache.get(key)
+        if entry is None:
+            keys[product.id()] = key
+            misses.append(product)
+            continue
+        hits.append(product)
+        # Not the geometry id of the file the entry was tessellated from, see tess_cache
+        uid = cache_uid(entry)
+        obj = cache.load_object(entry, product, meshes.get(uid) if instancing else None)
+        if instancing:
+            meshes[uid] = obj.mesh
+        yield obj
+    if not keys:
+        return None
+    for obj in tessellate(misses):
+        key = keys.get(obj.id)
+        # Geometry recovered with degraded settings is not cached under the key of the requested settings
+        if key is not None and 'degraded' not in obj.props:
+            cache.put(key, obj)
+        yield obj
+    return None
+
+
 def ifc_loads(txt: str, is_path:bool=False):
     if is_path:
         return ifcopenshell.open(txt)
@@ -348,11 +550,16 @@ def ifc_loads(txt: str, is_path:bool=False):
 import     ifcexport2.ifc_psets
 import re
 
-def _build(three_js_root:dict, h: ifcexport2.ifc_hierarchy.Hierarchy, geoms:dict[int,IRGeometryObject],ifc_file:ifcopenshell.file):
-
-    add_material(three_js_root, default_material)
-    add_material(three_js_root,color_attr_material)
-    root = three_js_root['object']
+def _build_tree(root:dict, h: ifcexport2.ifc_hierarchy.Hierarchy, ifc_file:ifcopenshell.file, make_leaf,
+                extractor:Optional[ifcexport2.ifc_psets.PropsExtractor]=None):
+    """
+    Build the groups of the three.js object tree from the hierarchy.
+    Meshes are created with ``make_leaf(obj_id, props)``, it returns None for an element without
+    geometry. The own geometry of a group element (e.g. a site with terrain) becomes its first child.
+    Props come from ``extractor``, a new PropsExtractor of ``ifc_file`` if not passed.
+    """
+    if extractor is None:
+        extractor = ifcexport2.ifc_psets.PropsExtractor(ifc_file)
     roots_stack = [(root, list(h.root_elements))]
     while roots_stack:
         current_root, next_roots = roots_stack.pop()
@@ -365,47 +572,218 @@ def _build(three_js_root:dict, h: ifcexport2.ifc_hierarchy.Hierarchy, geoms:dict
             additional_props = {}
             if current_root_id is not None:
                 additional_props={"parent_id":current_root_id}
-            props=ifcexport2.ifc_psets.extract_props(obj_id,ifc_file,additional_props)
+            props=extractor.props(obj_id,additional_props)
             if len(obj_childs) > 0:
 
                 obj_o = create_group(props['name'], props)
+                own_mesh = make_leaf(obj_id, {**props})
+                if own_mesh is not None:
+                    obj_o['children'].append(own_mesh)
                 roots_stack.append((obj_o, obj_childs))
             else:
-                o = geoms[obj_id]
-                if o.mesh.colors is None:
-                   mat =default_material
-                else :
-                    mat = color_attr_material
-
-                obj_o ,obj_geom,obj_mat= mesh_to_three(
-                    o.mesh,
-                    name=props['name'],
-                    matrix=o.transform,
-                    props=props)
-
-                obj_o['material']=mat['uuid']
-                add_geometry(three_js_root, obj_geom)
+                obj_o = make_leaf(obj_id, props)
+                if obj_o is None:
+                    # A spatial element or an element without a tessellated representation.
+                    continue
             current_root['children'].append(obj_o)
 
 
+def _build(three_js_root:dict, h: ifcexport2.ifc_hierarchy.Hierarchy, geoms:dict[int,IRGeometryObject],ifc_file:ifcopenshell.file, index:Optional[ModelIndex]=None,
+           quantize:bool=False, material_groups:bool=False, buffer:Optional[Buffer]=None,
+           extractor:Optional[ifcexport2.ifc_psets.PropsExtractor]=None):
+
+    add_material(three_js_root, default_material)
+    add_material(three_js_root,color_attr_material)
+    # Mesh.uid -> BufferGeometry, instanced objects share one Mesh and one geometry entry.
+    shared_geometries = {}
+
+    def make_leaf(obj_id, props):
+        if obj_id not in geoms:
+            return None
+        o = geoms[obj_id]
+        if o.mesh.lods:
+            # Simplified levels, see lod
+            shared_geometry = shared_geometries.get(o.mesh.uid)
+            obj_o, obj_geoms, obj_mats = lod_to_three(o.mesh, props=props, name=props['name'], matrix=o.transform,
+                                                      geometries=shared_geometry, buffer=buffer, quantize=quantize,
+                                                      material_groups=material_groups)
+            for m in obj_mats:
+                for mm in (m if isinstance(m, list) else [m]):
+                    add_material(three_js_root, mm, check_exist=True)
+            if shared_geometry is None:
+                shared_geometries[o.mesh.uid] = obj_geoms
+                for g in obj_geoms:
+                    add_geometry(three_js_root, g)
+            return obj_o
+        if o.mesh.colors is None:
+           mat =default_material
+        else :
+            mat = color_attr_material
+        shared_geometry = shared_geometries.get(o.mesh.uid)
+        obj_o ,obj_geom,obj_mat= mesh_to_three(
+            o.mesh,
+            name=props['name'],
+            matrix=o.transform,
+            props=props,
+            geometry=shared_geometry,
+            buffer=buffer,
+            quantize=quantize,
+            material_groups=material_groups)
+
+        if material_groups and o.mesh.material_ids is not None:
+            # Palette materials of the material groups
+            for m in (obj_mat if isinstance(obj_mat, list) else [obj_mat]):
+                add_material(three_js_root, m, check_exist=True)
+        else:
+            obj_o['material']=mat['uuid']
+        if shared_geometry is None:
+            shared_geometries[o.mesh.uid] = obj_geom
+            add_geometry(three_js_root, obj_geom)
+        return obj_o
+
+    _build_tree(three_js_root['object'], h, ifc_file, make_leaf,
+                extractor if extractor is not None else ifcexport2.ifc_psets.PropsExtractor(ifc_file, index))
+
+
 
 
 import ifcexport2.ifc_hierarchy
 
-def create_viewer_object(name, objects:list[IRGeometryObject],ifc_file:ifcopenshell.file,include_spatial_hierarchy:bool=True):
+def create_viewer_object(name, objects:list[IRGeometryObject],ifc_file:ifcopenshell.file,include_spatial_hierarchy:bool=True, index:Optional[ModelIndex]=None,
+                         quantize:bool=False, material_groups:bool=False, batch:bool=False,
+                         partition:Optional["PartitionPolicy"]=None):
+    """
+    The three.js root of ``objects`` under their spatial hierarchy.
+    With ``batch`` small meshes are merged into batches, see ``batching``.
+    With a ``partition`` policy the list of the part roots is returned instead, see ``viewer_parts``.
+    """
     geoms={o.id :o for o in objects}
+    if index is None:
+        index = ModelIndex.build(ifc_file)
+    if partition is not None:
+        from ifcexport2.viewer_parts import plan_parts, viewer_parts
+        h = ifcexport2.ifc_hierarchy.build_hierarchy(ifc_file, include_spatial_hierarchy=include_spatial_hierarchy, index=index)
+        objects = list(objects)
+        parts = viewer_parts(name, objects, ifc_file, plan_parts(objects, h, partition), h, index, quantize, material_groups)
+        if batch:
+            from ifcexport2.batching import batch_viewer_object
+            parts = map(batch_viewer_object, parts)
+        return list(parts)
 
     ifc_hierarchy=ifcexport2.ifc_hierarchy.clean_hierarchy(
         ifcexport2.ifc_hierarchy.build_hierarchy(ifc_file,
-                                                 include_spatial_hierarchy=include_spatial_hierarchy
+                                                 include_spatial_hierarchy=include_spatial_hierarchy,
+                                                 index=index
                                                  ),
         list(geoms.keys())
     )
     root = create_three_js_root(name,{'name':name})
-    _build(root,ifc_hierarchy,geoms,ifc_file)
-    
+    _build(root,ifc_hierarchy,geoms,ifc_file,index,quantize,material_groups)
+    if batch:
+        from ifcexport2.batching import batch_viewer_object
+        root = batch_viewer_object(root)
     return root
 
+
+def write_viewer_object(fp, name, objects:Iterable[IRGeometryObject], ifc_file:ifcopenshell.file, include_spatial_hierarchy:bool=True, props:dict=None,
+                        reused:Iterable[tuple[int,dict,list[float]]]=(), manifest:Optional[ConversionManifest]=None,
+                        index:Optional[ModelIndex]=None, buffer:Optional[Buffer]=None, reused_buffers:list=(),
+                        quantize:bool=False, material_groups:bool=False)->int:
+    """
+    Streaming counterpart of ``create_viewer_object``, writes the viewer JSON to ``fp``.
+
+    Each geometry is serialized as soon as its object arrives from ``objects`` (usually
+    ``convert_stream(...).objects``), only the small three.js Mesh dicts are kept until the
+    hierarchy is assembled at the end. Returns the number of written objects.
+
+    ``reused`` are (product id, geometry entry, matrix) of products taken over from a previous
+    conversion as they are (see ``incremental.convert_incremental``). If a ``manifest`` is
+    given, every written object is recorded in it.
+    ``index`` is the ModelIndex of ``ifc_file`` (``ConvertStream.index``), built if not passed.
+    If a ``buffer`` is given, the geometry attributes are stored in it instead of ``array`` lists
+    (``IfcExportCompat.viewer_buffers``), ``reused_buffers`` are the buffers the ``reused``
+    geometry entries refer to (``IncrementalStream.reused_buffers``).
+    With ``quantize`` the geometries are quantized, see ``quantize``. With ``material_groups``
+    multi-material meshes get geometry groups and palette materials instead of vertex colours.
+    """
+    if props is None:
+        props = {'name': name}
+    if index is None:
+        index = ModelIndex.build(ifc_file)
+    hierarchy = ifcexport2.ifc_hierarchy.build_hierarchy(ifc_file, include_spatial_hierarchy=include_spatial_hierarchy, index=index)
+    # Mesh.uid -> geometry uuid and decode matrix, instanced objects share one geometry entry.
+    shared_geometries = {}
+    mesh_objects = {}
+    with ViewerJsonWriter(fp, name, props) as writer:
+        if buffer is not None:
+            writer.buffers.append(buffer)
+        writer.add_material(default_material)
+        writer.add_material(color_attr_material)
+        written_geometries = set()
+        for product_id, geom, matrix in reused:
+            if geom['uuid'] not in written_geometries:
+                written_geometries.add(geom['uuid'])
+                writer.add_geometry(encode_geometry(geom, reused_buffers, buffer))
+            mat = geometry_material(geom)
+            writer.add_material(mat)
+            mesh_objects[product_id] = obj_o = _mesh_object(geom['uuid'], mat)
+            obj_o['matrix'] = matrix
+            if manifest is not None:
+                manifest.record(product_id, geom['uuid'], matrix)
+        for o in objects:
+            shared_geometry = shared_geometries.get(o.mesh.uid)
+            if o.mesh.lods:
+                # Simplified levels, see lod
+                obj_o, obj_geoms, mats = lod_to_three(o.mesh,
+                                                      matrix=o.transform,
+                                                      geometries=shared_geometry,
+                                                      buffer=buffer,
+                                                      quantize=quantize,
+                                                      material_groups=material_groups)
+                if shared_geometry is None:
+                    shared_geometries[o.mesh.uid] = [{k: g[k] for k in ('uuid', 'userData') if k in g} for g in obj_geoms]
+                    for g in obj_geoms:
+                        writer.add_geometry(g)
+                for mat in mats:
+                    writer.add_material(mat)
+                mesh_objects[o.id] = obj_o
+                if manifest is not None:
+                    # The original level, products reused by the next conversion lose their levels
+                    level = obj_o['children'][0]
+                    manifest.record(o.id, level['geometry'], apply_decode_matrix(obj_o['matrix'], np.array(level['matrix']).reshape((4, 4), order='F')))
+                del o, obj_geoms
+                continue
+            obj_o, obj_geom, mat = mesh_to_three(
+                o.mesh,
+                matrix=o.transform,
+                geometry=shared_geometry,
+                buffer=buffer,
+                quantize=quantize,
+                material_groups=material_groups)
+            if shared_geometry is None:
+                shared_geometries[o.mesh.uid] = {k: obj_geom[k] for k in ('uuid', 'userData') if k in obj_geom}
+                writer.add_geometry(obj_geom)
+            writer.add_material(mat)
+            mesh_objects[o.id] = obj_o
+            if manifest is not None:
+                manifest.record(o.id, obj_o['geometry'], obj_o['matrix'])
+            del o, obj_geom
+
+        def make_leaf(obj_id, leaf_props):
+            obj_o = mesh_objects.get(obj_id)
+            if obj_o is None:
+                return None
+            obj_o['name'] = leaf_props['name']
+            obj_o['userData'] = {'properties': leaf_props}
+            return obj_o
+
+        _build_tree(writer.object,
+                    ifcexport2.ifc_hierarchy.clean_hierarchy(hierarchy, list(mesh_objects.keys())),
+                    ifc_file,
+                    make_leaf,
+                    ifcexport2.ifc_psets.PropsExtractor(ifc_file, index, views=True))
+    return len(mesh_objects)
+
 def ifc_load(f):
     if isinstance(f, str):
         with open(f, "r") as fl:
@@ -428,7 +806,27 @@ def cli_export(
     print_items: bool,
     json_output: bool,
         target_units:str=None,
-        
+        instancing:bool=False,
+        cache_dir:Path=None,
+        cache_size:int=None,
+        previous:Path=None,
+        write_manifest:bool=False,
+        include_types:tuple=(),
+        global_ids:tuple=(),
+        exclude_global_ids:tuple=(),
+        containers:tuple=(),
+        contexts:tuple=(),
+        robust:bool=False,
+        retry_timeout:float=None,
+        no_save_fails:bool=False,
+        embed_buffers:bool=False,
+        draco:bool=False,
+        quantize:bool=False,
+        material_groups:bool=False,
+        batch:bool=False,
+        lod:Optional["LodPolicy"]=None,
+        adaptive_deflection:bool=False,
+        partition:Optional["PartitionPolicy"]=None,
         **kwargs
 ):
     """
@@ -458,21 +856,106 @@ def cli_export(
     # Create geometry iterator
     # (Assuming `safe_call_fast_convert` and `settings_dict` are defined elsewhere)
 
-    result = convert(ifc_file,ConvertArguments(
-      
-         
-            excluded_types=list(exclude),
-           
-           name=input_file.stem,target_units=target_units), settings=settings_dict,
-                     threads=threads,verbose=True
-                     
-        )
-    
-    
-    success, objects = result.success, result.objects
+    if output_format not in (IfcExportCompat.viewer, IfcExportCompat.viewer_buffers, IfcExportCompat.glb):
+        raise NotImplementedError(f"{str(output_format)} method of export is not supported at the moment")
+    if output_format == IfcExportCompat.glb and (previous is not None or write_manifest):
+        # The manifest refers to the geometry entries of a viewer JSON
+        raise NotImplementedError("Incremental conversion and manifests are not supported for glb at the moment")
+    if lod is not None and output_format == IfcExportCompat.glb:
+        raise NotImplementedError("Levels of detail are supported for the viewer formats at the moment")
+    if batch and (output_format == IfcExportCompat.glb or previous is not None or write_manifest):
+        # Batches do not keep the geometry entries of the products
+        raise NotImplementedError("Batching is supported for the viewer formats without manifests at the moment")
+    if partition is not None and (output_format == IfcExportCompat.glb or previous is not None or write_manifest or batch):
+        # Parts are written from the converted objects, see viewer_parts
+        raise NotImplementedError("Parts are supported for the viewer formats without manifests or batching at the moment")
+
+    cache = None
+    if cache_dir is not None:
+        cache = TessellationCache(cache_dir, **({} if cache_size is None else {'max_bytes': cache_size}))
+
+    args = ConvertArguments(excluded_types=list(exclude),
+                            name=input_file.stem,
+                            target_units=target_units,
+                            instancing=instancing,
+                            included_types=list(include_types) or None,
+                            global_ids=list(global_ids) or None,
+                            excluded_global_ids=list(exclude_global_ids) or None,
+                            containers=list(containers) or None,
+                            contexts=list(contexts) or None,
+                            adaptive_deflection=adaptive_deflection)
+    policy = None
+    if robust:
+        policy = RobustPolicy() if retry_timeout is None else RobustPolicy(timeout=retry_timeout)
+    if previous is not None:
+        # Only the products changed since the previous conversion are tessellated
+        stream = convert_incremental(ifc_file, args, PreviousConversion.load(previous), settings=settings_dict,
+                                     threads=threads, verbose=True, cache=cache, robust=policy)
+        reused, manifest = stream.reused, stream.manifest
+    else:
+        stream = convert_stream(ifc_file, args, settings=settings_dict,
+                                threads=threads, verbose=True, cache=cache, robust=policy)
+        reused = ()
+        manifest = ConversionManifest.for_file(ifc_file, effective_settings(args, settings_dict), args=args) if write_manifest else None
+    objects = stream.objects
+    if lod is not None:
+        from ifcexport2.lod import lod_stream
+        objects = lod_stream(objects, lod)
     output_files = []
-   
-    if not success:
+
+    # Write meshes to file while they are being tessellated
+    mesh_output_file = output_prefix.with_suffix(".viewer.json")
+    buffer_output_file = None
+    if output_format == IfcExportCompat.viewer_buffers and not embed_buffers:
+        buffer_output_file = output_prefix.with_suffix(".viewer" + BIN_SUFFIX)
+    try:
+        if output_format == IfcExportCompat.glb:
+            from ifcexport2.gltf import write_glb
+            mesh_output_file = output_prefix.with_suffix(".glb")
+            with open(mesh_output_file, 'wb') as f:
+                count = write_glb(f, input_file.stem, stream.objects, ifc_file, index=stream.index, draco=draco)
+        elif partition is not None:
+            from ifcexport2.viewer_parts import write_viewer_parts
+            # The parts are planned over all objects, so they are kept until the conversion is done
+            objects = list(objects)
+            count = len(objects)
+            buffers = None
+            if output_format == IfcExportCompat.viewer_buffers:
+                buffers = 'embedded' if embed_buffers else 'file'
+            part_files, plan = write_viewer_parts(output_prefix, input_file.stem, objects, ifc_file, partition,
+                                                  index=stream.index, buffers=buffers, quantize=quantize,
+                                                  material_groups=material_groups)
+            del objects
+            if print_items and plan.report is not None:
+                print(f"{plan.report.parts} parts, {plan.report.max / 1024 ** 2:.1f} MB largest, "
+                      f"max/mean {plan.report.imbalance:.2f}.")
+        else:
+            with open(mesh_output_file, 'w') as f, \
+                    (open(buffer_output_file, 'wb') if buffer_output_file is not None else contextlib.nullcontext()) as b:
+                buffer = None
+                if b is not None:
+                    buffer = GeometryBuffer(b, buffer_output_file.name)
+                elif output_format == IfcExportCompat.viewer_buffers:
+                    buffer = EmbeddedBuffer()
+                count = write_viewer_object(f,
+                                            input_file.stem,
+                                            objects,
+                                            ifc_file,
+                                            reused=reused,
+                                            manifest=manifest,
+                                            index=stream.index,
+                                            buffer=buffer,
+                                            reused_buffers=getattr(stream, 'reused_buffers', ()),
+                                            quantize=quantize,
+                                            material_groups=material_groups)
+        if batch and count > 0:
+            from ifcexport2.batching import batch_viewer_json
+            batch_viewer_json(mesh_output_file)
+    except Exception as e:
+            print(f"Error writing mesh file: {e}", file=sys.stderr)
+            raise e
+
+    if count == 0:
         if print_items:
             rich.print(f"[red]Failure: IfcOpenShell crashed on all attempts. No objects were extracted.[/red]", file=sys.stderr)
 
@@ -481,31 +964,26 @@ def cli_export(
         
     else:
         if print_items:
-            print(f"Success: {len(result.objects)} objects extracted. {len(result.fails)} fails")
-
-    # Write meshes to file
-    if output_format.viewer:
-        try:
-            
-
-            root=create_viewer_object(input_file.stem,
-                                      objects,
-                                      ifcopenshell.open(str(input_file))
-                                      )
-            
-            
-            mesh_output_file = output_prefix.with_suffix(".viewer.json")
-            with open(mesh_output_file, 'w') as f:
-                json.dump(root, f)
-        except Exception as e:
-                print(f"Error writing mesh file: {e}", file=sys.stderr)
-                raise e
-
+            print(f"Success: {count} objects extracted.")
+            if cache is not None:
+                print(f"Tessellation cache: {cache.hits} hits, {cache.misses} misses.")
+    if partition is not None:
+        output_files.extend(part_files)
     else:
-            raise NotImplementedError(f"{str(output_format)} method of export is not supported at the moment")
+        output_files.append(mesh_output_file)
+    if buffer_output_file is not None and partition is None:
+        output_files.append(buffer_output_file)
+    if manifest is not None:
+        manifest_output_file = Path(f"{mesh_output_file}{MANIFEST_SUFFIX}")
+        manifest.dump(manifest_output_file)
+        output_files.append(manifest_output_file)
     if print_items:
+        if partition is not None:
+            print(f"{len(part_files)} files saved to {output_prefix.parent}.")
+        else:
             print(f"{mesh_output_file} saved.")
-        # output_files.append(mesh_output_file)
+            if buffer_output_file is not None:
+                print(f"{buffer_output_file} saved.")
 
 
     # Write IFC database to JSON
@@ -523,7 +1001,14 @@ def cli_export(
     #     print(f"Error writing IFC DB file: {e}", file=sys.stderr)
 
     # Write fails to JSON if requested
-  
+    if stream.fails and not no_save_fails:
+        fails_output_file = output_prefix.with_suffix(".fails")
+        with fails_output_file.open("w") as f:
+            ujson.dump([asdict(fl) for fl in stream.fails], f, ensure_ascii=False, indent=2)
+        output_files.append(fails_output_file)
+        if print_items:
+            recovered = sum(fl.recovered for fl in stream.fails)
+            print(f"{len(stream.fails) - recovered} failed products ({recovered} recovered by retries), {fails_output_file} saved.")
 
     if print_items:
         print("Processing completed successfully.")
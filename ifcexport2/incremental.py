@@ -0,0 +1,196 @@
+"""
+Incremental re-conversion of a new revision of a model against a previous conversion.
+
+Every conversion can persist a manifest next to its viewer JSON, mapping each product's
+GlobalId to its representation hash (see ``tess_cache.RepresentationHasher``), the uuid of
+its three.js geometry and its matrix. A new revision is diffed against the manifest: only
+added or changed products are tessellated, the geometry entries of unchanged products are
+copied from the previous viewer JSON as they are.
+
+>>> previous = PreviousConversion.load('model-r1.viewer.json')
+>>> stream = convert_incremental(ifc_file_r2, ConvertArguments(), previous)
+>>> with open('model-r2.viewer.json', 'w') as f:
+...     write_viewer_object(f, 'model', stream.objects, ifc_file_r2,
+...                         reused=stream.reused, manifest=stream.manifest)
+...     stream.manifest.dump('model-r2.viewer.json' + MANIFEST_SUFFIX)
+"""
+from __future__ import annotations
+
+import dataclasses
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+import ifcopenshell
+import ujson
+from ifcopenshell.entity_instance import entity_instance
+
+from ifcexport2.ifc_preprocess import IfcInfo
+from ifcexport2.model_index import ModelIndex
+from ifcexport2.models import IRGeometryObject
+from ifcexport2.tess_cache import RepresentationHasher, settings_digest
+from ifcexport2.viewer_buffers import load_buffers
+
+MANIFEST_SUFFIX = ".manifest.json"
+# ConvertArguments that change the geometry but not the iterator settings: target_units converts
+# the file before tessellation, adaptive_deflection changes the deflection of some products,
+# contexts the representations tessellated
+GEOMETRY_ARGUMENTS = ("target_units", "adaptive_deflection", "contexts")
+
+
+def manifest_settings(settings: dict, args=None) -> dict:
+    """Iterator ``settings`` with the ``GEOMETRY_ARGUMENTS`` of ``args``, what a manifest digest covers."""
+    if args is None:
+        return settings
+    return {**settings, **{f"args.{name}": getattr(args, name) for name in GEOMETRY_ARGUMENTS}}
+
+
+class ConversionManifest:
+    """
+    Product -> geometry mapping of one conversion: ``products[GlobalId] = [key, geometry uuid, matrix]``.
+    Keys are computed lazily with ``hasher`` when objects are recorded.
+    """
+
+    def __init__(self, settings: str, products: dict[str, list] = None, hasher: Optional[RepresentationHasher] = None,
+                 ifc_file: Optional[ifcopenshell.file] = None):
+        self.settings = settings
+        self.products = products if products is not None else {}
+        self.hasher = hasher
+        self.ifc_file = ifc_file
+        self.keys: dict[int, str] = {}
+
+    @classmethod
+    def for_file(cls, ifc_file: ifcopenshell.file, settings: dict, backend: Optional[str] = None,
+                 args=None) -> "ConversionManifest":
+        """Manifest of a conversion of ``ifc_file`` with ``settings`` and ``args`` (``ConvertArguments``)."""
+        settings = manifest_settings(settings, args)
+        return cls(settings_digest(settings, backend).hex(), hasher=RepresentationHasher(ifc_file, settings, backend),
+                   ifc_file=ifc_file)
+
+    def record(self, product_id: int, geometry_uuid: str, matrix: list[float]):
+        product = self.ifc_file.by_id(product_id)
+        key = self.keys.get(product_id)
+        if key is None:
+            key = self.hasher.product_key(product)
+        self.products[product.GlobalId] = [key, geometry_uuid, matrix]
+
+    def dump(self, path: Union[str, Path]):
+        with open(path, "w") as f:
+            ujson.dump({"settings": self.settings, "products": self.products}, f)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "ConversionManifest":
+        with open(path, "r") as f:
+            data = ujson.load(f)
+        return cls(data["settings"], data["products"])
+
+
+@dataclasses.dataclass(slots=True)
+class RevisionDiff:
+    unchanged: list[entity_instance]
+    changed: list[entity_instance]
+    added: list[entity_instance]
+    removed: list[str]
+
+
+def diff_revision(manifest: ConversionManifest, products: list[entity_instance], keys: dict[int, str]) -> RevisionDiff:
+    """Diff ``products`` of a new revision against the previous ``manifest`` by GlobalId and representation hash."""
+    unchanged, changed, added = [], [], []
+    seen = set()
+    for product in products:
+        global_id = product.GlobalId
+        seen.add(global_id)
+        previous = manifest.products.get(global_id)
+        if previous is None:
+            added.append(product)
+        elif previous[0] == keys[product.id()]:
+            unchanged.append(product)
+        else:
+            changed.append(product)
+    removed = [global_id for global_id in manifest.products if global_id not in seen]
+    return RevisionDiff(unchanged, changed, added, removed)
+
+
+class PreviousConversion:
+    """The manifest and the geometry entries of a previous conversion."""
+
+    def __init__(self, manifest: ConversionManifest, viewer_json_path: Union[str, Path]):
+        self.manifest = manifest
+        self.viewer_json_path = Path(viewer_json_path)
+        # Buffers the geometry entries refer to, loaded by ``geometries``
+        self.buffers: list = []
+
+    @classmethod
+    def load(cls, viewer_json_path: Union[str, Path], manifest_path: Union[str, Path] = None) -> "PreviousConversion":
+        if manifest_path is None:
+            manifest_path = f"{viewer_json_path}{MANIFEST_SUFFIX}"
+        return cls(ConversionManifest.load(manifest_path), viewer_json_path)
+
+    def geometries(self, uuids: set[str]) -> dict[str, dict]:
+        """Geometry entries of the previous viewer JSON with the given uuids."""
+        if not uuids:
+            return {}
+        with self.viewer_json_path.open("r") as f:
+            root = ujson.load(f)
+        self.buffers = load_buffers(root, self.viewer_json_path.parent)
+        geometries = root["geometries"]
+        return {g["uuid"]: g for g in geometries if g["uuid"] in uuids}
+
+
+@dataclasses.dataclass(slots=True)
+class IncrementalStream:
+    # Objects of the added and changed products only
+    objects: Iterator[IRGeometryObject]
+    info: IfcInfo
+    ifc_file: ifcopenshell.file
+    diff: RevisionDiff
+    # (product id, previous geometry entry, previous matrix) for each unchanged product
+    reused: list[tuple[int, dict, list[float]]]
+    manifest: ConversionManifest
+    fails: list = dataclasses.field(default_factory=list)
+    index: Optional[ModelIndex] = None
+    # Buffers the reused geometry entries refer to, see viewer_buffers
+    reused_buffers: list = dataclasses.field(default_factory=list)
+
+
+def convert_incremental(
+        ifc_file: ifcopenshell.file,
+        args,
+        previous: PreviousConversion,
+        settings: dict = None,
+        threads=None,
+        verbose=False,
+        backend=None,
+        cache=None,
+        robust=None,
+) -> IncrementalStream:
+    """
+    Convert a new revision of a model, tessellating only the products that were added or
+    changed since ``previous``. If the previous conversion used other settings or target units,
+    every product is treated as changed.
+    """
+    from ifcexport2.ifc_to_mesh import convert_stream, effective_settings
+
+    settings = effective_settings(args, settings)
+    manifest = ConversionManifest.for_file(ifc_file, settings, backend, args=args)
+    index = ModelIndex.build(ifc_file)
+    products = args.select_products(ifc_file, index)
+    manifest.keys = {p.id(): manifest.hasher.product_key(p) for p in products}
+    if previous.manifest.settings != manifest.settings:
+        diff = RevisionDiff([], [], products, list(previous.manifest.products))
+    else:
+        diff = diff_revision(previous.manifest, products, manifest.keys)
+
+    previous_products = previous.manifest.products
+    geometries = previous.geometries({previous_products[p.GlobalId][1] for p in diff.unchanged})
+    reused = []
+    for product in diff.unchanged:
+        _, geometry_uuid, matrix = previous_products[product.GlobalId]
+        reused.append((product.id(), geometries[geometry_uuid], matrix))
+    if verbose:
+        print(f"Incremental conversion: {len(diff.unchanged)} unchanged, {len(diff.changed)} changed, "
+              f"{len(diff.added)} added, {len(diff.removed)} removed products.")
+
+    stream = convert_stream(ifc_file, args, settings=settings, threads=threads, verbose=verbose, backend=backend,
+                            cache=cache, products=diff.changed + diff.added, robust=robust, index=index)
+    return IncrementalStream(stream.objects, stream.info, stream.ifc_file, diff, reused, manifest, stream.fails,
+                             stream.index, previous.buffers)
@@ -0,0 +1,300 @@
+"""
+Level-of-detail generation.
+
+Heavy meshes (at least ``LodPolicy.min_triangles`` triangles) get simplified levels, stored in
+``Mesh.lods`` as (distance, Mesh) pairs, using quadric error decimation implemented with NumPy:
+each pass computes the collapse cost of every edge at once, collapses an independent set of the
+cheapest edges (no two sharing a vertex), rejects the collapses that flip a face and repeats
+until the triangle target of the level is reached. Face materials are carried along, so levels
+keep the colours (and material groups) of the original mesh.
+
+The viewer writers emit meshes with levels as three.js ``LOD`` objects, the original mesh
+being the level at distance 0. Simplification runs in a process pool while the geometry
+iterator goes on, instanced meshes are simplified once.
+
+>>> stream = convert_stream(ifc_file, ConvertArguments())
+>>> write_viewer_object(f, 'model', lod_stream(stream.objects, LodPolicy()), ifc_file, index=stream.index)
+"""
+from __future__ import annotations
+
+import collections
+import dataclasses
+import multiprocessing
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+
+from ifcexport2.mesh import Mesh
+from ifcexport2.models import IRGeometryObject
+
+# Weight of the planes keeping open boundaries in place, relative to the squared edge length
+BOUNDARY_WEIGHT = 100.0
+# Minimum cosine between a face normal before and after a collapse
+FLIP_COSINE = 0.2
+WELD_TOLERANCE = 1e-6
+# Objects read from the stream while the previous window is simplified
+WINDOW = 256
+
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class LodPolicy:
+    # Triangle count of each level relative to the original mesh
+    ratios: tuple[float, ...] = (0.5, 0.25, 0.1)
+    # Meshes with fewer triangles get no levels
+    min_triangles: int = 1024
+    # Triangle budget of a level, levels above it are simplified down to it
+    max_triangles: Optional[int] = None
+    # Distance of the first level in bounding sphere radii, doubled for each next level
+    distance: float = 4.0
+    # Simplification processes, cpu count - 1 by default, 0 simplifies in the calling process
+    workers: Optional[int] = None
+
+    def targets(self, triangles: int) -> list[int]:
+        targets = []
+        for ratio in self.ratios:
+            target = int(triangles * ratio)
+            if self.max_triangles is not None:
+                target = min(target, self.max_triangles)
+            if target > 0 and (not targets or target < targets[-1]):
+                targets.append(target)
+        return targets
+
+
+def weld(position: np.ndarray, faces: np.ndarray, tolerance: float = WELD_TOLERANCE) -> tuple[np.ndarray, np.ndarray]:
+    """Merge coincident vertices, the geometry iterator splits them along face normals and materials."""
+    keys = np.rint(np.asarray(position, dtype=np.float64) / tolerance).astype(np.int64)
+    _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    return np.asarray(position, dtype=np.float64)[first], inverse.reshape(-1)[faces]
+
+
+def _accumulate(index: np.ndarray, values: np.ndarray, count: int) -> np.ndarray:
+    """Sum of the (n, k) ``values`` rows per ``index``, (count, k)."""
+    return np.stack([np.bincount(index, values[:, j], minlength=count) for j in range(values.shape[1])], axis=1)
+
+
+def _face_normals(position: np.ndarray, faces: np.ndarray) -> np.ndarray:
+    v0 = position[faces[:, 0]]
+    return np.cross(position[faces[:, 1]] - v0, position[faces[:, 2]] - v0)
+
+
+def _edges(faces: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Unique edges (sorted vertex pairs), the edge of each face side and the face count of each edge."""
+    sides = np.sort(faces[:, [0, 1, 1, 2, 2, 0]].reshape((-1, 2)), axis=1)
+    # One int64 key per edge, much faster to sort than rows
+    count = int(faces.max()) + 1 if len(faces) else 1
+    keys, inverse, counts = np.unique(sides[:, 0] * count + sides[:, 1], return_inverse=True, return_counts=True)
+    return np.stack([keys // count, keys % count], axis=1), inverse.reshape(-1), counts
+
+
+def vertex_quadrics(position: np.ndarray, faces: np.ndarray) -> np.ndarray:
+    """(n, 4, 4) error quadrics of the vertices: area weighted face planes and open boundary planes."""
+    normals = _face_normals(position, faces)
+    double_area = np.linalg.norm(normals, axis=1)
+    unit = normals / np.maximum(double_area, 1e-300)[:, np.newaxis]
+    planes = np.concatenate([unit, -np.einsum('ij,ij->i', unit, position[faces[:, 0]])[:, np.newaxis]], axis=1)
+    quadrics = (planes[:, :, np.newaxis] * planes[:, np.newaxis, :]).reshape((-1, 16)) * (double_area / 2)[:, np.newaxis]
+    index = faces.reshape(-1)
+    result = _accumulate(index, np.repeat(quadrics, 3, axis=0), len(position))
+
+    edges, side_edges, counts = _edges(faces)
+    boundary = counts[side_edges] == 1
+    if boundary.any():
+        sides = faces[:, [0, 1, 1, 2, 2, 0]].reshape((-1, 2))[boundary]
+        face_unit = np.repeat(unit, 3, axis=0)[boundary]
+        direction = position[sides[:, 1]] - position[sides[:, 0]]
+        normal = np.cross(direction, face_unit)
+        length = np.linalg.norm(normal, axis=1)
+        normal /= np.maximum(length, 1e-300)[:, np.newaxis]
+        planes = np.concatenate([normal, -np.einsum('ij,ij->i', normal, position[sides[:, 0]])[:, np.newaxis]], axis=1)
+        weight = BOUNDARY_WEIGHT * np.einsum('ij,ij->i', direction, direction)
+        quadrics = (planes[:, :, np.newaxis] * planes[:, np.newaxis, :]).reshape((-1, 16)) * weight[:, np.newaxis]
+        result += _accumulate(sides.reshape(-1), np.repeat(quadrics, 2, axis=0), len(position))
+    return result.reshape((-1, 4, 4))
+
+
+def _collapse_targets(position: np.ndarray, quadrics: np.ndarray, edges: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Position minimizing the error of each collapsed edge among its ends, midpoint and optimum, and the error."""
+    a, b = position[edges[:, 0]], position[edges[:, 1]]
+    q = quadrics[edges[:, 0]] + quadrics[edges[:, 1]]
+    candidates = [a, b, (a + b) / 2]
+    # The optimum where the quadric is well conditioned and close to the edge
+    det = np.linalg.det(q[:, :3, :3])
+    scale = np.einsum('ijj->i', q[:, :3, :3]) ** 3
+    solvable = np.abs(det) > 1e-10 * np.maximum(scale, 1e-300)
+    optimum = (a + b) / 2
+    if solvable.any():
+        solved = np.linalg.solve(q[solvable, :3, :3], -q[solvable, :3, 3:4])[:, :, 0]
+        near = np.linalg.norm(solved - optimum[solvable], axis=1) <= np.linalg.norm(b - a, axis=1)[solvable]
+        optimum[np.flatnonzero(solvable)[near]] = solved[near]
+    candidates.append(optimum)
+    points = np.stack(candidates, axis=1)
+    homogeneous = np.concatenate([points, np.ones(points.shape[:2] + (1,))], axis=2)
+    errors = np.einsum('eci,eij,ecj->ec', homogeneous, q, homogeneous)
+    best = np.argmin(errors, axis=1)
+    rows = np.arange(len(edges))
+    return points[rows, best], np.maximum(errors[rows, best], 0.0)
+
+
+def _collapse(position, faces, edges, points, selected):
+    """Positions and faces after collapsing the ``selected`` edges, degenerate faces and the collapses flipping a face."""
+    moved = np.full(len(position), -1, dtype=np.int64)
+    moved[edges[selected, 0]] = selected
+    moved[edges[selected, 1]] = selected
+    remap = np.arange(len(position))
+    remap[edges[selected, 1]] = edges[selected, 0]
+    new_faces = remap[faces]
+    degenerate = (new_faces[:, 0] == new_faces[:, 1]) | (new_faces[:, 1] == new_faces[:, 2]) | \
+                 (new_faces[:, 2] == new_faces[:, 0])
+    new_position = position.copy()
+    new_position[edges[selected, 0]] = points[selected]
+
+    touched = np.flatnonzero((moved[faces] >= 0).any(axis=1) & ~degenerate)
+    before = _face_normals(position, faces[touched])
+    after = _face_normals(new_position, new_faces[touched])
+    cosine = np.einsum('ij,ij->i', before, after)
+    flipped = cosine <= FLIP_COSINE * np.linalg.norm(before, axis=1) * np.linalg.norm(after, axis=1)
+    rejected = moved[faces[touched[flipped]]].reshape(-1)
+    return new_position, new_faces, degenerate, np.unique(rejected[rejected >= 0])
+
+
+def simplify(position: np.ndarray, faces: np.ndarray, target: int, face_data: Optional[np.ndarray] = None,
+             quadrics: Optional[np.ndarray] = None) -> tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]:
+    """
+    Quadric error decimation of a welded mesh down to ``target`` triangles (or as close as it gets
+    without flipping faces). ``face_data`` (per face, e.g. material ids) follows the kept faces.
+    Returns the positions (unused vertices included), faces and face data.
+    """
+    position = np.array(position, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64).reshape((-1, 3))
+    if quadrics is None:
+        quadrics = vertex_quadrics(position, faces)
+    quadrics = quadrics.copy()
+    while len(faces) > target:
+        edges, _, _ = _edges(faces)
+        points, errors = _collapse_targets(position, quadrics, edges)
+        # Independent set: the edges that are the cheapest edge of both their vertices
+        rank = np.empty(len(edges), dtype=np.int64)
+        rank[np.argsort(errors, kind='stable')] = np.arange(len(edges))
+        vertex_rank = np.full(len(position), len(edges), dtype=np.int64)
+        np.minimum.at(vertex_rank, edges[:, 0], rank)
+        np.minimum.at(vertex_rank, edges[:, 1], rank)
+        selected = np.flatnonzero((vertex_rank[edges[:, 0]] == rank) & (vertex_rank[edges[:, 1]] == rank))
+        # A collapse removes about two faces
+        selected = selected[np.argsort(rank[selected])][:max(1, (len(faces) - target + 1) // 2)]
+
+        # Collapses flipping a face are dropped until none does
+        while True:
+            new_position, new_faces, degenerate, rejected = _collapse(position, faces, edges, points, selected)
+            if len(rejected) == 0:
+                break
+            selected = np.setdiff1d(selected, rejected)
+        if len(selected) == 0:
+            break
+        quadrics[edges[selected, 0]] += quadrics[edges[selected, 1]]
+        position = new_position
+        faces = new_faces[~degenerate]
+        if face_data is not None:
+            face_data = face_data[~degenerate]
+    return position, faces, face_data
+
+
+def compact(position: np.ndarray, faces: np.ndarray, face_data: Optional[np.ndarray] = None):
+    """Drop unused vertices. With ``face_data``, vertices are split per value, so it can become vertex data."""
+    faces = np.asarray(faces).reshape((-1, 3))
+    if face_data is None:
+        used, inverse = np.unique(faces.reshape(-1), return_inverse=True)
+        return position[used], inverse.reshape((-1, 3)).astype(np.int32), None
+    data = np.repeat(np.asarray(face_data, dtype=np.int64), 3)
+    low = int(data.min()) if len(data) else 0
+    span = int(data.max()) - low + 1 if len(data) else 1
+    used, inverse = np.unique(faces.reshape(-1) * span + (data - low), return_inverse=True)
+    return position[used // span], inverse.reshape((-1, 3)).astype(np.int32), used % span + low
+
+
+def simplify_levels(mesh: Mesh, policy: LodPolicy) -> list[tuple[float, Mesh]]:
+    """(distance, Mesh) of the simplified levels of ``mesh``, empty if it is too light or does not simplify."""
+    faces = np.asarray(mesh.faces).reshape((-1, 3))
+    if len(faces) < policy.min_triangles:
+        return []
+    position, welded = weld(mesh.position, faces)
+    material_ids = None if mesh.material_ids is None else np.asarray(mesh.material_ids, dtype=np.int64)
+    quadrics = vertex_quadrics(position, welded)
+    radius = max(float(np.linalg.norm(position.max(axis=0) - position.min(axis=0))) / 2, 1e-9)
+
+    levels = []
+    previous = len(faces)
+    for target in policy.targets(len(faces)):
+        level_position, level_faces, level_ids = simplify(position, welded, target, material_ids, quadrics)
+        # Levels that do not simplify further are dropped
+        if len(level_faces) >= 0.9 * previous or len(level_faces) == 0:
+            break
+        previous = len(level_faces)
+        # The next level continues from this one
+        position, welded, material_ids = level_position, level_faces, level_ids
+        vertices, level_faces, vertex_ids = compact(position, level_faces, level_ids)
+        colors = None
+        if vertex_ids is not None:
+            colors = np.zeros((len(vertices), 3), dtype=np.float32)
+            colors[vertex_ids >= 0] = np.asarray(mesh.materials)[vertex_ids[vertex_ids >= 0], :3]
+        distance = radius * policy.distance * 2 ** len(levels)
+        levels.append((distance, Mesh(vertices.astype(np.float32),
+                                      faces=level_faces,
+                                      colors=colors,
+                                      uid=f'{mesh.uid}/{len(levels) + 1}',
+                                      material_ids=level_ids,
+                                      materials=mesh.materials)))
+        # Recomputed from the simplified mesh for the next level
+        quadrics = vertex_quadrics(position, welded)
+    return levels
+
+
+def _simplify_job(mesh: Mesh, policy: LodPolicy) -> list[tuple[float, Mesh]]:
+    return simplify_levels(mesh, policy)
+
+
+def lod_stream(objects: Iterable[IRGeometryObject], policy: LodPolicy = LodPolicy()) -> Iterator[IRGeometryObject]:
+    """
+    Yields ``objects`` with the levels of their meshes in ``Mesh.lods``. Objects are read by windows,
+    the meshes of a window are simplified in the pool while the next window is read.
+    """
+    workers = policy.workers
+    if workers is None:
+        workers = max(multiprocessing.cpu_count() - 1, 1)
+    if workers == 0:
+        for o in objects:
+            if o.mesh.lods is None:
+                o.mesh.lods = simplify_levels(o.mesh, policy)
+            yield o
+        return
+
+    # id(mesh) -> pending levels, instanced objects share one Mesh
+    in_flight = {}
+    pending = collections.deque()
+
+    def submit(window):
+        for o in window:
+            mesh = o.mesh
+            if mesh.lods is None and id(mesh) not in in_flight and np.size(mesh.faces) >= 3 * policy.min_triangles:
+                in_flight[id(mesh)] = pool.apply_async(_simplify_job, (mesh, policy))
+        return window
+
+    def finish(window):
+        for o in window:
+            result = in_flight.pop(id(o.mesh), None)
+            if result is not None:
+                o.mesh.lods = result.get()
+        yield from window
+
+    # Spawned, the geometry iterator threads of this process are not forked along
+    with multiprocessing.get_context('spawn').Pool(workers) as pool:
+        window = []
+        for o in objects:
+            window.append(o)
+            if len(window) == WINDOW:
+                pending.append(submit(window))
+                window = []
+                if len(pending) > 1:
+                    yield from finish(pending.popleft())
+        pending.append(submit(window))
+        while pending:
+            yield from finish(pending.popleft())
@@ -12,4 +12,8 @@ class Mesh:
     colors:Optional[NDArray]=None
     color:Optional[tuple[int,int,int]]=None
     uid:int|str=0
-
+    # Material index of each face (-1 for none) and the RGB (0..1) colour of each material
+    material_ids:Optional[NDArray]=None
+    materials:Optional[NDArray]=None
+    # Simplified levels as (distance, Mesh), see lod
+    lods:Optional[list[tuple[float,"Mesh"]]]=None
@@ -2,9 +2,13 @@ import uuid
 from dataclasses import dataclass, field
 from datetime import datetime
 
+import numpy as np
+
 
 
 from .mesh import Mesh
+from .viewer_buffers import attribute, Buffer
+from .quantize import quantized_geometry_data, apply_decode_matrix, decode_matrix
 def rgb_to_dec(r, g, b):
     return (r << 16) + (g << 8) + b
 def material(color_rgb, flat=True):
@@ -55,55 +59,162 @@ color_attr_material={
 default_material=material((150,150,150))
 _material_table={(150,150,150):default_material}
 
-def mesh_to_three(mesh:Mesh,  props:dict=None,name="MeshObject",color=None, mat=None,matrix=None):
+def mesh_to_three(mesh:Mesh,  props:dict=None,name="MeshObject",color=None, mat=None,matrix=None, geometry:dict=None,
+                  buffer:Buffer=None, quantize:bool=False, material_groups:bool=False):
+    """
+    Convert a mesh into a three.js Mesh object, its BufferGeometry and material.
+
+    If ``geometry`` (a BufferGeometry previously produced for the same mesh) is given,
+    it is referenced instead of being built again, so instances share one geometry entry.
+    If ``buffer`` is given, the attribute arrays are stored in it instead of ``array`` lists
+    (see ``viewer_buffers``). With ``quantize`` the attributes are quantized and the decode
+    matrix is applied to the object matrix (see ``quantize``).
+
+    With ``material_groups`` a mesh with material ids gets no colour attribute: its faces are
+    sorted by material into geometry ``groups`` and the object gets a list of palette materials
+    (a single material if there is one colour). The palette is kept in the geometry's
+    ``userData.palette``. The returned material is then a list if there are several.
+    """
+    if geometry is not None:
+        if 'palette' in geometry.get('userData', {}):
+            mat = palette_materials(geometry['userData']['palette'])
+        else:
+            mat = _mesh_material(mesh, color, mat)
+        decode = decode_matrix(geometry)
+        if decode is not None:
+            matrix = apply_decode_matrix(matrix, decode)
+        return _mesh_object(geometry['uuid'], mat, props, name, matrix), geometry, mat
     mesh_geometry_uid=uuid.uuid4().__str__()
 
+    faces, colors, groups, palette = mesh.faces, mesh.colors, None, None
+    if material_groups and mesh.material_ids is not None:
+        faces, groups, palette = group_faces_by_material(mesh)
+        colors = None
+
+    user_data = {}
+    if quantize:
+        data, decode = quantized_geometry_data(mesh.position, faces, colors, buffer)
+        user_data["decodeMatrix"] = decode.flatten(order='F').tolist()
+        matrix = apply_decode_matrix(matrix, decode)
+    else:
+        data = {
+            "attributes": {
+                "position": attribute(np.array(mesh.position,dtype=float), 3, "Float32Array", buffer)
+            },
+            "index": attribute(np.array(faces.flatten(),dtype=np.uint32), 1, "Uint32Array", buffer)
+        }
+        if colors is not None:
+            data['attributes']['color']=attribute(np.array(colors, dtype=float), int(colors.shape[-1]),
+                                                  "Float32Array", buffer)
+    if groups:
+        data["groups"] = groups
     geom={
         "uuid":  mesh_geometry_uid,
         "type": "BufferGeometry",
-        "data": {
-            "attributes": {
-                "position": {
-                    "itemSize": 3,
-                    "type": "Float32Array",
-                    "array": np.array(mesh.position,dtype=float).flatten().tolist()
-                           }
-            },
-                "index": {"itemSize": 1,
-                           "type": "Uint32Array",
-                           "array": [int(i) for i in np.array(mesh.faces.flatten(),dtype=np.uint32)]
-                           }
-
-            }
-
-
-
+        "data": data,
     }
-
-    mat = mat
-    if mesh.colors is not None:
-        colors={
-            "itemSize":int( mesh.colors.shape[-1]),
-            "type": "Float32Array",
-            "array": np.array(mesh.colors, dtype=float).flatten().tolist()
-        }
-        geom['data']['attributes']['color']=colors
-        mat = color_attr_material
-
+    if palette is not None:
+        user_data["palette"] = palette
+        mat = palette_materials(palette)
     else:
-        if color is not None:
-            if color not in _material_table:
-
-                _material_table[color]=material(color)
-
-            mat=_material_table[color]
-        elif mat is not None :
-            mat=mat
+        mat = _mesh_material(mesh, color, mat)
+    if user_data:
+        geom["userData"] = user_data
+
+    return _mesh_object(mesh_geometry_uid, mat, props, name, matrix), geom, mat
+
+
+def lod_to_three(mesh:Mesh, props:dict=None, name="MeshObject", matrix=None, geometries:list[dict]=None,
+                 buffer:Buffer=None, quantize:bool=False, material_groups:bool=False):
+    """
+    Convert a mesh with simplified levels (``Mesh.lods``, see ``lod``) into a three.js LOD object whose
+    children are the Mesh objects of the levels, the original mesh first. Returns the LOD object,
+    the BufferGeometry and the material(s) of each level. ``geometries`` are the BufferGeometries
+    previously produced for the levels of the same mesh, as in ``mesh_to_three``.
+    """
+    levels = [(0.0, mesh), *mesh.lods]
+    children, geoms, mats = [], [], []
+    for i, (distance, level) in enumerate(levels):
+        obj, geom, mat = mesh_to_three(level, name=f"{name} LOD{i}",
+                                       geometry=None if geometries is None else geometries[i],
+                                       buffer=buffer, quantize=quantize, material_groups=material_groups)
+        children.append(obj)
+        geoms.append(geom)
+        mats.append(mat)
+    lod = {
+        "uuid": uuid.uuid4().__str__(),
+        "type": "LOD",
+        "name": name,
+        "layers": 1,
+        "matrix": [1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1] if matrix is None else list(np.array(matrix).flatten(order='F').tolist()),
+        "up": [0, 1, 0],
+        "userData": {"properties": props if props is not None else {}},
+        "children": children,
+        "autoUpdate": True,
+        "levels": [{"object": child["uuid"], "distance": distance, "hysteresis": 0}
+                   for child, (distance, _) in zip(children, levels)],
+    }
+    return lod, geoms, mats
+
+
+def group_faces_by_material(mesh:Mesh) -> tuple[np.ndarray, list[dict], list]:
+    """
+    Faces of the mesh sorted by material colour, three.js geometry groups of the sorted faces and
+    the palette: an RGB list (0..255) per group, None for faces without material. Materials with the
+    same colour share a group. Single-colour meshes get no groups and the faces as they are.
+    """
+    rgb = np.rint(np.asarray(mesh.materials, dtype=np.float64)[:, :3] * 255).astype(np.int64)
+    colors, color_of_material = np.unique(rgb, axis=0, return_inverse=True)
+    color_of_material = np.append(color_of_material.reshape(-1), len(colors))
+    # -1 (no material) indexes the appended entry
+    keys = color_of_material[np.asarray(mesh.material_ids, dtype=np.int64)]
+    used = np.unique(keys)
+    palette = [None if k == len(colors) else colors[k].tolist() for k in used]
+    if len(used) == 1:
+        return mesh.faces, [], palette
+    order = np.argsort(keys, kind='stable')
+    _, starts, counts = np.unique(keys[order], return_index=True, return_counts=True)
+    faces = np.asarray(mesh.faces).reshape((-1, 3))[order]
+    groups = [{"start": int(start) * 3, "count": int(count) * 3, "materialIndex": i}
+              for i, (start, count) in enumerate(zip(starts, counts))]
+    return faces, groups, palette
+
+
+def palette_material(rgb) -> dict:
+    """The deduplicated MeshStandardMaterial of an RGB colour (0..255), the default material for None."""
+    if rgb is None:
+        return default_material
+    rgb = tuple(rgb)
+    if rgb not in _material_table:
+        _material_table[rgb] = material(rgb)
+    return _material_table[rgb]
+
+
+def palette_materials(palette: list):
+    """Materials of a geometry palette, a single material if the palette has one colour."""
+    mats = [palette_material(rgb) for rgb in palette]
+    return mats[0] if len(mats) == 1 else mats
+
+
+def geometry_material(geom: dict):
+    """Material(s) of an object using the BufferGeometry dict ``geom`` as written by ``mesh_to_three``."""
+    if 'palette' in geom.get('userData', {}):
+        return palette_materials(geom['userData']['palette'])
+    return color_attr_material if 'color' in geom['data']['attributes'] else default_material
+
+
+def _mesh_material(mesh:Mesh, color=None, mat=None):
+    if mesh.colors is not None:
+        return color_attr_material
+    if color is not None:
+        return palette_material(color)
+    if mat is not None :
+        return mat
+    return default_material
 
-        else:
-            mat=default_material
 
-    mesh_object={
+def _mesh_object(mesh_geometry_uid:str, mat:dict, props:dict=None, name="MeshObject", matrix=None):
+    return {
             "uuid": uuid.uuid4().__str__(),
             "type": "Mesh",
             "name": name,
@@ -112,10 +223,8 @@ def mesh_to_three(mesh:Mesh,  props:dict=None,name="MeshObject",color=None, mat=
             "up": [0, 1, 0],
             "userData":{"properties":props if props is not None else {}},
             "geometry": mesh_geometry_uid,
-            "material": mat["uuid"],
+            "material": [m["uuid"] for m in mat] if isinstance(mat, list) else mat["uuid"],
         }
-
-    return mesh_object,geom,mat
 import numpy as np
 def points_to_three(pts:np.ndarray,  props:dict=None,name="MeshObject",matrix=None):
     mesh_geometry_uid=uuid.uuid4().__str__()
@@ -201,9 +310,10 @@ def add_geometry(root: dict, geom: dict):
 def add_mesh(root:dict, obj:dict, geom:dict, mat:dict):
     root['object']['children'].append(obj)
     add_geometry(root, geom)
-    if mat['uuid'] == default_material['uuid'] :
-        return
-    add_material(root, mat,check_exist=False)
+    for m in (mat if isinstance(mat, list) else [mat]):
+        if m['uuid'] == default_material['uuid'] :
+            continue
+        add_material(root, m,check_exist=isinstance(mat, list))
 
 
 def add_points(root:dict, obj:dict, geom:dict, mat:dict):
@@ -0,0 +1,130 @@
+"""
+Metadata index of an IFC model, built in one pass over the object definitions and the
+relationships the conversion needs, and shared by ``ifc_preprocess``, ``ifc_hierarchy``
+and ``ifc_psets``.
+
+>>> index = ModelIndex.build(ifc_file)
+>>> index.type_name(wall.id())
+'IfcWallStandardCase'
+>>> hierarchy = build_hierarchy(ifc_file, index=index)
+"""
+from __future__ import annotations
+
+from typing import Optional
+
+import ifcopenshell
+import numpy as np
+
+
+class ModelIndex:
+    """
+    Object definitions (products, project, type objects, ...) are stored in arrays sorted by
+    step id: the type code of each one and whether it has a Representation. Aggregation and
+    spatial containment are (parent, child) edge arrays in the order of the relationships.
+    Property definitions and type objects of each object are kept in dicts by step id.
+    """
+
+    def __init__(self,
+                 ids: np.ndarray,
+                 type_codes: np.ndarray,
+                 has_representation: np.ndarray,
+                 type_names: list[str],
+                 aggregates: np.ndarray,
+                 containment: np.ndarray,
+                 property_definitions: dict[int, list[int]],
+                 object_types: dict[int, int]):
+        self.ids = ids
+        self.type_codes = type_codes
+        self.has_representation = has_representation
+        self.type_names = type_names
+        self.aggregates = aggregates
+        self.containment = containment
+        self.property_definitions = property_definitions
+        self.object_types = object_types
+
+    @classmethod
+    def build(cls, ifc_file: ifcopenshell.file) -> "ModelIndex":
+        codes_by_name: dict[str, int] = {}
+        type_names = []
+        ids, type_codes, has_representation = [], [], []
+        for obj in ifc_file.by_type("IfcObjectDefinition"):
+            typ = obj.is_a()
+            code = codes_by_name.get(typ)
+            if code is None:
+                code = codes_by_name[typ] = len(type_names)
+                type_names.append(typ)
+            ids.append(obj.id())
+            type_codes.append(code)
+            has_representation.append(getattr(obj, "Representation", None) is not None)
+
+        ids = np.array(ids, dtype=np.int64)
+        order = np.argsort(ids, kind="stable")
+
+        def edges(rel_type, parent_attr, children_attr):
+            pairs = []
+            for rel in ifc_file.by_type(rel_type):
+                parent_id = getattr(rel, parent_attr).id()
+                pairs.extend((parent_id, child.id()) for child in getattr(rel, children_attr))
+            return np.array(pairs, dtype=np.int64).reshape((-1, 2))
+
+        property_definitions: dict[int, list[int]] = {}
+        for rel in ifc_file.by_type("IfcRelDefinesByProperties"):
+            definition = rel.RelatingPropertyDefinition
+            # IFC4 allows a set of property set definitions (IfcPropertySetDefinitionSet)
+            definition_ids = [d.id() for d in definition] if isinstance(definition, tuple) else [definition.id()]
+            for obj in rel.RelatedObjects:
+                property_definitions.setdefault(obj.id(), []).extend(definition_ids)
+        object_types: dict[int, int] = {}
+        for rel in ifc_file.by_type("IfcRelDefinesByType"):
+            type_id = rel.RelatingType.id()
+            for obj in rel.RelatedObjects:
+                object_types[obj.id()] = type_id
+
+        return cls(
+            ids[order],
+            np.array(type_codes, dtype=np.int32)[order],
+            np.array(has_representation, dtype=bool)[order],
+            type_names,
+            edges("IfcRelAggregates", "RelatingObject", "RelatedObjects"),
+            edges("IfcRelContainedInSpatialStructure", "RelatingStructure", "RelatedElements"),
+            property_definitions,
+            object_types,
+        )
+
+    def _position(self, step_id: int) -> Optional[int]:
+        i = int(np.searchsorted(self.ids, step_id))
+        if i < len(self.ids) and self.ids[i] == step_id:
+            return i
+        return None
+
+    def type_name(self, step_id: int) -> Optional[str]:
+        i = self._position(step_id)
+        return None if i is None else self.type_names[self.type_codes[i]]
+
+    def _type_mask(self, type_names) -> np.ndarray:
+        codes = [i for i, name in enumerate(self.type_names) if name in type_names]
+        return np.isin(self.type_codes, codes)
+
+    def products(self, excluded_types=None) -> np.ndarray:
+        """Ids of the object definitions with a Representation (i.e. products), excluding the given exact types."""
+        mask = self.has_representation.copy()
+        if excluded_types:
+            mask &= ~self._type_mask(set(excluded_types))
+        return self.ids[mask]
+
+    def categories(self, product_ids: np.ndarray) -> list[str]:
+        """Distinct type names of the given ids."""
+        positions = np.searchsorted(self.ids, product_ids)
+        return [self.type_names[c] for c in np.unique(self.type_codes[positions])]
+
+    def hierarchy_edges(self, include_spatial_hierarchy: bool = True) -> np.ndarray:
+        if include_spatial_hierarchy:
+            return np.concatenate((self.aggregates, self.containment))
+        return self.aggregates
+
+    def children(self, include_spatial_hierarchy: bool = True) -> dict[int, list[int]]:
+        """parent id -> child ids of the aggregation (and spatial containment) relationships."""
+        hierarchy: dict[int, list[int]] = {}
+        for parent_id, child_id in self.hierarchy_edges(include_spatial_hierarchy).tolist():
+            hierarchy.setdefault(parent_id, []).append(child_id)
+        return hierarchy
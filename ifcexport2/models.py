@@ -1,12 +1,35 @@
 from __future__ import annotations
 import dataclasses
 from collections import namedtuple
-from typing import List, Literal, Tuple, Union
+from typing import List, Literal, Optional, Tuple, Union
 
 from ifcexport2.mesh import Mesh
 
 IfcFail = namedtuple("IfcFail", ["item", "tb"])
-ImportFailList = Union[List, List[IfcFail]]
+
+
+@dataclasses.dataclass(slots=True)
+class FailAttempt:
+    # 'main' for the main pass, 'retry <n>' for the isolated retries
+    stage: str
+    reason: Literal['error', 'crash', 'timeout', 'empty']
+    detail: str = ''
+    settings: dict = dataclasses.field(default_factory=dict)
+    backend: Optional[str] = None
+
+
+@dataclasses.dataclass(slots=True)
+class ProductFail:
+    id: int
+    global_id: Optional[str]
+    type: str
+    name: Optional[str]
+    attempts: List[FailAttempt] = dataclasses.field(default_factory=list)
+    # True if one of the retries succeeded, the geometry may come from degraded settings
+    recovered: bool = False
+
+
+ImportFailList = Union[List, List[IfcFail], List[ProductFail]]
 
 @dataclasses.dataclass(slots=True,unsafe_hash=True)
 class IRGeometryObject:
@@ -18,6 +41,7 @@ class IRGeometryObject:
     transform: List[float]
     mesh:Mesh
     props:dict[str]= dataclasses.field(default_factory=dict)
+    geometry_id: Optional[str] = None
 
 
 
@@ -1,10 +1,13 @@
 import gc
-import struct
+import math
 import time
 
 import ujson
 
 from ifcexport2.mesh_to_three import Object3DStorage
+from ifcexport2.viewer_buffers import geometry_attributes, attribute_nbytes, encode_geometry
+from ifcexport2.quantize import quantize_geometry, apply_decode_matrix
+import numpy as np
 
 from typing import List, Optional
 from dataclasses import dataclass,field
@@ -217,6 +220,155 @@ def _split_subtree(node: Node,
 
 
 
+# Part count mode of partition_tree: the largest part may exceed the mean by this fraction
+TOLERANCE = 0.1
+
+
+@dataclass(slots=True)
+class PartitionReport:
+    """Achieved balance of a partition, sizes in bytes."""
+    parts: int
+    total: int
+    min: int
+    max: int
+    mean: float
+    # Largest unit (subtree kept whole) the parts were made of
+    unit: float
+
+    @property
+    def imbalance(self) -> float:
+        """The largest part over the mean part, 1.0 is a perfect balance."""
+        return self.max / self.mean if self.mean else 1.0
+
+
+class _FlatTree:
+    """
+    Nodes of a tree in depth first order with the range of leaves (in depth first order) below each,
+    so that the subtrees of a size can be selected and packed with array operations.
+    """
+
+    def __init__(self, root: Node):
+        self.nodes = []
+        parents, starts, ends, leaf_sizes = [], [], [], []
+        stack = [(root, -1)]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, int):
+                # All the leaves of node `item` are numbered
+                ends[item] = len(leaf_sizes)
+                continue
+            node, parent = item
+            i = len(self.nodes)
+            self.nodes.append(node)
+            parents.append(parent)
+            starts.append(len(leaf_sizes))
+            ends.append(0)
+            if node.is_leaf:
+                leaf_sizes.append(node.size)
+                ends[i] = len(leaf_sizes)
+            else:
+                stack.append(i)
+                stack.extend((child, i) for child in reversed(node.children))
+        self.start = np.array(starts, dtype=np.int64)
+        self.end = np.array(ends, dtype=np.int64)
+        self.leaf = np.array([n.is_leaf for n in self.nodes], dtype=bool)
+        self.cum = np.concatenate([[0], np.cumsum(np.array(leaf_sizes, dtype=np.int64))])
+        self.size = self.cum[self.end] - self.cum[self.start]
+        parents = np.array(parents, dtype=np.int64)
+        self.parent_size = np.where(parents >= 0, self.size[np.maximum(parents, 0)], np.iinfo(np.int64).max)
+        self.total = int(self.cum[-1])
+        self.leaves = len(leaf_sizes)
+
+    def units(self, limit: float) -> np.ndarray:
+        """The largest subtrees of at most ``limit`` bytes (leaves above it on their own), in depth first order."""
+        return np.flatnonzero((self.parent_size > limit) & ((self.size <= limit) | self.leaf) & (self.end > self.start))
+
+    def greedy_cuts(self, units: np.ndarray, capacity: float) -> np.ndarray:
+        """Fewest consecutive runs of ``units`` of at most ``capacity`` bytes, as unit indices of the run starts and end."""
+        bounds = self.cum[np.append(self.start[units], self.leaves)]
+        cuts = [0]
+        while cuts[-1] < len(units):
+            s = cuts[-1]
+            e = int(np.searchsorted(bounds, bounds[s] + capacity, 'right')) - 1
+            cuts.append(min(max(e, s + 1), len(units)))
+        return np.array(cuts)
+
+    def balanced_cuts(self, units: np.ndarray, parts: int) -> np.ndarray:
+        """Runs of ``units`` cut at the unit bounds nearest to the multiples of total / parts."""
+        bounds = self.cum[np.append(self.start[units], self.leaves)]
+        targets = self.total * np.arange(1, parts) / parts
+        right = np.clip(np.searchsorted(bounds, targets), 1, len(bounds) - 1)
+        nearest = np.where(bounds[right] - targets < targets - bounds[right - 1], right, right - 1)
+        return np.unique(np.concatenate([[0], nearest, [len(units)]]))
+
+    def part_sizes(self, units: np.ndarray, cuts: np.ndarray) -> np.ndarray:
+        bounds = self.cum[np.append(self.start[units], self.leaves)]
+        return bounds[cuts[1:]] - bounds[cuts[:-1]]
+
+
+def _balanced_partition(flat: _FlatTree, parts: int, limit: float):
+    """
+    (units, cuts, unit size) of ``parts`` even parts of at most ``limit`` bytes, None if even leaves do not allow it.
+    The parts are made of the subtrees of at most ``limit`` bytes, halved while the parts do not fit.
+    """
+    unit = limit
+    while True:
+        units = flat.units(unit)
+        cuts = flat.balanced_cuts(units, parts)
+        if len(cuts) - 1 == parts and flat.part_sizes(units, cuts).max() <= limit:
+            return units, cuts, unit
+        if flat.leaf[units].all() or unit < 1:
+            return None
+        unit /= 2
+
+
+def partition_tree(root: Node, parts: Optional[int] = None, max_part_bytes: Optional[int] = None,
+                   tolerance: float = TOLERANCE) -> tuple[List[Node], PartitionReport]:
+    """
+    Split a tree into parts of consecutive subtrees (in depth first order), returns the parts as groups
+    of original nodes and the achieved balance.
+
+    With ``max_part_bytes`` the parts are the fewest that fit it (only leaves larger than it exceed it),
+    cut as evenly as the budget allows. With ``parts`` the parts are cut as evenly as possible, the
+    largest within ``1 + tolerance`` of the mean if the leaves allow it. Whole subtrees (a storey, a
+    container) stay in one part where possible: the parts are made of the largest subtrees that fit,
+    finer subtrees are only used as long as the balance is off. Runs in O(n log n) of the tree size.
+
+    >>> groups, report = partition_tree(tree, max_part_bytes=64 * 1024 ** 2)
+    >>> report.parts, report.imbalance
+    """
+    if parts is None and max_part_bytes is None:
+        raise ValueError('A part count or a maximum part size is required')
+    flat = _FlatTree(root)
+    if flat.leaves == 0:
+        return [], PartitionReport(0, 0, 0, 0, 0.0, 0.0)
+
+    if max_part_bytes is not None:
+        # The fewest parts that fit, then the fewest cut evenly within the budget
+        units = flat.units(max_part_bytes)
+        cuts = flat.greedy_cuts(units, max_part_bytes)
+        unit = float(max_part_bytes)
+        for count in range(max(1, math.ceil(flat.total / max_part_bytes)), len(cuts) - 1):
+            balanced = _balanced_partition(flat, count, max_part_bytes)
+            if balanced is not None:
+                units, cuts, unit = balanced
+                break
+    else:
+        parts = max(1, min(parts, flat.leaves))
+        limit = (1 + tolerance) * flat.total / parts
+        balanced = _balanced_partition(flat, parts, limit)
+        if balanced is None:
+            # The leaves do not allow the tolerance, as even as they allow
+            units = flat.units(0)
+            balanced = units, flat.balanced_cuts(units, parts), 0.0
+        units, cuts, unit = balanced
+
+    sizes = flat.part_sizes(units, cuts)
+    groups = [Node(is_leaf=False, children=[flat.nodes[u] for u in units[a:b]]) for a, b in zip(cuts[:-1], cuts[1:])]
+    report = PartitionReport(len(groups), flat.total, int(sizes.min()), int(sizes.max()), float(sizes.mean()), unit)
+    return groups, report
+
+
 @dataclass
 class Object3DBuilder:
     materials: dict
@@ -242,7 +394,9 @@ class Object3DBuilder:
 
         self.geometries[obj['geometry']] = storage.geometries[obj['geometry']]
 
-        self.materials[obj['material']] = storage.materials[obj['material']]
+        # A list for objects with material groups
+        for mat in (obj['material'] if isinstance(obj['material'], list) else [obj['material']]):
+            self.materials[mat] = storage.materials[mat]
 
         self.object['children'].append(obj)
 
@@ -251,8 +405,18 @@ class Object3DBuilder:
         for g in group['children']:
             self.add_object(g, storage)
 
+    def add_lod_object(self, obj: dict, storage: Object3DStorage):
+        # The levels are kept together under their LOD object
+        for level in obj['children']:
+            self.geometries[level['geometry']] = storage.geometries[level['geometry']]
+            for mat in (level['material'] if isinstance(level['material'], list) else [level['material']]):
+                self.materials[mat] = storage.materials[mat]
+        self.object['children'].append(obj)
+
     def add_object(self, obj: dict, storage: Object3DStorage):
-        if 'geometry' in obj:
+        if obj.get('type') == 'LOD':
+            self.add_lod_object(obj, storage)
+        elif 'geometry' in obj:
             self.add_geometry_object(obj, storage)
         elif 'children' in obj:
             self.add_group(obj, storage)
@@ -272,40 +436,76 @@ class Object3DBuilder:
 
 
 def calculate_geometry_size(geom):
-    fmts={float:'d', int:'i'}
     sz=0
-    for k,v in geom['data']['attributes'].items():
-
-        sz+=struct.calcsize(f"{len(v['array'])}{fmts[type(v['array'][0])]}")
-    if 'index' in geom['data']:
-        v=geom['data']['index']
-        sz += struct.calcsize(f"{len(v['array'])}{fmts[type(v['array'][0])]}")
+    for v in geometry_attributes(geom):
+        if 'array' not in v:
+            # Stored in a binary buffer or as base64 data
+            sz+=attribute_nbytes(v)
+            continue
+        # As double or int arrays
+        sz+=len(v['array'])*(8 if v['array'] and isinstance(v['array'][0],float) else 4)
     return sz
-def _build_maps(root):
-    objects=dict()
 
-    geom={g['uuid']:g for g in root['geometries']}
-    mat = {g['uuid']: g for g in root['materials']}
+
+def _build_tree(obj, objects:dict, geometry_size):
+    """``Node`` tree of a three.js object, ``geometry_size(uuid)`` gives the leaf sizes, ``objects`` gets every object by uuid."""
 
     def inner(obj):
 
         objects[obj['uuid']]=obj
 
+        if obj.get('type')=='LOD':
+            # A leaf with the geometries of all its levels, see lod
+            return Node(is_leaf=True,size=sum(geometry_size(level['geometry']) for level in obj['children']),uid=obj['uuid'])
         if 'children' in obj and obj['children'] is not None:
             return Node(is_leaf=False,children=[inner(i) for i in obj['children']],uid=obj['uuid'])
         else:
-            return Node(is_leaf=True,size=calculate_geometry_size(geom[obj['geometry']]),uid=obj['uuid'])
+            return Node(is_leaf=True,size=geometry_size(obj['geometry']),uid=obj['uuid'])
 
+    return inner(obj)
 
 
-    return  inner(root['object']),Object3DStorage(objects,geom,mat)
+def _build_maps(root):
+    objects=dict()
+
+    geom={g['uuid']:g for g in root['geometries']}
+    mat = {g['uuid']: g for g in root['materials']}
+
+    return _build_tree(root['object'],objects,lambda uid:calculate_geometry_size(geom[uid])),Object3DStorage(objects,geom,mat)
 
 
 from ifcexport2.mesh_to_three import create_three_js_root,add_group,add_mesh,add_geometry,add_material
 
 
 import json
-def partition_viewer_json(root:dict, parts:int, name_prefix="Group"):
+def _quantize_part(jsn:dict, buffers:list, buffer=None):
+    """
+    Quantize the geometries of a part (see ``quantize``) and rebase it to its own origin: the centre of
+    its objects goes to the matrix of the part group, the objects are placed relative to it.
+    """
+    decodes = {}
+    geometries = []
+    for g in jsn['geometries']:
+        g, decodes[g['uuid']] = quantize_geometry(g, buffers, buffer)
+        geometries.append(g)
+    children = [{**obj, 'children': [{**level, 'matrix': apply_decode_matrix(level['matrix'], decodes[level['geometry']])}
+                                     for level in obj['children']]}
+                if obj.get('type') == 'LOD' else
+                {**obj, 'matrix': apply_decode_matrix(obj['matrix'], decodes[obj['geometry']])}
+                for obj in jsn['object']['children']]
+    if children:
+        translations = np.array([obj['matrix'][12:15] for obj in children])
+        origin = (translations.min(axis=0) + translations.max(axis=0)) / 2
+        for obj in children:
+            obj['matrix'][12:15] = (np.array(obj['matrix'][12:15]) - origin).tolist()
+        jsn['object'] = {**jsn['object'], 'children': children,
+                         'matrix': [1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0, *origin.tolist(), 1]}
+    jsn['geometries'] = geometries
+    return jsn
+
+
+def partition_viewer_json(root:dict, parts:Optional[int], name_prefix="Group", buffers:list=(), make_buffer=None,
+                          quantize:bool=False, max_part_bytes:Optional[int]=None, tolerance:float=TOLERANCE):
     """
     >>> import ujson
     >>> with open('A_Burj_Khalifa_District_SD_2023.viewer.json', 'r') as f:
@@ -327,14 +527,22 @@ def partition_viewer_json(root:dict, parts:int, name_prefix="Group"):
 
     Args:
         root:
-        parts:
+        parts: count of parts, see ``partition_tree``
         name_prefix:
+        buffers: loaded buffers of ``root`` (``viewer_buffers.load_buffers``), if its geometries refer to any
+        make_buffer: ``make_buffer(i)`` returns the buffer the geometries of part ``i`` are stored in,
+            it must be written out before the next part is requested. By default parts keep the
+            layout of ``root`` and refer to its buffers.
+        quantize: quantize the geometries of each part and rebase the part to its own origin
+        max_part_bytes: geometry budget of a part instead of a count, see ``partition_tree``
+        tolerance: balance tolerance with a part count, see ``partition_tree``
 
     Returns:
+        ``(jsn, perf)`` per part, ``perf['balance']`` is the ``PartitionReport`` of the partition
 
     """
     tree,storage=_build_maps(root)
-    trees=split_into_k_subtrees(tree,parts)
+    trees,report=partition_tree(tree,parts,max_part_bytes,tolerance)
     perf = dict(builder_init=0, builder_from_node=0, builder_to_three=0)
 
     for i, grp in enumerate(trees):
@@ -346,6 +554,15 @@ def partition_viewer_json(root:dict, parts:int, name_prefix="Group"):
         perf['builder_from_node'] += (time.time() - s2)
         s3 = time.time()
         jsn = builder.to_three()
+        buffer = make_buffer(i) if make_buffer is not None else None
+        if quantize:
+            jsn = _quantize_part(jsn, buffers, buffer)
+        elif make_buffer is not None:
+            jsn['geometries'] = [encode_geometry(g, buffers, buffer) for g in jsn['geometries']]
+        elif 'buffers' in root:
+            jsn['buffers'] = root['buffers']
+        if buffer is not None and buffer.entry() is not None:
+            jsn['buffers'] = [buffer.entry()]
         perf['builder_to_three'] += (time.time() - s3)
 
 
@@ -354,7 +571,7 @@ def partition_viewer_json(root:dict, parts:int, name_prefix="Group"):
 
         #gc.collect()
 
-        yield jsn, {**perf}
+        yield jsn, {**perf, 'balance': report}
 
 
 
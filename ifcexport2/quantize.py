@@ -0,0 +1,108 @@
+"""
+Quantized geometry attributes of the viewer JSON.
+
+Positions are rebased to the centre of their mesh's bounding box and stored as normalized
+``Int16Array``, colours as normalized ``Uint8Array`` and indices as ``Uint16Array`` when the
+geometry has fewer than 65,536 vertices. The decode matrix (normalized position -> mesh
+coordinates) is kept in the geometry's ``userData.decodeMatrix`` and multiplied into the
+matrix of every object using the geometry, so three.js renders quantized geometries as they are::
+
+    {"itemSize": 3, "type": "Int16Array", "normalized": true, "array": [-32767, 1202, 32767, ...]}
+
+Large (georeferenced) offsets end up in the float64 object matrices instead of the vertices.
+``partition_viewer_json(..., quantize=True)`` also rebases each part to its own origin.
+"""
+from __future__ import annotations
+
+from typing import Optional
+
+import numpy as np
+
+from ifcexport2.viewer_buffers import Buffer, attribute, attribute_array, encode_geometry
+
+INT16_MAX = 32767
+UINT16_VERTICES = 1 << 16
+
+
+def quantize_positions(position: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """(n, 3) positions -> normalized int16 positions and the 4x4 decode matrix."""
+    position = np.asarray(position, dtype=np.float64).reshape((-1, 3))
+    if len(position) == 0:
+        return np.zeros((0, 3), dtype=np.int16), np.eye(4)
+    lo, hi = position.min(axis=0), position.max(axis=0)
+    center = (lo + hi) / 2
+    half = (hi - lo) / 2
+    half[half < 1e-12] = 1.0
+    quantized = np.rint((position - center) / half * INT16_MAX)
+    np.clip(quantized, -INT16_MAX, INT16_MAX, out=quantized)
+    decode = np.diag([*half, 1.0])
+    decode[:3, 3] = center
+    return quantized.astype(np.int16), decode
+
+
+def quantize_colors(colors: np.ndarray) -> np.ndarray:
+    return np.rint(np.clip(np.asarray(colors, dtype=np.float32), 0.0, 1.0) * 255).astype(np.uint8)
+
+
+def index_attribute(faces: np.ndarray, vertices_count: int, buffer: Optional[Buffer] = None) -> dict:
+    type_name = "Uint16Array" if vertices_count < UINT16_VERTICES else "Uint32Array"
+    return attribute(np.asarray(faces).reshape(-1), 1, type_name, buffer)
+
+
+def decode_matrix(geom: dict) -> Optional[np.ndarray]:
+    decode = geom.get("userData", {}).get("decodeMatrix")
+    return None if decode is None else np.array(decode, dtype=np.float64).reshape((4, 4), order="F")
+
+
+def apply_decode_matrix(matrix, decode: Optional[np.ndarray]) -> list[float]:
+    """Column-major object ``matrix`` (list of 16 or 4x4, None for identity) with ``decode`` applied first."""
+    if matrix is None:
+        matrix = np.eye(4)
+    elif np.ndim(matrix) == 1:
+        matrix = np.array(matrix, dtype=np.float64).reshape((4, 4), order="F")
+    matrix = np.asarray(matrix, dtype=np.float64)
+    if decode is not None:
+        matrix = matrix @ decode
+    return matrix.flatten(order="F").tolist()
+
+
+def quantized_geometry_data(position, faces, colors=None, buffer: Optional[Buffer] = None) -> tuple[dict, np.ndarray]:
+    """``data`` of a quantized BufferGeometry and its decode matrix."""
+    quantized, decode = quantize_positions(position)
+    position_attr = attribute(quantized, 3, "Int16Array", buffer)
+    position_attr["normalized"] = True
+    data = {"attributes": {"position": position_attr}}
+    if faces is not None:
+        data["index"] = index_attribute(faces, len(quantized), buffer)
+    if colors is not None:
+        colors = np.asarray(colors)
+        color_attr = attribute(quantize_colors(colors), int(colors.shape[-1]), "Uint8Array", buffer)
+        color_attr["normalized"] = True
+        data["attributes"]["color"] = color_attr
+    return data, decode
+
+
+def quantize_geometry(geom: dict, buffers: list, buffer: Optional[Buffer] = None) -> tuple[dict, Optional[np.ndarray]]:
+    """
+    Quantized copy of a BufferGeometry dict (``buffers`` as in ``viewer_buffers.encode_geometry``)
+    and the decode matrix the objects using it must apply. Already quantized geometries are only
+    re-encoded into ``buffer``, the returned decode matrix is None then (their objects already apply it).
+    """
+    if decode_matrix(geom) is not None:
+        return encode_geometry(geom, buffers, buffer), None
+    attributes = geom["data"]["attributes"]
+    position = attribute_array(attributes["position"], buffers).reshape((-1, attributes["position"]["itemSize"]))
+    faces = attribute_array(geom["data"]["index"], buffers) if "index" in geom["data"] else None
+    colors = None
+    if "color" in attributes and attributes["color"]["type"].startswith("Float"):
+        colors = attribute_array(attributes["color"], buffers).reshape((-1, attributes["color"]["itemSize"]))
+    data, decode = quantized_geometry_data(position, faces, colors, buffer)
+    # Groups, ...
+    data = {**{k: v for k, v in geom["data"].items() if k not in ("attributes", "index")}, **data}
+    # Attributes that are not quantized (normals, uvs, ...) are kept as they are
+    rest = {k: v for k, v in attributes.items() if k not in data["attributes"]}
+    if rest:
+        encoded = encode_geometry({"data": {"attributes": rest}}, buffers, buffer)
+        data["attributes"].update(encoded["data"]["attributes"])
+    user_data = {**geom.get("userData", {}), "decodeMatrix": decode.flatten(order="F").tolist()}
+    return {**geom, "data": data, "userData": user_data}, decode
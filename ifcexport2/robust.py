@@ -0,0 +1,219 @@
+"""
+Per-product fallback conversion.
+
+The main multi-threaded pass of the geometry iterator runs normally, in this process. Only the
+products it fails on are retried: those raising in ``parse_geom_item`` and those the iterator
+reports an error for in the ifcopenshell log (it skips them). Products without a shape and without
+an error are left out as in a normal pass. Each retry runs one product in a forked process of a
+pool, with a timeout and progressively degraded settings, so a product that crashes or hangs in
+the C++ iterator only ends its process. Products that fail every attempt land in the fail list
+instead of aborting the conversion.
+
+>>> stream = convert_stream(ifc_file, ConvertArguments(), robust=RobustPolicy())
+>>> objects = list(stream.objects)
+>>> stream.fails  # filled once the objects are consumed
+"""
+from __future__ import annotations
+
+import collections
+import dataclasses
+import json
+import multiprocessing
+import re
+import time
+import traceback
+from multiprocessing.connection import wait
+from typing import Iterator, Optional
+
+import ifcopenshell
+import ifcopenshell.geom
+import ifcopenshell.ifcopenshell_wrapper
+import rich
+from ifcopenshell.entity_instance import entity_instance
+
+from ifcexport2.models import IRGeometryObject, ProductFail, FailAttempt
+
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class RetryAttempt:
+    """Settings overrides and geometry backend of one isolated retry."""
+    settings: dict = dataclasses.field(default_factory=dict)
+    backend: Optional[str] = None
+
+
+DEFAULT_RETRY_ATTEMPTS = (
+    # The main pass settings, one product and one thread
+    RetryAttempt(),
+    RetryAttempt({'DISABLE_OPENING_SUBTRACTIONS': True}),
+    RetryAttempt({'DISABLE_OPENING_SUBTRACTIONS': True}, backend='cgal'),
+)
+
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class RobustPolicy:
+    # Seconds allowed for one product in one retry
+    timeout: float = 60.0
+    attempts: tuple[RetryAttempt, ...] = DEFAULT_RETRY_ATTEMPTS
+    # Retry processes running at once, cpu count - 1 by default
+    workers: Optional[int] = None
+
+
+_LOGGED_INSTANCE = re.compile(r"#(\d+)=")
+
+
+def _logged_errors(log: str) -> dict[int, list[str]]:
+    """Step id -> messages of the errors in a JSON formatted ifcopenshell log."""
+    errors = collections.defaultdict(list)
+    for line in log.splitlines():
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        match = _LOGGED_INSTANCE.match(entry.get("instance", ""))
+        if entry.get("level") == "Error" and match:
+            errors[int(match[1])].append(f'{entry.get("message", "")} {entry["instance"]}')
+    return errors
+
+
+def _product_errors(product: entity_instance, errors: dict[int, list[str]]) -> list[str]:
+    """Logged errors of ``product`` or of its representations."""
+    messages = list(errors.get(product.id(), ()))
+    for rep in product.Representation.Representations:
+        messages.extend(errors.get(rep.id(), ()))
+    return messages
+
+
+def _retry_product(conn, ifc_file, product_id, settings, backend):
+    from ifcexport2.ifc_to_mesh import geom_settings, parse_geom_item
+    try:
+        kwargs = {} if backend is None else {'geometry_library': backend}
+        iterator = ifcopenshell.geom.iterator(geom_settings(settings), ifc_file, 1,
+                                              include=[ifc_file.by_id(product_id)], **kwargs)
+        if not iterator.initialize():
+            conn.send(('empty', 'The geometry iterator produced no shape.'))
+            return
+        success, obj, mesh_or_tb = parse_geom_item(iterator.get())
+        conn.send(('object', obj) if success else ('error', mesh_or_tb[1]))
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+def _exit_detail(proc) -> str:
+    if proc.exitcode is not None and proc.exitcode < 0:
+        return f'Killed by signal {-proc.exitcode}.'
+    return f'Exited with code {proc.exitcode}.'
+
+
+def _new_fail(product: entity_instance) -> ProductFail:
+    return ProductFail(product.id(), getattr(product, 'GlobalId', None), product.is_a(), getattr(product, 'Name', None))
+
+
+def process_isolated_geometry_items(
+        ifc_file: ifcopenshell.file,
+        products: list[entity_instance],
+        make_iterator,
+        settings: dict,
+        excluded_types: list[str],
+        instancing: bool = False,
+        policy: RobustPolicy = RobustPolicy(),
+        fails: Optional[list[ProductFail]] = None,
+) -> Iterator[IRGeometryObject]:
+    """
+    Yield IRGeometryObject for each product, like ``process_ifc_geometry_items(make_iterator(include=products))``,
+    with the failed products retried in isolation.
+    ``settings`` are the settings of ``make_iterator``, the retries apply their overrides on top of them.
+    Failures are appended to ``fails``.
+    """
+    if fails is None:
+        fails = []
+    from ifcexport2.ifc_to_mesh import process_ifc_geometry_items
+    ctx = multiprocessing.get_context('fork')
+
+    # Main pass, the iterator errors are read back from the log
+    received = set()
+    main_fails: list[ProductFail] = []
+    ifcopenshell.ifcopenshell_wrapper.set_log_format_json()
+    ifcopenshell.get_log()
+    try:
+        for obj in process_ifc_geometry_items(make_iterator(include=products), excluded_types,
+                                              instancing=instancing, fails=main_fails):
+            received.add(obj.id)
+            yield obj
+        errors = _logged_errors(ifcopenshell.get_log())
+    finally:
+        ifcopenshell.ifcopenshell_wrapper.set_log_format_text()
+
+    # Isolated retries of the products that raised or were skipped with an error
+    product_fails = {f.id: f for f in main_fails}
+    for product in products:
+        if product.id() in received or product.id() in product_fails:
+            continue
+        messages = _product_errors(product, errors)
+        if messages:
+            fail = _new_fail(product)
+            fail.attempts.append(FailAttempt('main', 'error', '\n'.join(messages)))
+            product_fails[product.id()] = fail
+    queue = collections.deque((product_id, 0) for product_id in product_fails)
+    if not queue:
+        return None
+
+    workers = policy.workers or max(multiprocessing.cpu_count() - 1, 1)
+    active = {}
+    try:
+        while queue or active:
+            while queue and len(active) < workers:
+                product_id, i = queue.popleft()
+                attempt = policy.attempts[i]
+                recv_conn, send_conn = ctx.Pipe(duplex=False)
+                proc = ctx.Process(target=_retry_product,
+                                   args=(send_conn, ifc_file, product_id, {**settings, **attempt.settings},
+                                         attempt.backend),
+                                   daemon=True)
+                proc.start()
+                send_conn.close()
+                active[recv_conn] = (proc, product_id, i, time.monotonic() + policy.timeout)
+
+            deadline = min(v[3] for v in active.values())
+            ready = wait(list(active), timeout=max(deadline - time.monotonic(), 0))
+            now = time.monotonic()
+            for conn, (proc, product_id, i, deadline) in list(active.items()):
+                if conn in ready:
+                    try:
+                        kind, payload = conn.recv()
+                    except EOFError:
+                        proc.join()
+                        kind, payload = 'crash', _exit_detail(proc)
+                elif now >= deadline:
+                    kind, payload = 'timeout', f'No shape in {policy.timeout} s.'
+                else:
+                    continue
+                del active[conn]
+                conn.close()
+                if proc.is_alive():
+                    proc.kill()
+                proc.join()
+
+                attempt = policy.attempts[i]
+                fail = product_fails[product_id]
+                if kind == 'object':
+                    fail.recovered = True
+                    fails.append(fail)
+                    if attempt.settings or attempt.backend is not None:
+                        payload.props['degraded'] = {'settings': attempt.settings, 'backend': attempt.backend}
+                    yield payload
+                    continue
+                fail.attempts.append(FailAttempt(f'retry {i + 1}', kind, payload, attempt.settings, attempt.backend))
+                if i + 1 < len(policy.attempts):
+                    queue.append((product_id, i + 1))
+                else:
+                    rich.print(f'[red][bold]import fail: #{product_id} {fail.type} ({kind})[/bold][/red]')
+                    fails.append(fail)
+    finally:
+        for conn, (proc, *_) in active.items():
+            if proc.is_alive():
+                proc.kill()
+            proc.join()
+            conn.close()
+    return None
@@ -0,0 +1,282 @@
+"""
+Streaming, bounded-memory split of the viewer JSON.
+
+``partition_viewer_json`` needs the whole file parsed: a 3 GB viewer JSON takes well over 10 GB to
+split. Here the file is read incrementally (``JsonObjectReader``), every geometry is parsed on
+its own, sized and its raw text spilled to a temporary file, so the geometries are never held in
+memory at once. The object tree and the materials (small compared to the geometry) are parsed
+whole, partitioned as usual (``partition.partition_tree``), and the parts are written by a
+process pool, each worker reading the geometries of its part from the memory-mapped spill file.
+Parts without buffers are written from the raw geometry text without parsing it again. Peak
+memory is the object tree plus about one part per worker.
+
+>>> outs, report = split_viewer_json_stream('model.viewer.json', 8, 'parts/', workers=4)
+"""
+from __future__ import annotations
+
+import collections
+import contextlib
+import json
+import mmap
+import multiprocessing
+import os
+import re
+import tempfile
+from pathlib import Path
+from typing import Callable, Optional, TextIO, Union
+
+import ujson
+
+from ifcexport2.mesh_to_three import Object3DStorage
+from ifcexport2.partition import Object3DBuilder, PartitionReport, partition_tree, calculate_geometry_size, \
+    _build_tree, _quantize_part, TOLERANCE
+from ifcexport2.viewer_buffers import GeometryBuffer, BIN_SUFFIX, encode_geometry, load_buffers
+
+CHUNK_SIZE = 1 << 20
+WHITESPACE = " \t\r\n"
+DELIMITERS = WHITESPACE + ",:]}"
+# The next bracket or string (with its closing quote, if in the buffer) after any numbers and separators
+TOKEN = re.compile(r'[^\[\]{}"]*(?:([\[{])|([\]}])|("(?:[^"\\]|\\.)*(")?))')
+
+
+class JsonObjectReader:
+    """
+    Top-level members of a JSON object read incrementally from a text file. The arrays of
+    ``streamed`` keys are yielded element by element, with the raw text of each element.
+
+    >>> for key, value, raw in JsonObjectReader(f).members(streamed=('geometries',)):
+    ...     ...
+    """
+
+    def __init__(self, fp: TextIO, chunk_size: int = CHUNK_SIZE):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _read(self, size: int) -> bool:
+        data = self.fp.read(size)
+        self.eof = not data
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return bool(data)
+
+    def _peek(self) -> str:
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._read(self.chunk_size):
+                raise ValueError("Unexpected end of JSON")
+
+    def _expect(self, chars: str) -> str:
+        c = self._peek()
+        if c not in chars:
+            raise ValueError(f"Expected one of {chars!r}, got {c!r}")
+        self.pos += 1
+        return c
+
+    def _value(self, raw: bool = False):
+        """The next value, (value, raw text) if ``raw``."""
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number at the end of the buffer may go on in the next chunk
+                if self.eof or (end < len(self.buf) and self.buf[end] in DELIMITERS):
+                    text = self.buf[self.pos:end] if raw else None
+                    self.pos = end
+                    return (value, text) if raw else value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Incomplete value, read at least as much again so large values take few attempts
+            self._read(max(self.chunk_size, len(self.buf) - self.pos))
+
+    def _raw_value(self) -> tuple:
+        """The next value and its raw text. Arrays and objects are scanned for their end and parsed by ujson."""
+        if self._peek() not in "[{":
+            return self._value(raw=True)
+        depth = 0
+        offset = self.pos
+        while True:
+            m = TOKEN.match(self.buf, offset)
+            if m is None or (m.group(3) is not None and m.group(4) is None):
+                # No bracket or an unterminated string up to the end of the buffer
+                if self.eof:
+                    raise ValueError("Unexpected end of JSON")
+                offset -= self.pos
+                self._read(max(self.chunk_size, len(self.buf) - self.pos))
+                continue
+            offset = m.end()
+            if m.group(1) is not None:
+                depth += 1
+            elif m.group(2) is not None:
+                depth -= 1
+                if depth == 0:
+                    break
+        text = self.buf[self.pos:offset]
+        self.pos = offset
+        return ujson.loads(text), text
+
+    def members(self, streamed: tuple[str, ...] = ()):
+        """Yields (key, value, None) per member, (key, element, raw text) per element of the ``streamed`` arrays."""
+        self._expect("{")
+        if self._peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(":")
+            if key in streamed and self._peek() == "[":
+                self.pos += 1
+                if self._peek() == "]":
+                    self.pos += 1
+                else:
+                    while True:
+                        yield (key, *self._raw_value())
+                        if self._expect(",]") == "]":
+                            break
+            else:
+                yield key, self._value(), None
+            if self._expect(",}") == "}":
+                return
+
+
+def spill_viewer_json(fp: TextIO, spill) -> tuple[dict, dict]:
+    """
+    Reads a viewer JSON, writing the raw text of the geometries to the binary file ``spill``.
+    Returns the other members of the root and ``uuid -> (offset, length, size)`` of the geometries.
+    """
+    root = {}
+    refs = {}
+    offset = spill.tell()
+    for key, value, raw in JsonObjectReader(fp).members(streamed=("geometries",)):
+        if key != "geometries":
+            root[key] = value
+            continue
+        data = raw.encode("utf-8")
+        spill.write(data)
+        refs[value["uuid"]] = (offset, len(data), calculate_geometry_size(value))
+        offset += len(data)
+    return root, refs
+
+
+class _PartTask:
+    """A part to write: its three.js root with ``(offset, length)`` spill refs in place of the geometries."""
+    __slots__ = ("path", "bin_path", "jsn", "spill_path", "buffer_entries", "base_dir", "quantize")
+
+    def __init__(self, path, bin_path, jsn, spill_path, buffer_entries, base_dir, quantize):
+        self.path = path
+        self.bin_path = bin_path
+        self.jsn = jsn
+        self.spill_path = spill_path
+        self.buffer_entries = buffer_entries
+        self.base_dir = base_dir
+        self.quantize = quantize
+
+
+def _write_part(task: _PartTask) -> list[str]:
+    jsn = task.jsn
+    texts = []
+    if jsn["geometries"]:
+        with open(task.spill_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as spill:
+            texts = [spill[offset:offset + length].decode("utf-8") for offset, length in jsn["geometries"]]
+    if task.bin_path is None and not task.quantize:
+        # The raw text of the geometries goes as it is
+        with open(task.path, "w", encoding="utf-8") as f:
+            f.write('{"metadata":')
+            f.write(ujson.dumps(jsn["metadata"]))
+            f.write(',"geometries":[')
+            f.write(",".join(texts))
+            f.write('],"materials":')
+            f.write(ujson.dumps(jsn["materials"], ensure_ascii=False))
+            f.write(',"object":')
+            f.write(ujson.dumps(jsn["object"], ensure_ascii=False))
+            f.write("}")
+        return [str(task.path)]
+
+    jsn["geometries"] = [ujson.loads(t) for t in texts]
+    del texts
+    buffers = load_buffers({"buffers": task.buffer_entries}, task.base_dir)
+    outs = []
+    with (open(task.bin_path, "wb") if task.bin_path is not None else contextlib.nullcontext()) as bin_file:
+        buffer = GeometryBuffer(bin_file, Path(task.bin_path).name) if bin_file is not None else None
+        if task.quantize:
+            jsn = _quantize_part(jsn, buffers, buffer)
+        else:
+            jsn["geometries"] = [encode_geometry(g, buffers, buffer) for g in jsn["geometries"]]
+        if buffer is not None and buffer.entry() is not None:
+            jsn["buffers"] = [buffer.entry()]
+            outs.append(str(task.bin_path))
+    with open(task.path, "w", encoding="utf-8") as f:
+        ujson.dump(jsn, f, ensure_ascii=False)
+    return [str(task.path)] + outs
+
+
+def split_viewer_json_stream(input_path: Union[str, Path], parts: Optional[int], output_dir: Union[str, Path],
+                             name: Optional[str] = None, quantize: bool = False, workers: Optional[int] = None,
+                             spill_dir: Union[str, Path, None] = None,
+                             progress: Optional[Callable[[int, int], None]] = None,
+                             max_part_bytes: Optional[int] = None,
+                             tolerance: float = TOLERANCE) -> tuple[list[str], PartitionReport]:
+    """
+    Split a viewer JSON file into ``<name>-<i>.viewer.json`` parts in ``output_dir``, as the ``split`` command.
+    Parts of an input with buffers get their own ``<name>-<i>.viewer.bin``, ``quantize``, ``max_part_bytes``
+    and ``tolerance`` are as in ``partition.partition_viewer_json``. ``workers`` processes write the parts (0 writes them in this
+    process, None uses the CPU count). The spill file goes to ``spill_dir`` (the output directory by
+    default). ``progress(done, total)`` is called as parts are written. Returns the written files and the
+    balance of the partition.
+    """
+    input_path = Path(input_path)
+    output_dir = Path(output_dir)
+    if name is None:
+        name = input_path.name.split(".")[0]
+    fd, spill_path = tempfile.mkstemp(dir=spill_dir or output_dir, prefix=f".{name}-", suffix=".spill")
+    try:
+        with os.fdopen(fd, "wb") as spill, input_path.open("r", encoding="utf-8") as f:
+            root, refs = spill_viewer_json(f, spill)
+
+        objects = {}
+        tree = _build_tree(root["object"], objects, lambda uid: refs[uid][2])
+        storage = Object3DStorage(objects, {uid: ref[:2] for uid, ref in refs.items()},
+                                  {m["uuid"]: m for m in root.get("materials", ())})
+        trees, report = partition_tree(tree, parts, max_part_bytes, tolerance)
+        buffer_entries = root.get("buffers", [])
+        outs = []
+
+        def tasks():
+            for i, grp in enumerate(trees):
+                builder = Object3DBuilder(f"{name}-{i}", {"part": name})
+                builder.from_node(grp, storage)
+                yield _PartTask(output_dir / f"{name}-{i}.viewer.json",
+                                output_dir / f"{name}-{i}.viewer{BIN_SUFFIX}" if buffer_entries else None,
+                                builder.to_three(), spill_path, buffer_entries, input_path.parent, quantize)
+
+        def finish(files):
+            outs.extend(files)
+            if progress is not None:
+                progress(sum(1 for o in outs if o.endswith(".json")), len(trees))
+
+        if workers is None:
+            workers = min(multiprocessing.cpu_count(), len(trees))
+        if workers == 0:
+            for task in tasks():
+                finish(_write_part(task))
+            return outs, report
+
+        # Parts are submitted as workers free up, so only a few part trees are pickled at once
+        pending = collections.deque()
+        with multiprocessing.get_context("spawn").Pool(workers) as pool:
+            for task in tasks():
+                pending.append(pool.apply_async(_write_part, (task,)))
+                if len(pending) >= 2 * workers:
+                    finish(pending.popleft().get())
+            while pending:
+                finish(pending.popleft().get())
+        return outs, report
+    finally:
+        os.unlink(spill_path)
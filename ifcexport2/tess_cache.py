@@ -0,0 +1,253 @@
+"""
+Persistent content-addressed cache of tessellated products.
+
+Entries are keyed by a hash of everything that affects the tessellation of a product: its
+representation subgraph, placement, openings, styles and materials, the project units and
+the effective iterator settings. Step ids are not part of the key (references are replaced
+by the hash of the referenced entity), so a re-exported model with only property edits
+still hits the cache.
+
+The iterator geometry id an entry was tessellated with is only meaningful in the file it came
+from, so a loaded object gets ``cache_uid(entry)`` instead: the digest of its arrays. Hits of
+the same geometry share it (and one Mesh with instancing), and it cannot collide with the ids
+of the shapes tessellated from the current file.
+
+>>> cache = TessellationCache(VOLUME_PATH / "tess-cache", max_bytes=10 * 1024 ** 3)
+>>> stream = convert_stream(ifc_file, ConvertArguments(), cache=cache)
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional, Union
+
+import ifcopenshell
+import numpy as np
+from ifcopenshell.entity_instance import entity_instance
+
+from ifcexport2.mesh import Mesh
+from ifcexport2.models import IRGeometryObject
+
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+
+
+def settings_digest(settings: dict, backend: Optional[str] = None) -> bytes:
+    """Digest of the effective iterator settings, geometry backend and ifcopenshell version."""
+    data = json.dumps(
+        {"settings": settings, "backend": backend, "ifcopenshell": ifcopenshell.version},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.blake2b(data.encode(), digest_size=16).digest()
+
+
+UID_PREFIX = "cache-"
+MESH_ARRAYS = ("position", "faces", "colors", "material_ids", "materials")
+
+
+def mesh_digest(arrays: dict) -> str:
+    """Digest of the mesh arrays of an entry (``position``, ``faces``, colours and materials)."""
+    h = hashlib.blake2b(digest_size=16)
+    for name in MESH_ARRAYS:
+        array = arrays.get(name)
+        h.update(name.encode())
+        if array is not None:
+            array = np.ascontiguousarray(array)
+            h.update(f"{array.dtype.str}{array.shape}".encode())
+            h.update(array.data)
+    return h.hexdigest()
+
+
+def cache_uid(entry: dict) -> str:
+    """Mesh uid (and geometry id) of the objects loaded from ``entry``, unique across files."""
+    return UID_PREFIX + entry["meta"]["mesh_digest"]
+
+
+class RepresentationHasher:
+    """
+    Stable content hashes of the entities a product's tessellation depends on.
+
+    Entity digests are memoized by step id, so subgraphs shared between products
+    (mapped representations, placements, styles) are hashed once per file.
+    """
+
+    def __init__(self, ifc_file: ifcopenshell.file, settings: dict, backend: Optional[str] = None):
+        self._settings_digest = settings_digest(settings, backend)
+        self._memo: dict[int, bytes] = {}
+        # Inverse relationships that change the result of the tessellation. Only the attributes
+        # pointing away from the referenced entity are hashed, to avoid cycles.
+        self._extras: dict[int, list] = {}
+        for styled in ifc_file.by_type("IfcStyledItem"):
+            if styled.Item is not None:
+                self._extras.setdefault(styled.Item.id(), []).append(styled.Styles)
+        for definition in ifc_file.by_type("IfcMaterialDefinitionRepresentation"):
+            self._extras.setdefault(definition.RepresentedMaterial.id(), []).append(definition.Representations)
+        self._openings: dict[int, list[entity_instance]] = {}
+        for rel in ifc_file.by_type("IfcRelVoidsElement"):
+            self._openings.setdefault(rel.RelatingBuildingElement.id(), []).append(rel.RelatedOpeningElement)
+        self._materials: dict[int, list[entity_instance]] = {}
+        for rel in ifc_file.by_type("IfcRelAssociatesMaterial"):
+            for obj in rel.RelatedObjects:
+                self._materials.setdefault(obj.id(), []).append(rel.RelatingMaterial)
+        self._types: dict[int, entity_instance] = {}
+        for rel in ifc_file.by_type("IfcRelDefinesByType"):
+            for obj in rel.RelatedObjects:
+                self._types[obj.id()] = rel.RelatingType
+        units = hashlib.blake2b(digest_size=16)
+        self._update(units, tuple(ifc_file.by_type("IfcUnitAssignment")))
+        self._units_digest = units.digest()
+
+    def entity_digest(self, inst: entity_instance) -> bytes:
+        step_id = inst.id()
+        if step_id and step_id in self._memo:
+            return self._memo[step_id]
+        h = hashlib.blake2b(digest_size=16)
+        h.update(inst.is_a().encode())
+        for i in range(len(inst)):
+            self._update(h, inst[i])
+        for extra in self._extras.get(step_id, ()):
+            h.update(b"+")
+            self._update(h, extra)
+        digest = h.digest()
+        if step_id:
+            self._memo[step_id] = digest
+        return digest
+
+    def _update(self, h, value):
+        if isinstance(value, entity_instance):
+            h.update(b"#")
+            h.update(self.entity_digest(value))
+        elif isinstance(value, (tuple, list)):
+            h.update(b"(")
+            for v in value:
+                self._update(h, v)
+                h.update(b",")
+            h.update(b")")
+        elif value is None:
+            h.update(b"$")
+        else:
+            h.update(repr(value).encode())
+
+    def product_key(self, product: entity_instance) -> str:
+        h = hashlib.blake2b(digest_size=20)
+        h.update(self._settings_digest)
+        h.update(self._units_digest)
+        h.update(product.is_a().encode())
+        self._update(h, (product.Representation, product.ObjectPlacement))
+        step_id = product.id()
+        for opening in self._openings.get(step_id, ()):
+            self._update(h, (opening.Representation, opening.ObjectPlacement))
+        self._update(h, tuple(self._materials.get(step_id, ())))
+        product_type = self._types.get(step_id)
+        if product_type is not None:
+            self._update(h, tuple(self._materials.get(product_type.id(), ())))
+        return h.hexdigest()
+
+
+class TessellationCache:
+    """
+    On-disk cache of the arrays produced by ``parse_geom_item``, with a size limit and
+    LRU eviction (the modification time of an entry is bumped on every hit).
+
+    Entries are written atomically, so a cache directory can be shared by several workers.
+    """
+
+    def __init__(self, directory: Union[str, Path], max_bytes: int = DEFAULT_MAX_BYTES):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = sum(p.stat().st_size for p in self._entries())
+
+    def _entries(self):
+        return self.directory.glob("*/*.npz")
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.npz"
+
+    def get(self, key: str) -> Optional[dict]:
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                entry = {k: data[k] for k in data.files}
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            # Missing, evicted by another worker or partially written.
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry["meta"] = json.loads(str(entry["meta"]))
+        return entry
+
+    def put(self, key: str, obj: IRGeometryObject):
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        arrays = dict(
+            position=obj.mesh.position,
+            faces=obj.mesh.faces,
+        )
+        if obj.mesh.colors is not None:
+            arrays["colors"] = obj.mesh.colors
+        if obj.mesh.material_ids is not None:
+            arrays["material_ids"] = obj.mesh.material_ids
+            arrays["materials"] = obj.mesh.materials
+        meta = {"context": obj.context, "parent_id": obj.parent_id, "mesh_digest": mesh_digest(arrays)}
+        arrays["transform"] = np.asarray(obj.transform)
+        arrays["meta"] = np.array(json.dumps(meta))
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            try:
+                # The entry of the same key written meanwhile (by another worker) is replaced
+                self._size -= path.stat().st_size
+            except FileNotFoundError:
+                pass
+            os.replace(tmp, path)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+        self._size += path.stat().st_size
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self, target_bytes: Optional[int] = None):
+        """Remove least recently used entries until the cache is below ``target_bytes`` (90% of the limit by default)."""
+        if target_bytes is None:
+            target_bytes = int(self.max_bytes * 0.9)
+        entries = []
+        for p in self._entries():
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, p))
+        entries.sort()
+        self._size = sum(e[1] for e in entries)
+        for _, size, p in entries:
+            if self._size <= target_bytes:
+                break
+            p.unlink(missing_ok=True)
+            self._size -= size
+
+    def load_object(self, entry: dict, product: entity_instance, mesh: Optional[Mesh] = None) -> IRGeometryObject:
+        """``product`` with the geometry of ``entry``, or ``mesh`` if given (a Mesh loaded with the same ``cache_uid``)."""
+        meta = entry["meta"]
+        uid = cache_uid(entry)
+        if mesh is None:
+            mesh = Mesh(entry["position"], faces=entry["faces"], colors=entry.get("colors"), uid=uid,
+                        material_ids=entry.get("material_ids"), materials=entry.get("materials"))
+        return IRGeometryObject(
+            id=product.id(),
+            type=product.is_a(),
+            name=product.Name,
+            context=meta["context"],
+            parent_id=meta["parent_id"],
+            transform=entry["transform"],
+            mesh=mesh,
+            geometry_id=uid,
+        )
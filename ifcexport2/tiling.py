@@ -0,0 +1,290 @@
+"""
+Spatial tiling of the viewer JSON for progressive loading.
+
+``partition.split_into_k_subtrees`` splits by hierarchy and size, so each part is scattered over
+the whole model. Here the world bounding boxes of all meshes are computed at once from the
+vertex buffers, and a loose octree is built over their centres: a tile whose objects exceed the
+byte budget is split into octants, objects larger than an octant stay in the tile. Every tile
+with objects is written as a viewer JSON (with its own ``*.bin`` if the input has external
+buffers), the tree goes to a tileset manifest in the spirit of 3D Tiles (``refine: ADD``, parent
+content is shown together with the children)::
+
+    {"asset": {"version": "1.1", "generator": "ifcexport2"}, "geometricError": 12.5,
+     "root": {"boundingVolume": {"box": [cx, cy, cz, hx, 0, 0, 0, hy, 0, 0, 0, hz]},
+              "geometricError": 12.5, "refine": "ADD", "content": {"uri": "model-0.viewer.json"},
+              "extras": {"byteLength": 1048576, "objects": 12}, "children": [...]}}
+
+Bounding volumes are axis aligned boxes in the coordinates of the viewer JSON, not in ECEF. The
+geometric error of a tile is the largest extent of the objects below it, 0 for leaf tiles.
+
+>>> leaves, bounds, nbytes = object_bounds(root, buffers)
+>>> tree = build_octree(bounds, nbytes, max_tile_bytes=4 << 20)
+>>> write_tiles('model.viewer.json', 'tiles/')
+"""
+from __future__ import annotations
+
+import collections
+import contextlib
+import dataclasses
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+import ujson
+
+from ifcexport2.mesh_to_three import Object3DStorage
+from ifcexport2.partition import Object3DBuilder, calculate_geometry_size, _quantize_part
+from ifcexport2.viewer_buffers import GeometryBuffer, BIN_SUFFIX, encode_geometry, float_attribute, load_buffers
+
+MAX_TILE_BYTES = 4 << 20
+MAX_DEPTH = 8
+TILESET_SUFFIX = ".tileset.json"
+IDENTITY = [1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1]
+# Corners of a box as (min, max) choices per axis
+CORNERS = (np.arange(8)[:, None] >> np.arange(3)) & 1
+
+
+@dataclasses.dataclass(slots=True)
+class Tile:
+    # Cell of the octree, the bounds of the content may stick out of it
+    center: np.ndarray
+    half: float
+    depth: int
+    # Indices of the tile's own objects
+    objects: np.ndarray
+    children: list["Tile"] = dataclasses.field(default_factory=list)
+    # Bounds of the tile's objects and all its children
+    bounds: Optional[np.ndarray] = None
+    byte_length: int = 0
+    geometric_error: float = 0.0
+    uri: Optional[str] = None
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+
+def _matrix(obj: dict) -> np.ndarray:
+    return np.array(obj.get("matrix", IDENTITY), dtype=np.float64).reshape((4, 4), order="F")
+
+
+def viewer_leaves(root: dict) -> list[tuple[dict, np.ndarray]]:
+    """(object, world matrix) of the mesh and LOD objects of a three.js root, in tree order."""
+    leaves = []
+
+    def inner(obj, parent):
+        world = parent @ _matrix(obj)
+        if obj.get("type") == "LOD" or "geometry" in obj:
+            leaves.append((obj, world))
+        else:
+            for child in obj.get("children", ()):
+                inner(child, world)
+
+    inner(root["object"], np.eye(4))
+    return leaves
+
+
+def object_bounds(root: dict, buffers: list = ()) -> tuple[list[tuple[dict, np.ndarray]], np.ndarray, np.ndarray]:
+    """
+    Leaves of ``root`` (``viewer_leaves``), their world bounds (n, 2, 3) and geometry byte sizes (n,).
+    LOD objects are bounded by their first level and sized by all of them.
+    """
+    geometries = {g["uuid"]: g for g in root["geometries"]}
+    leaves = viewer_leaves(root)
+    keys = []
+    matrices = np.empty((len(leaves), 4, 4))
+    nbytes = np.empty(len(leaves), dtype=np.int64)
+    for i, (obj, world) in enumerate(leaves):
+        if obj.get("type") == "LOD":
+            level = obj["children"][0]
+            keys.append(level["geometry"])
+            matrices[i] = world @ _matrix(level)
+            nbytes[i] = sum(calculate_geometry_size(geometries[l["geometry"]]) for l in obj["children"])
+        else:
+            keys.append(obj["geometry"])
+            matrices[i] = world
+            nbytes[i] = calculate_geometry_size(geometries[obj["geometry"]])
+
+    # Local bounds of every geometry over one concatenated position array
+    unique = list(dict.fromkeys(keys))
+    positions = [float_attribute(geometries[k]["data"]["attributes"]["position"], buffers) for k in unique]
+    counts = np.array([len(p) for p in positions])
+    local = np.zeros((len(unique), 2, 3))
+    if counts.any():
+        stacked = np.concatenate([p for p in positions if len(p)])
+        starts = (np.cumsum(counts) - counts)[counts > 0]
+        local[counts > 0, 0] = np.minimum.reduceat(stacked, starts)
+        local[counts > 0, 1] = np.maximum.reduceat(stacked, starts)
+    index = {k: i for i, k in enumerate(unique)}
+    local = local[[index[k] for k in keys]].reshape((-1, 2, 3))
+
+    return leaves, world_bounds(local, matrices), nbytes
+
+
+def world_bounds(local: np.ndarray, matrices: np.ndarray) -> np.ndarray:
+    """World bounds (n, 2, 3) of local boxes (n, 2, 3) transformed by ``matrices`` (n, 4, 4)."""
+    corners = np.where(CORNERS[None], local[:, 1, None, :], local[:, 0, None, :])
+    world = np.einsum("nij,nkj->nki", matrices[:, :3, :3], corners) + matrices[:, None, :3, 3]
+    return np.stack([world.min(axis=1), world.max(axis=1)], axis=1)
+
+
+def content_tiles(tree: Tile) -> list[Tile]:
+    """The tiles of ``tree`` with objects in breadth first order, the coarse tiles first."""
+    tiles = []
+    queue = collections.deque([tree])
+    while queue:
+        tile = queue.popleft()
+        queue.extend(tile.children)
+        if len(tile.objects):
+            tiles.append(tile)
+    return tiles
+
+
+def build_octree(bounds: np.ndarray, nbytes: np.ndarray, max_tile_bytes: int = MAX_TILE_BYTES,
+                 max_depth: int = MAX_DEPTH) -> Tile:
+    """
+    Loose octree over objects with world ``bounds`` (n, 2, 3) and sizes ``nbytes``. Tiles above
+    ``max_tile_bytes`` are split by object centre into octants, objects larger than an octant stay
+    in the tile. Tiles at ``max_depth`` and tiles of large objects only may exceed the budget.
+    """
+    centers = bounds.mean(axis=1)
+    extents = (bounds[:, 1] - bounds[:, 0]).max(axis=1)
+    if len(bounds):
+        low, high = bounds[:, 0].min(axis=0), bounds[:, 1].max(axis=0)
+    else:
+        low = high = np.zeros(3)
+
+    def inner(indices, center, half, depth):
+        tile = Tile(center, half, depth, indices)
+        if nbytes[indices].sum() <= max_tile_bytes or depth >= max_depth or len(indices) < 2:
+            return tile
+        # Objects larger than an octant (edge = half) stay here
+        large = extents[indices] > half
+        tile.objects = indices[large]
+        small = indices[~large]
+        octants = (centers[small] > center) @ (1 << np.arange(3))
+        for octant in np.unique(octants):
+            sign = np.where((octant >> np.arange(3)) & 1, 1.0, -1.0)
+            tile.children.append(inner(small[octants == octant], center + sign * half / 2, half / 2, depth + 1))
+        return tile
+
+    root = inner(np.arange(len(bounds)), (low + high) / 2, float((high - low).max()) / 2, 0)
+
+    def summarize(tile):
+        for child in tile.children:
+            summarize(child)
+        boxes = [bounds[tile.objects]] + [child.bounds[None] for child in tile.children]
+        boxes = np.concatenate(boxes)
+        tile.bounds = np.stack([boxes[:, 0].min(axis=0), boxes[:, 1].max(axis=0)]) if len(boxes) else np.zeros((2, 3))
+        tile.byte_length = int(nbytes[tile.objects].sum())
+        tile.geometric_error = max((max(float(extents[child.objects].max(initial=0)), child.geometric_error)
+                                    for child in tile.children), default=0.0)
+
+    summarize(root)
+    return root
+
+
+def tileset_json(root: Tile) -> dict:
+    """3D Tiles like manifest of a tree whose tiles have their ``uri`` set."""
+
+    def inner(tile):
+        center = (tile.bounds[0] + tile.bounds[1]) / 2
+        hx, hy, hz = ((tile.bounds[1] - tile.bounds[0]) / 2).tolist()
+        jsn = {"boundingVolume": {"box": [*center.tolist(), hx, 0, 0, 0, hy, 0, 0, 0, hz]},
+               "geometricError": tile.geometric_error,
+               "refine": "ADD"}
+        if tile.uri is not None:
+            jsn["content"] = {"uri": tile.uri}
+        jsn["extras"] = {"byteLength": tile.byte_length, "objects": len(tile.objects)}
+        if tile.children:
+            jsn["children"] = [inner(child) for child in tile.children]
+        return jsn
+
+    return {"asset": {"version": "1.1", "generator": "ifcexport2"},
+            "geometricError": root.geometric_error,
+            "root": inner(root)}
+
+
+def tile_viewer_json(root: dict, leaves: list[tuple[dict, np.ndarray]], tree: Tile, name_prefix: str = "Group",
+                     buffers: list = (), make_buffer=None, quantize: bool = False):
+    """
+    Yields ``(i, tile, jsn)`` for every tile of ``tree`` with objects (``content_tiles``). ``leaves`` are
+    the ``object_bounds`` leaves of ``root`` the tree was built over. Objects are placed by their world matrix directly under the tile group, ``buffers``,
+    ``make_buffer`` and ``quantize`` are as in ``partition.partition_viewer_json``.
+    """
+    storage = leaves_storage(root)
+    for i, tile in enumerate(content_tiles(tree)):
+        jsn = leaves_viewer_json(root, storage, [leaves[k] for k in tile.objects], f"{name_prefix}-{i}",
+                                 {"part": name_prefix, "tile": i}, buffers,
+                                 make_buffer(i) if make_buffer is not None else None, quantize)
+        yield i, tile, jsn
+
+
+def leaves_storage(root: dict) -> Object3DStorage:
+    """Geometries and materials of ``root`` for ``leaves_viewer_json``."""
+    return Object3DStorage({}, {g["uuid"]: g for g in root["geometries"]},
+                           {m["uuid"]: m for m in root["materials"]})
+
+
+def leaves_viewer_json(root: dict, storage: Object3DStorage, leaves: list[tuple[dict, np.ndarray]], name: str,
+                       props: dict, buffers: list = (), buffer=None, quantize: bool = False) -> dict:
+    """
+    Viewer JSON of some ``viewer_leaves`` of ``root``, placed by their world matrix directly under the
+    root group. The geometries are stored in ``buffer`` if given, otherwise they keep the buffers of ``root``.
+    """
+    builder = Object3DBuilder(name, props)
+    for obj, world in leaves:
+        builder.add_object({**obj, "matrix": world.reshape(-1, order="F").tolist()}, storage)
+    jsn = builder.to_three()
+    if quantize:
+        jsn = _quantize_part(jsn, buffers, buffer)
+    elif buffer is not None:
+        jsn["geometries"] = [encode_geometry(g, buffers, buffer) for g in jsn["geometries"]]
+    elif "buffers" in root:
+        jsn["buffers"] = root["buffers"]
+    if buffer is not None and buffer.entry() is not None:
+        jsn["buffers"] = [buffer.entry()]
+    return jsn
+
+
+def write_tiles(input_path: Union[str, Path], output_dir: Union[str, Path], name: Optional[str] = None,
+                max_tile_bytes: int = MAX_TILE_BYTES, max_depth: int = MAX_DEPTH, quantize: bool = False) -> list[Path]:
+    """
+    Tile a viewer JSON file into ``output_dir`` (``build_octree``, ``tile_viewer_json``): ``<name>-<i>.viewer.json`` tiles,
+    their ``*.bin`` if the input has external buffers and the ``<name>.tileset.json`` manifest, the
+    last of the returned paths. ``name`` defaults to the input name without suffixes.
+    """
+    input_path = Path(input_path)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if name is None:
+        name = input_path.name.split(".")[0]
+    with input_path.open("r") as f:
+        root = ujson.load(f)
+    buffers = load_buffers(root, input_path.parent)
+    external = any(not b["uri"].startswith("data:") for b in root.get("buffers", ()))
+    leaves, bounds, nbytes = object_bounds(root, buffers)
+    tree = build_octree(bounds, nbytes, max_tile_bytes, max_depth)
+    outputs = []
+
+    with contextlib.ExitStack() as stack:
+        def make_buffer(i):
+            bin_path = output_dir / f"{name}-{i}.viewer{BIN_SUFFIX}"
+            outputs.append(bin_path)
+            return GeometryBuffer(stack.enter_context(bin_path.open("wb")), bin_path.name)
+
+        for i, tile, jsn in tile_viewer_json(root, leaves, tree, name, buffers,
+                                             make_buffer if external else None, quantize):
+            tile.uri = f"{name}-{i}.viewer.json"
+            outputs.append(output_dir / tile.uri)
+            with (output_dir / tile.uri).open("w") as f:
+                ujson.dump(jsn, f, ensure_ascii=False)
+            # The buffer of the tile is complete
+            stack.close()
+
+    tileset_path = output_dir / f"{name}{TILESET_SUFFIX}"
+    with tileset_path.open("w") as f:
+        ujson.dump(tileset_json(tree), f, ensure_ascii=False)
+    outputs.append(tileset_path)
+    return outputs
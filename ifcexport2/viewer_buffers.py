@@ -0,0 +1,167 @@
+"""
+Binary geometry buffers of the viewer JSON (``IfcExportCompat.viewer_buffers``).
+
+Instead of decimal ``array`` lists, geometry attributes (and the index) reference a range of
+a little-endian binary buffer listed in the root ``buffers``, or carry their bytes inline as
+a base64 ``data`` string::
+
+    {"itemSize": 3, "type": "Float32Array", "buffer": 0, "byteOffset": 0, "byteLength": 1152}
+    {"itemSize": 1, "type": "Uint32Array", "data": "AAAAAAEAAAACAAAA..."}
+
+    "buffers": [{"uri": "model.viewer.bin", "byteLength": 734208}]
+
+Buffer uris are relative to the viewer JSON. Ranges are aligned to 4 bytes, so the viewer
+can create typed array views over the fetched ``ArrayBuffer`` without copying.
+
+>>> with open('model.viewer.json', 'w') as f, open('model.viewer.bin', 'wb') as b:
+...     write_viewer_object(f, 'model', stream.objects, ifc_file, buffer=GeometryBuffer(b, 'model.viewer.bin'))
+"""
+from __future__ import annotations
+
+import base64
+import mmap
+from pathlib import Path
+from typing import BinaryIO, Optional, Union
+
+import numpy as np
+
+BIN_SUFFIX = ".bin"
+
+# three.js typed array name -> little-endian dtype
+TYPED_ARRAYS = {
+    "Float32Array": np.dtype("<f4"),
+    "Float64Array": np.dtype("<f8"),
+    "Int8Array": np.dtype("i1"),
+    "Uint8Array": np.dtype("u1"),
+    "Int16Array": np.dtype("<i2"),
+    "Uint16Array": np.dtype("<u2"),
+    "Int32Array": np.dtype("<i4"),
+    "Uint32Array": np.dtype("<u4"),
+}
+ALIGNMENT = 4
+# Divisors of normalized integer attributes
+NORMALIZED = {"Int8Array": 127, "Uint8Array": 255, "Int16Array": 32767, "Uint16Array": 65535}
+
+
+class GeometryBuffer:
+    """Appends attribute arrays to the binary file ``fp``, referenced as ``uri`` from the JSON."""
+
+    def __init__(self, fp: BinaryIO, uri: str, index: int = 0):
+        self.fp = fp
+        self.uri = uri
+        self.index = index
+        self.byte_length = 0
+
+    def add(self, array: np.ndarray, type_name: str) -> dict:
+        padding = -self.byte_length % ALIGNMENT
+        if padding:
+            self.fp.write(b"\0" * padding)
+            self.byte_length += padding
+        data = np.ascontiguousarray(array, dtype=TYPED_ARRAYS[type_name]).reshape(-1)
+        self.fp.write(data.data)
+        offset = self.byte_length
+        self.byte_length += data.nbytes
+        return {"buffer": self.index, "byteOffset": offset, "byteLength": data.nbytes}
+
+    def entry(self) -> dict:
+        return {"uri": self.uri, "byteLength": self.byte_length}
+
+
+class EmbeddedBuffer:
+    """Stores attribute arrays inline, as base64 ``data``."""
+
+    def add(self, array: np.ndarray, type_name: str) -> dict:
+        data = np.ascontiguousarray(array, dtype=TYPED_ARRAYS[type_name]).reshape(-1)
+        return {"data": base64.b64encode(data.data).decode("ascii")}
+
+    def entry(self) -> Optional[dict]:
+        return None
+
+
+Buffer = Union[GeometryBuffer, EmbeddedBuffer]
+
+
+def attribute(array: np.ndarray, item_size: int, type_name: str, buffer: Optional[Buffer] = None) -> dict:
+    """A BufferAttribute dict of ``array``, as an ``array`` list or stored in ``buffer``."""
+    attr = {"itemSize": item_size, "type": type_name}
+    if buffer is None:
+        attr["array"] = np.asarray(array).reshape(-1).tolist()
+    else:
+        attr.update(buffer.add(array, type_name))
+    return attr
+
+
+def geometry_attributes(geom: dict) -> list[dict]:
+    """The attribute dicts of a BufferGeometry, index included."""
+    data = geom["data"]
+    attrs = list(data["attributes"].values())
+    if "index" in data:
+        attrs.append(data["index"])
+    return attrs
+
+
+def uses_buffers(geom: dict) -> bool:
+    return any("array" not in attr for attr in geometry_attributes(geom))
+
+
+def attribute_nbytes(attr: dict) -> int:
+    if "byteLength" in attr:
+        return attr["byteLength"]
+    if "data" in attr:
+        data = attr["data"]
+        return len(data) * 3 // 4 - data[-2:].count("=")
+    return len(attr["array"]) * TYPED_ARRAYS[attr["type"]].itemsize
+
+
+def load_buffers(root: dict, base_dir: Union[str, Path]) -> list:
+    """Contents of the root ``buffers`` of a viewer JSON, external files are memory-mapped."""
+    buffers = []
+    for entry in root.get("buffers", ()):
+        uri = entry["uri"]
+        if uri.startswith("data:"):
+            buffers.append(base64.b64decode(uri.split(",", 1)[1]))
+            continue
+        with open(Path(base_dir) / uri, "rb") as f:
+            buffers.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if entry["byteLength"] else b"")
+    return buffers
+
+
+def attribute_array(attr: dict, buffers: list) -> np.ndarray:
+    dtype = TYPED_ARRAYS[attr["type"]]
+    if "array" in attr:
+        return np.asarray(attr["array"], dtype=dtype)
+    if "data" in attr:
+        return np.frombuffer(base64.b64decode(attr["data"]), dtype=dtype)
+    return np.frombuffer(buffers[attr["buffer"]], dtype=dtype, count=attr["byteLength"] // dtype.itemsize,
+                         offset=attr["byteOffset"])
+
+
+def float_attribute(attr: dict, buffers: list) -> np.ndarray:
+    """(n, itemSize) float64 values of an attribute, normalized integer attributes are decoded as three.js does."""
+    array = attribute_array(attr, buffers).astype(np.float64).reshape((-1, attr["itemSize"]))
+    if attr.get("normalized"):
+        array /= NORMALIZED[attr["type"]]
+    return array
+
+
+def encode_geometry(geom: dict, buffers: list, buffer: Optional[Buffer] = None) -> dict:
+    """
+    Copy of ``geom`` with its attributes stored in ``buffer`` (or as ``array`` lists if None).
+    ``buffers`` are the loaded buffers ``geom`` refers to, see ``load_buffers``.
+    """
+    if buffer is None and not uses_buffers(geom):
+        return geom
+
+    def encode(attr):
+        if buffer is None and "array" in attr:
+            return attr
+        array = attribute_array(attr, buffers)
+        encoded = {k: v for k, v in attr.items() if k not in ("array", "data", "buffer", "byteOffset", "byteLength")}
+        encoded.update(attribute(array, attr["itemSize"], attr["type"], buffer))
+        return encoded
+
+    data = geom["data"]
+    encoded = {**data, "attributes": {k: encode(v) for k, v in data["attributes"].items()}}
+    if "index" in data:
+        encoded["index"] = encode(data["index"])
+    return {**geom, "data": encoded}
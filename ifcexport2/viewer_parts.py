@@ -0,0 +1,187 @@
+"""
+Partitioned viewer output straight from the conversion results.
+
+Getting parts used to mean writing one viewer JSON and reading it back with ``ifcexport2 split``.
+Here the parts are planned on the ``IRGeometryObject``s themselves: leaf sizes are the ``nbytes``
+of the mesh arrays, the tree is the spatial hierarchy of the model (``partition.partition_tree``)
+or the world bounds of the meshes (``tiling.build_octree``). Each part is then built as its own
+three.js root, with the spatial groups of its products, and written without a JSON round trip.
+
+>>> plan = plan_parts(objects, hierarchy, PartitionPolicy(max_part_bytes=64 * 1024 ** 2))
+>>> write_viewer_parts('out/model', 'model', objects, ifc_file, PartitionPolicy(parts=8))
+"""
+from __future__ import annotations
+
+import contextlib
+import dataclasses
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+import numpy as np
+import ujson
+
+import ifcexport2.ifc_hierarchy
+import ifcexport2.ifc_psets
+from ifcexport2.ifc_to_mesh import _build
+from ifcexport2.mesh import Mesh
+from ifcexport2.mesh_to_three import create_three_js_root
+from ifcexport2.model_index import ModelIndex
+from ifcexport2.models import IRGeometryObject
+from ifcexport2.partition import Node, PartitionReport, partition_tree, flatten_leaves, TOLERANCE
+from ifcexport2.tiling import Tile, build_octree, content_tiles, tileset_json, world_bounds, MAX_DEPTH, \
+    TILESET_SUFFIX
+from ifcexport2.viewer_buffers import GeometryBuffer, EmbeddedBuffer, BIN_SUFFIX
+
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class PartitionPolicy:
+    # A part count or a budget per part in bytes of the mesh arrays, see partition.partition_tree
+    parts: Optional[int] = None
+    max_part_bytes: Optional[int] = None
+    tolerance: float = TOLERANCE
+    # Spatial tiles of at most max_part_bytes (see tiling) instead of parts of the hierarchy
+    tiles: bool = False
+    max_depth: int = MAX_DEPTH
+
+
+@dataclasses.dataclass(slots=True)
+class PartPlan:
+    # Product ids of each part
+    ids: list[list[int]]
+    # Balance of the hierarchy parts
+    report: Optional[PartitionReport] = None
+    # The octree and the tile of each part with spatial tiles
+    tree: Optional[Tile] = None
+    tiles: Optional[list[Tile]] = None
+
+
+def mesh_nbytes(mesh: Mesh) -> int:
+    """Bytes of the arrays of a mesh and of its levels of detail."""
+    nbytes = sum(np.asarray(a).nbytes for a in (mesh.position, mesh.faces, mesh.normals, mesh.uv, mesh.colors,
+                                                 mesh.material_ids) if a is not None)
+    return nbytes + sum(mesh_nbytes(level) for _, level in (mesh.lods or ()))
+
+
+def object_sizes(objects: list[IRGeometryObject]) -> np.ndarray:
+    """Sizes of the objects, instances of a mesh after the first one only count their matrix."""
+    seen = set()
+    sizes = np.empty(len(objects), dtype=np.int64)
+    for i, o in enumerate(objects):
+        sizes[i] = 128 if o.mesh.uid in seen else mesh_nbytes(o.mesh)
+        seen.add(o.mesh.uid)
+    return sizes
+
+
+def object_world_bounds(objects: list[IRGeometryObject]) -> np.ndarray:
+    """World bounds (n, 2, 3) of the meshes of the objects."""
+    local = {}
+    boxes = np.zeros((len(objects), 2, 3))
+    for i, o in enumerate(objects):
+        if o.mesh.uid not in local:
+            position = np.asarray(o.mesh.position, dtype=np.float64).reshape((-1, 3))
+            local[o.mesh.uid] = (position.min(axis=0), position.max(axis=0)) if len(position) else (0, 0)
+        boxes[i] = local[o.mesh.uid]
+    matrices = np.array([np.asarray(o.transform, dtype=np.float64).reshape((4, 4)) for o in objects]).reshape((-1, 4, 4))
+    return world_bounds(boxes, matrices)
+
+
+def hierarchy_tree(h: ifcexport2.ifc_hierarchy.Hierarchy, sizes: dict[int, int]) -> Node:
+    """``Node`` tree of the products with ``sizes`` (id -> bytes) under their spatial hierarchy, leaf uids are product ids."""
+    seen = set()
+
+    def inner(obj_id):
+        children = h.hierarchy.get(obj_id, [])
+        own = None
+        if obj_id in sizes and obj_id not in seen:
+            seen.add(obj_id)
+            own = Node(True, sizes[obj_id], uid=obj_id)
+        if not children:
+            return own
+        # The own geometry of a group element is its first child, as in the viewer tree
+        nodes = [n for n in [own, *map(inner, children)] if n is not None]
+        return Node(False, children=nodes, uid=obj_id) if nodes else None
+
+    return Node(False, children=[n for n in map(inner, h.root_elements) if n is not None])
+
+
+def plan_parts(objects: list[IRGeometryObject], h: ifcexport2.ifc_hierarchy.Hierarchy, policy: PartitionPolicy) -> PartPlan:
+    """The products of each part of ``objects`` under the hierarchy ``h`` (``ifc_hierarchy.build_hierarchy``)."""
+    sizes = object_sizes(objects)
+    if policy.tiles:
+        if policy.max_part_bytes is None:
+            raise ValueError('Spatial tiles need a maximum part size')
+        tree = build_octree(object_world_bounds(objects), sizes, policy.max_part_bytes, policy.max_depth)
+        tiles = content_tiles(tree)
+        return PartPlan([[objects[k].id for k in tile.objects] for tile in tiles], tree=tree, tiles=tiles)
+    h = ifcexport2.ifc_hierarchy.clean_hierarchy(h, [o.id for o in objects])
+    tree = hierarchy_tree(h, {o.id: int(size) for o, size in zip(objects, sizes)})
+    groups, report = partition_tree(tree, policy.parts, policy.max_part_bytes, policy.tolerance)
+    return PartPlan([[leaf.uid for leaf in flatten_leaves(g)] for g in groups], report=report)
+
+
+def viewer_parts(name: str, objects: list[IRGeometryObject], ifc_file, plan: PartPlan,
+                 h: ifcexport2.ifc_hierarchy.Hierarchy, index: Optional[ModelIndex] = None,
+                 quantize: bool = False, material_groups: bool = False, make_buffer=None) -> Iterator[dict]:
+    """
+    Yields the three.js root of each part of ``plan``, built from ``objects`` under the spatial groups of
+    its products. ``make_buffer(i)`` returns the buffer the geometries of part ``i`` are stored in (as
+    ``array`` lists if not given), it must be written out before the next part is requested.
+    """
+    if index is None:
+        index = ModelIndex.build(ifc_file)
+    geoms = {o.id: o for o in objects}
+    extractor = ifcexport2.ifc_psets.PropsExtractor(ifc_file, index)
+    for i, ids in enumerate(plan.ids):
+        props = {'part': name} if plan.tiles is None else {'part': name, 'tile': i}
+        root = create_three_js_root(f'{name}-{i}', props)
+        buffer = make_buffer(i) if make_buffer is not None else None
+        _build(root, ifcexport2.ifc_hierarchy.clean_hierarchy(h, ids), {k: geoms[k] for k in ids}, ifc_file, index,
+               quantize, material_groups, buffer, extractor)
+        if buffer is not None and buffer.entry() is not None:
+            root['buffers'] = [buffer.entry()]
+        yield root
+
+
+def write_viewer_parts(output_prefix: Union[str, Path], name: str, objects: list[IRGeometryObject], ifc_file,
+                       policy: PartitionPolicy, include_spatial_hierarchy: bool = True,
+                       index: Optional[ModelIndex] = None, buffers: Optional[str] = None,
+                       quantize: bool = False, material_groups: bool = False) -> tuple[list[Path], PartPlan]:
+    """
+    Write the parts of ``objects`` as ``<output_prefix>-<i>.viewer.json``, with spatial tiles also the
+    ``<output_prefix>.tileset.json`` manifest (see ``tiling``). ``buffers`` is None for ``array`` lists,
+    'file' for a ``<output_prefix>-<i>.viewer.bin`` per part and 'embedded' for base64 buffers.
+    Returns the written files and the plan.
+    """
+    output_prefix = Path(output_prefix)
+    if index is None:
+        index = ModelIndex.build(ifc_file)
+    h = ifcexport2.ifc_hierarchy.build_hierarchy(ifc_file, include_spatial_hierarchy=include_spatial_hierarchy, index=index)
+    plan = plan_parts(objects, h, policy)
+    outputs = []
+
+    with contextlib.ExitStack() as stack:
+        def make_buffer(i):
+            if buffers == 'embedded':
+                return EmbeddedBuffer()
+            bin_path = output_prefix.with_name(f'{output_prefix.name}-{i}.viewer{BIN_SUFFIX}')
+            outputs.append(bin_path)
+            return GeometryBuffer(stack.enter_context(bin_path.open('wb')), bin_path.name)
+
+        for i, root in enumerate(viewer_parts(name, objects, ifc_file, plan, h, index, quantize, material_groups,
+                                              make_buffer if buffers is not None else None)):
+            path = output_prefix.with_name(f'{output_prefix.name}-{i}.viewer.json')
+            with path.open('w') as f:
+                # Object props can be ChainMap views over shared property sets (see ifc_psets.PropsExtractor)
+                ujson.dump(root, f, ensure_ascii=False, default=dict)
+            outputs.append(path)
+            if plan.tiles is not None:
+                plan.tiles[i].uri = path.name
+            # The buffer of the part is complete
+            stack.close()
+
+    if plan.tree is not None:
+        tileset_path = output_prefix.with_name(f'{output_prefix.name}{TILESET_SUFFIX}')
+        with tileset_path.open('w') as f:
+            ujson.dump(tileset_json(plan.tree), f, ensure_ascii=False)
+        outputs.append(tileset_path)
+    return outputs, plan
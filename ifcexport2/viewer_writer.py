@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+from typing import TextIO
+
+import ujson
+
+from ifcexport2.mesh_to_three import create_three_js_root, add_material
+
+
+class ViewerJsonWriter:
+    """
+    Incrementally write a three.js JSON object (the *.viewer.json layout).
+
+    Geometries are serialized and written to ``fp`` as soon as they are added, so the
+    caller can drop the arrays right after. Materials and the object tree are kept in
+    memory and written by ``close()``, they are small compared to the geometry.
+    Entries of ``buffers`` (``viewer_buffers.GeometryBuffer``) are written by ``close()`` as
+    the root ``buffers``, once their length is known.
+
+    >>> with open('model.viewer.json', 'w') as f, ViewerJsonWriter(f, 'Model') as writer:
+    ...     writer.add_geometry(geom)
+    ...     writer.object['children'].append(mesh_object)
+    """
+
+    def __init__(self, fp: TextIO, name: str = "Object", props: dict = None):
+        self.fp = fp
+        self.root = create_three_js_root(name, props)
+        self.geometries_count = 0
+        self.buffers = []
+        self.closed = False
+        fp.write('{"metadata":')
+        fp.write(ujson.dumps(self.root['metadata']))
+        fp.write(',"geometries":[')
+
+    @property
+    def object(self) -> dict:
+        return self.root['object']
+
+    def add_geometry(self, geom: dict):
+        if self.geometries_count > 0:
+            self.fp.write(',')
+        self.fp.write(ujson.dumps(geom, ensure_ascii=False))
+        self.geometries_count += 1
+
+    def add_material(self, mat: dict):
+        # A list for objects with material groups
+        for m in (mat if isinstance(mat, list) else [mat]):
+            add_material(self.root, m, check_exist=True)
+
+    def close(self):
+        if self.closed:
+            return
+        self.fp.write('],"materials":')
+        self.fp.write(ujson.dumps(self.root['materials'], ensure_ascii=False))
+        self.fp.write(',"object":')
+        # Object props can be ChainMap views over shared property sets (see ifc_psets.PropsExtractor)
+        self.fp.write(ujson.dumps(self.root['object'], ensure_ascii=False, default=dict))
+        entries = [b.entry() for b in self.buffers]
+        entries = [e for e in entries if e is not None]
+        if entries:
+            self.fp.write(',"buffers":')
+            self.fp.write(ujson.dumps(entries, ensure_ascii=False))
+        self.fp.write('}')
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
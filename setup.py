@@ -16,12 +16,20 @@ setup(
 "rich",
 "celery[redis]",
 "fastapi[all]",
+        # Range requests of FileResponse, see appv2.app.blobs_proxy
+        "starlette>=0.39",
 "uvicorn[standard]",
 "aiofiles",
         "psutil",
         "kubernetes",
         "tqdm"
     ],
+    extras_require={
+        # brotli and zstd variants of the blobs, see ifcexport2.blob_variants
+        "compression": ["brotli", "zstandard"],
+        # tests/, the app runs against an in-memory Redis
+        "test": ["pytest", "fakeredis", "httpx"],
+    },
     entry_points={
         'console_scripts': [
             'ifcexport2=ifcexport2.cli:ifcexport2_cli',
@@ -0,0 +1,29 @@
+import os
+import tempfile
+
+import pytest
+
+# The settings modules require an existing volume at import
+os.environ.setdefault("VOLUME_PATH", tempfile.mkdtemp(prefix="ifcexport2-tests-"))
+
+
+@pytest.fixture
+def redis_client(monkeypatch):
+    """The app with its Redis clients replaced by one in-memory fake."""
+    fakeredis = pytest.importorskip("fakeredis")
+    import ifcexport2.appv2.app as app_module
+
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(app_module, "r", client)
+    monkeypatch.setattr(app_module.upload_statuses, "client", client)
+    monkeypatch.setattr(app_module.result_cache, "client", client)
+    return client
+
+
+@pytest.fixture
+def client(redis_client):
+    from fastapi.testclient import TestClient
+    from ifcexport2.appv2.app import app
+
+    with TestClient(app) as test_client:
+        yield test_client
@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+
+@pytest.fixture
+def blob():
+    from ifcexport2.appv2.app import BLOBS_PATH
+
+    path = BLOBS_PATH / "model-test.json"
+    path.write_bytes(b'{"a": "' + os.urandom(500).hex().encode() + b'"}')
+    yield path
+    path.unlink()
+
+
+def test_validators(client, blob):
+    res = client.get(f"/blobs/{blob.name}", headers={"Accept-Encoding": "identity"})
+    assert res.status_code == 200
+    assert res.headers["cache-control"] == "no-cache"
+    assert res.headers["etag"].startswith('"')
+    assert res.content == blob.read_bytes()
+    etag = res.headers["etag"]
+    assert client.get(f"/blobs/{blob.name}", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get(f"/blobs/{blob.name}", headers={"If-None-Match": f'"other", W/{etag}'}).status_code == 304
+    assert client.get(f"/blobs/{blob.name}", headers={"If-None-Match": '"other"'}).status_code == 200
+    modified = client.get(f"/blobs/{blob.name}", headers={"If-Modified-Since": res.headers["last-modified"]})
+    assert modified.status_code == 304
+
+
+def test_range(client, blob):
+    res = client.get(f"/blobs/{blob.name}", headers={"Accept-Encoding": "identity", "Range": "bytes=10-19"})
+    assert res.status_code == 206
+    assert res.headers["content-range"] == f"bytes 10-19/{blob.stat().st_size}"
+    assert res.content == blob.read_bytes()[10:20]
+    stale = client.get(f"/blobs/{blob.name}", headers={"Accept-Encoding": "identity", "Range": "bytes=10-19",
+                                                        "If-Range": '"other"'})
+    assert stale.status_code == 200
+
+
+def test_outside_blobs(client, blob):
+    assert client.get("/blobs/..%2Fsecret").status_code == 404
+    assert client.get("/blobs/missing.json").status_code == 404
@@ -0,0 +1,88 @@
+import json
+import os
+
+import pytest
+
+from ifcexport2.appv2.result_cache import ResultCache, conversion_key
+
+
+@pytest.fixture
+def cache():
+    fakeredis = pytest.importorskip("fakeredis")
+    return ResultCache(fakeredis.FakeRedis(), prefix="test-results:", ttl=100, in_flight_ttl=10)
+
+
+def test_claim(cache):
+    assert cache.claim("key", "task-1") is None
+    assert cache.client.ttl("test-results:key") == 10
+    # Identical requests attach to the task holding the key
+    assert cache.claim("key", "task-2") == "task-1"
+    # An unusable task (failed, blob gone) gives the key up
+    assert cache.claim("key", "task-3", usable=lambda task_id: False) is None
+    assert cache.claim("key", "task-4") == "task-3"
+
+
+def test_complete(cache):
+    cache.claim("key", "task-1")
+    assert not cache.complete("key", "task-2")
+    assert cache.complete("key", "task-1")
+    assert cache.client.ttl("test-results:key") == 100
+    assert cache.claim("key", "task-2") == "task-1"
+
+
+def test_release(cache):
+    cache.claim("key", "task-1")
+    # Only the task holding the key releases it
+    assert not cache.release("key", "task-2")
+    assert cache.client.get("test-results:key") == b"task-1"
+    assert cache.release("key", "task-1")
+    assert cache.claim("key", "task-2") is None
+    assert not cache.complete("key", "task-1")
+
+
+def test_conversion_key():
+    data = {"name": "a", "upload_id": "1", "fp": "x", "excluded_types": ["IfcSpace"], "settings": {"A": 1}}
+    key = conversion_key("sha", data)
+    # Per-request fields do not change the key
+    assert conversion_key("sha", {**data, "name": "b", "upload_id": "2", "fp": "y"}) == key
+    assert conversion_key("sha", {**data, "excluded_types": []}) != key
+    assert conversion_key("other", data) != key
+
+
+def upload(client, content):
+    res = client.post("/upload", params=dict(scene_id=1, user_id=2), files={"file": ("model.ifc", content)})
+    return res.json()["id"]
+
+
+def complete(redis_client, task_id, blob):
+    import ifcexport2.appv2.app as app_module
+    data = json.loads(redis_client.hget(task_id, "data"))["data"]
+    redis_client.hset(task_id, mapping={"status": "success",
+                                        "result": json.dumps({"url": f"http://host/blobs/{blob.name}", "name": "m"})})
+    assert app_module.result_cache.complete(data["cache_key"], task_id)
+
+
+def test_conversion_endpoint(client, redis_client):
+    from ifcexport2.appv2.app import BLOBS_PATH
+
+    content = b"ISO-10303-21;" + os.urandom(1000)
+    first, second = upload(client, content), upload(client, content)
+    task = client.post(f"/conversion/{first}", json={}).json()
+    # The same content with the same settings attaches to the pending task
+    assert client.post(f"/conversion/{second}", json={}).json()["id"] == task["id"]
+    assert client.post(f"/conversion/{second}", json={"excluded_types": []}).json()["id"] != task["id"]
+    assert client.post(f"/conversion/{upload(client, content + b'1')}", json={}).json()["id"] != task["id"]
+
+    blob = BLOBS_PATH / f"model-{task['id']}.json"
+    blob.write_text("{}")
+    complete(redis_client, task["id"], blob)
+    hit = client.post(f"/conversion/{second}", json={}).json()
+    assert hit["id"] == task["id"] and hit["status"] == "success"
+
+    # A result without its blob is converted again
+    blob.unlink()
+    again = client.post(f"/conversion/{second}", json={}).json()
+    assert again["id"] != task["id"] and again["status"] == "pending"
+    # And so is a failed task
+    redis_client.hset(again["id"], "status", "error")
+    assert client.post(f"/conversion/{first}", json={}).json()["id"] not in (task["id"], again["id"])
@@ -0,0 +1,137 @@
+import asyncio
+import hashlib
+import os
+
+import pytest
+from starlette.requests import ClientDisconnect
+
+import ifcexport2.appv2.uploads as uploads
+from ifcexport2.appv2.app import upload_statuses
+
+OFFSET_HEADERS = {"Content-Type": uploads.OFFSET_CONTENT_TYPE}
+DATA = os.urandom(300_000)
+
+
+def create(client, length=len(DATA)):
+    res = client.post("/uploads", params=dict(scene_id=1, user_id=2, filename="model.ifc"),
+                      headers={"Upload-Length": str(length)})
+    assert res.status_code == 201
+    return res.json()["id"], res.headers["location"]
+
+
+def patch(client, location, body, offset):
+    return client.patch(location, content=body, headers={**OFFSET_HEADERS, "Upload-Offset": str(offset)})
+
+
+def upload_data(client, upload_id):
+    return client.get(f"/upload_data/{upload_id}").json()
+
+
+def test_resumable_upload(client):
+    upload_id, location = create(client)
+    assert patch(client, location, DATA[:100_000], 0).headers["upload-offset"] == "100000"
+    assert client.head(location).headers["upload-offset"] == "100000"
+    res = patch(client, location, DATA[100_000:], 100_000)
+    assert res.status_code == 204
+    assert res.headers["upload-offset"] == str(len(DATA))
+    data = upload_data(client, upload_id)
+    assert data["status"] == "success"
+    assert data["sha256"] == hashlib.sha256(DATA).hexdigest()
+    with open(data["file_path"], "rb") as f:
+        assert f.read() == DATA
+    # Complete uploads take no more chunks
+    assert patch(client, location, b"x", len(DATA)).status_code == 409
+
+
+def test_offset_mismatch(client):
+    upload_id, location = create(client)
+    patch(client, location, DATA[:100_000], 0)
+    res = patch(client, location, DATA[50_000:], 50_000)
+    assert res.status_code == 409
+    # The current offset to resume from
+    assert res.headers["upload-offset"] == "100000"
+    assert upload_data(client, upload_id)["offset"] == 100_000
+
+
+def test_body_over_upload_length(client):
+    upload_id, location = create(client)
+    res = patch(client, location, DATA + b"extra", 0)
+    assert res.status_code == 409
+    assert upload_data(client, upload_id)["status"] == "pending"
+    # What fit stays, the rest is sent again from the offset
+    offset = int(client.head(location).headers["upload-offset"])
+    assert offset <= len(DATA)
+    assert patch(client, location, DATA[offset:], offset).status_code == 204
+    data = upload_data(client, upload_id)
+    assert data["status"] == "success"
+    assert data["sha256"] == hashlib.sha256(DATA).hexdigest()
+
+
+def test_resume_after_interrupted_patch(client):
+    upload_id, location = create(client)
+
+    async def disconnected():
+        yield DATA[:60_000]
+        yield DATA[60_000:120_000]
+        raise ClientDisconnect()
+
+    with pytest.raises(ClientDisconnect):
+        asyncio.run(uploads.append_chunks(upload_statuses[upload_id], disconnected(), upload_statuses, offset=0))
+    assert client.head(location).headers["upload-offset"] == "120000"
+    # Resumed as by another replica, the hash state is rebuilt from the file
+    uploads._hashers.clear()
+    assert patch(client, location, DATA[120_000:], 120_000).status_code == 204
+    data = upload_data(client, upload_id)
+    assert data["status"] == "success"
+    assert data["sha256"] == hashlib.sha256(DATA).hexdigest()
+
+
+def test_wrong_content_type(client):
+    _, location = create(client)
+    res = client.patch(location, content=b"x", headers={"Content-Type": "text/plain", "Upload-Offset": "0"})
+    assert res.status_code == 415
+
+
+def test_multipart_upload(client):
+    res = client.post("/upload", params=dict(scene_id=1, user_id=2),
+                      data={"comment": "before the file"}, files={"file": ("model.ifc", DATA)})
+    assert res.status_code == 200
+    data = upload_data(client, res.json()["id"])
+    assert data["status"] == "success"
+    assert data["total_size"] == len(DATA)
+    assert data["sha256"] == hashlib.sha256(DATA).hexdigest()
+    assert data["file_path"].endswith(".ifc")
+
+
+def test_multipart_without_file(client):
+    res = client.post("/upload", params=dict(scene_id=1, user_id=2), data={"comment": "no file"},
+                      files={"other": ("model.ifc", b"x")})
+    assert res.status_code == 400
+    assert client.post("/upload", params=dict(scene_id=1, user_id=2), content=b"x").status_code == 400
+
+
+class _Request:
+    """A request streaming ``body`` in chunks of ``size`` bytes."""
+
+    def __init__(self, body: bytes, content_type: str, size: int):
+        self.headers = {"content-type": content_type}
+        self.body = body
+        self.size = size
+
+    async def stream(self):
+        for i in range(0, len(self.body), self.size):
+            yield self.body[i:i + self.size]
+
+
+def test_multipart_file_split_chunks():
+    boundary = "b0undary"
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="comment"\r\n\r\nhi\r\n'
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="a b.ifc"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode() + DATA + f"\r\n--{boundary}--\r\n".encode()
+
+    async def read():
+        form = uploads.MultipartFile(_Request(body, f"multipart/form-data; boundary={boundary}", 7))
+        filename = await form.start()
+        return filename, b"".join([chunk async for chunk in form.chunks()])
+
+    assert asyncio.run(read()) == ("a b.ifc", DATA)